@@ -0,0 +1,91 @@
+"""
+Queue remote commands and run them in a single round trip
+"""
+
+import re
+import shlex
+
+from invoke.exceptions import UnexpectedExit
+
+MARKER = '__batch_failed__'
+
+
+class BatchError(Exception):
+    """
+    A queued command failed, the ones after it were not run
+    """
+
+    def __init__(self, index, command, result):
+        self.index = index
+        self.command = command
+        self.result = result
+        super().__init__(f'Command {index} failed: {command}')
+
+
+def script(commands):
+    """
+    Shell command running commands in order, stopping at the first failure
+
+    A failing command reports its (1-based) index on stderr and its exit
+    code becomes the exit code of the script.
+    """
+    if len(commands) == 1:
+        return commands[0]
+    lines = [
+        f'{{ {command}; }} || {{ rc=$?; echo "{MARKER} {index}" >&2; exit $rc; }}'
+        for index, command in enumerate(commands, 1)
+    ]
+    return f"sh -c {shlex.quote(chr(10).join(lines))}"
+
+
+class Batch:
+    """
+    Commands queued in a task and flushed as one remote script
+
+        with Batch(c, sudo=True) as batch:
+            batch.run("supervisorctl reread")
+            batch.run("supervisorctl update")
+    """
+
+    def __init__(self, c, sudo=False, **kwargs):
+        self.c = c
+        self.sudo = sudo
+        self.kwargs = kwargs
+        self.commands = []
+
+    def run(self, command):
+        self.commands.append(command)
+        return self
+
+    def flush(self):
+        """
+        Run the queued commands, raise BatchError naming the one that failed
+        """
+        if not self.commands:
+            return None
+        commands, self.commands = self.commands, []
+        runner = self.c.sudo if self.sudo else self.c.run
+        try:
+            return runner(script(commands), **self.kwargs)
+        except UnexpectedExit as error:
+            index = failed_index(error.result, len(commands))
+            raise BatchError(index, commands[index - 1], error.result) from error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        return False
+
+
+def failed_index(result, count):
+    """
+    Index of the failing command as reported in the output of the script
+    """
+    if count == 1:
+        return 1
+    output = f'{result.stdout}\n{result.stderr}'
+    found = re.findall(fr'{MARKER} (\d+)', output)
+    return int(found[-1]) if found else count
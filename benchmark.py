@@ -0,0 +1,334 @@
+"""
+HTTP load generator for deployed or locally started sites
+"""
+
+import asyncio
+import contextlib
+import importlib.util
+import itertools
+import math
+import platform
+import shlex
+import socket
+import ssl
+import subprocess
+import sys
+import time
+import urllib.parse
+
+import template
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of values, which must be sorted
+    """
+    if not values:
+        return None
+    rank = max(math.ceil(p / 100 * len(values)), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+def summary(latencies):
+    """
+    Latency statistics in milliseconds
+    """
+    values = sorted(latencies)
+    return {
+        'requests': len(values),
+        'p50': round(percentile(values, 50) * 1000, 3) if values else None,
+        'p95': round(percentile(values, 95) * 1000, 3) if values else None,
+        'p99': round(percentile(values, 99) * 1000, 3) if values else None,
+        'max': round(values[-1] * 1000, 3) if values else None,
+    }
+
+
+async def read_response(reader):
+    """
+    Read one HTTP/1.1 response, return status and whether to keep the
+    connection
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('Connection closed')
+    version, status, *_ = status_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    elif status not in ('204', '304') and not status.startswith('1'):
+        await reader.read()
+        return int(status), False
+
+    keep = headers.get('connection', '').lower() != 'close'
+    return int(status), keep and version == 'HTTP/1.1'
+
+
+class Client:
+    """
+    One keep-alive connection issuing requests back to back
+    """
+
+    def __init__(self, url):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.ssl = ssl.create_default_context() if parts.scheme == 'https' \
+            else None
+        self.prefix = parts.path.rstrip('/')
+        self.netloc = parts.netloc
+        self.reader = self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, ssl=self.ssl
+        )
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            with contextlib.suppress(Exception):
+                await self.writer.wait_closed()
+        self.reader = self.writer = None
+
+    async def get(self, path):
+        if self.writer is None:
+            await self.connect()
+        self.writer.write(
+            f'GET {self.prefix}{path} HTTP/1.1\r\n'
+            f'Host: {self.netloc}\r\n'
+            'User-Agent: flask-deploy-benchmark\r\n'
+            '\r\n'.encode('latin-1')
+        )
+        await self.writer.drain()
+        status, keep = await read_response(self.reader)
+        if not keep:
+            await self.close()
+        return status
+
+
+async def load(url, concurrency, duration, routes, warmup=0.0):
+    """
+    Run concurrency clients for warmup + duration seconds, recording the
+    requests completed after the warmup
+    """
+    latencies = {route: [] for route in routes}
+    statuses = {}
+    errors = 0
+    start = time.perf_counter()
+    record_from = start + warmup
+    deadline = record_from + duration
+
+    async def worker(offset):
+        nonlocal errors
+        client = Client(url)
+        i = offset
+        try:
+            while time.perf_counter() < deadline:
+                route = routes[i % len(routes)]
+                i += 1
+                sent = time.perf_counter()
+                try:
+                    status = await client.get(route)
+                except (OSError, asyncio.IncompleteReadError, ValueError):
+                    await client.close()
+                    if sent >= record_from:
+                        errors += 1
+                    await asyncio.sleep(0.01)
+                    continue
+                if sent >= record_from:
+                    latencies[route].append(time.perf_counter() - sent)
+                    statuses[status] = statuses.get(status, 0) + 1
+        finally:
+            await client.close()
+
+    await asyncio.gather(*(worker(n) for n in range(concurrency)))
+    elapsed = time.perf_counter() - record_from
+    return latencies, statuses, errors, elapsed
+
+
+def run(url, concurrency=10, duration=10, routes=('/',), warmup=1.0):
+    """
+    Load test url and return the results as a JSON-able dict
+    """
+    routes = list(routes)
+    latencies, statuses, errors, elapsed = asyncio.run(
+        load(url, concurrency, duration, routes, warmup=warmup)
+    )
+    everything = [value for values in latencies.values() for value in values]
+    overall = summary(everything)
+    return {
+        'url': url,
+        'concurrency': concurrency,
+        'duration': duration,
+        'warmup': warmup,
+        'routes': routes,
+        'python': platform.python_version(),
+        'elapsed': round(elapsed, 3),
+        'rps': round(len(everything) / elapsed, 1) if elapsed > 0 else 0.0,
+        'errors': errors,
+        'statuses': {str(k): v for k, v in sorted(statuses.items())},
+        'latency_ms': overall,
+        'routes_latency_ms': {
+            route: summary(values) for route, values in latencies.items()
+        },
+    }
+
+
+def wait_for_port(host, port, timeout=15, proc=None):
+    """
+    Wait until something accepts connections on host:port
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f'Server exited with {proc.returncode}')
+        with contextlib.suppress(OSError):
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        time.sleep(0.1)
+    raise TimeoutError(f'Nothing listening on {host}:{port}')
+
+
+@contextlib.contextmanager
+def local_server(command, port, host='127.0.0.1', timeout=15, cwd=None):
+    """
+    Start command in the background and wait until it serves on port
+    """
+    proc = subprocess.Popen(
+        command, cwd=cwd,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(host, port, timeout=timeout, proc=proc)
+        yield proc
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+SERVERS = {
+    'sync': ('gunicorn', 'sync'),
+    'gthread': ('gunicorn', 'gthread'),
+    'gevent': ('gunicorn', 'gevent'),
+    'uvicorn': ('uvicorn', None),
+}
+REQUIRES = {
+    'sync': ('gunicorn',),
+    'gthread': ('gunicorn',),
+    'gevent': ('gunicorn', 'gevent'),
+    'uvicorn': ('uvicorn',),
+}
+
+
+def available(server):
+    """
+    Whether the packages needed to run server are installed
+    """
+    return all(importlib.util.find_spec(name) for name in REQUIRES[server])
+
+
+def server_command(
+    server, module, app, port, workers=1, keepalive=2, threads=4,
+    interface='wsgi',
+):
+    """
+    Command line starting module:app on 127.0.0.1:port with the options
+    generate_site_supervisor would write
+    """
+    program, worker_class = SERVERS[server]
+    if program == 'gunicorn':
+        options = template.gunicorn_options(
+            worker_class=worker_class, workers=workers,
+            threads=threads if worker_class == 'gthread' else 1,
+            keepalive=keepalive,
+        )
+        return [
+            sys.executable, '-m', 'gunicorn', f'{module}:{app}',
+            '-b', f'127.0.0.1:{port}', *shlex.split(options),
+        ]
+    options = template.uvicorn_options(workers=workers, keepalive=keepalive)
+    return [
+        sys.executable, '-m', 'uvicorn', f'{module}:{app}',
+        '--host', '127.0.0.1', '--port', str(port),
+        '--interface', interface, '--log-level', 'warning',
+        *shlex.split(options),
+    ]
+
+
+def matrix(servers, workers, keepalives):
+    """
+    Server configurations to compare
+
+    Sync workers close the connection after each response, so they are
+    run once per worker count whatever the keepalive.
+    """
+    configs = []
+    for server, count, keepalive in itertools.product(
+        servers, workers, keepalives
+    ):
+        if server not in SERVERS:
+            raise ValueError(f'Unknown server {server}')
+        if server == 'sync' and keepalive != keepalives[0]:
+            continue
+        configs.append(
+            {'server': server, 'workers': count, 'keepalive': keepalive}
+        )
+    return configs
+
+
+def ranked(results):
+    """
+    Results sorted by requests per second, failed runs last
+    """
+    return sorted(
+        results,
+        key=lambda r: (r.get('error') is None, r.get('rps', 0)),
+        reverse=True,
+    )
+
+
+def table(results):
+    """
+    Ranked comparison of matrix results as text
+    """
+    rows = [('#', 'server', 'workers', 'keepalive', 'rps', 'p50', 'p95',
+             'p99', 'errors')]
+    notes = ['']
+    for rank, result in enumerate(ranked(results), 1):
+        row = [rank, result['server'], result['workers'], result['keepalive']]
+        if result.get('error'):
+            row += ['failed', '-', '-', '-', '-']
+            notes.append(result['error'])
+        else:
+            latency = result['latency_ms']
+            row += [result['rps'], latency['p50'], latency['p95'],
+                    latency['p99'], result['errors']]
+            notes.append('')
+        rows.append(tuple('-' if value is None else str(value)
+                          for value in row))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = []
+    for row, note in zip(rows, notes):
+        cells = [
+            value.ljust(width) if i == 1 else value.rjust(width)
+            for i, (value, width) in enumerate(zip(row, widths))
+        ]
+        lines.append('  '.join(cells + [note]).rstrip())
+    return '\n'.join(lines)
@@ -2,17 +2,30 @@
 #   imports   #
 ###############
 
+import hashlib
+import io
+import json
 import os
 import re
 import pathlib
+import shlex
+import sys
+import tarfile
 import textwrap
+import time
 
 
-from invoke import task, run as local
+from fabric import Connection
+from invoke import task, run as local, Task
 from patchwork.files import exists
 
 from file_and_stream import logger
 
+import remote_state
+import ssh_mux
+from batch import Batch
+from parallel import TaskGraph, report, fan_out
+
 ##############
 #   config   #
 ##############
@@ -21,12 +34,20 @@ from file_and_stream import logger
 DEPLOY_ROOT = "/home/www"
 DEPLOY_USER = os.environ.get('DEPLOY_USER', 'user')
 DEPLOY_HOST = os.environ.get('DEPLOY_HOST', 'deployhost')
+DEPLOY_HOSTS = os.environ.get('DEPLOY_HOSTS', DEPLOY_HOST)
 DEPLOY_SERVER = os.environ.get('DEPLOY_SERVER', 'gunicorn')
 DEPLOY_NGINX_DIR = "/etc/nginx/sites-available"
 DEPLOY_SUPERVISOR_DIR = "/etc/supervisor/conf.d"
+NGINX_CACHE_DIR = "/var/cache/nginx"
 FLASK_MODULE = os.environ.get('FLASKMODULE', 'flask_project')
 APP = os.environ.get('APP', 'app')
 PORT = os.environ.get('PORT', 9000)
+WHEELHOUSE_SIZE = int(os.environ.get('WHEELHOUSE_SIZE', 200))
+RELEASES_KEEP = int(os.environ.get('RELEASES_KEEP', 5))
+WARMUP_PATHS = os.environ.get('WARMUP_PATHS', '')
+WARMUP_ROUNDS = int(os.environ.get('WARMUP_ROUNDS', 4))
+NGINX_USER = os.environ.get('NGINX_USER', 'www-data')
+SSH_CONTROL_PERSIST = os.environ.get('SSH_CONTROL_PERSIST', ssh_mux.PERSIST)
 
 
 def remote_site_dir(site):
@@ -41,6 +62,64 @@ def remote_flask_work_tree(site):
     return f"{DEPLOY_ROOT}/sites/{site}/src"
 
 
+def remote_releases_dir(site):
+    return f"{DEPLOY_ROOT}/sites/{site}/releases"
+
+
+def remote_wheelhouse():
+    return f"{DEPLOY_ROOT}/wheelhouse"
+
+
+def remote_port_registry():
+    return f"{DEPLOY_ROOT}/ports.json"
+
+
+def remote_run_dir(site):
+    return f"{DEPLOY_ROOT}/sites/{site}/run"
+
+
+def remote_socket(site):
+    return f"{DEPLOY_ROOT}/sites/{site}/run/app.sock"
+
+
+def site_paths(site):
+    """
+    Remote paths whose existence the tasks check for site
+    """
+    return [
+        DEPLOY_ROOT,
+        remote_site_dir(site),
+        remote_git_dir(site),
+        remote_flask_work_tree(site),
+        "/etc/nginx/sites-enabled/default",
+        f"/etc/nginx/sites-enabled/{site}",
+        f"/etc/supervisor/conf.d/{site}.conf",
+    ]
+
+
+def remote_exists(c, path):
+    """
+    Existence of path from the probed state, checked remotely if not probed
+    """
+    state = remote_state.cached(c)
+    known = state.exists(path) if state else None
+    if known is None:
+        return exists(c, path)
+    return known
+
+
+def app_running(c, site):
+    """
+    Whether supervisor runs site, from the probed state if available
+    """
+    state = remote_state.cached(c)
+    running = state.running(site) if state else None
+    if running is None:
+        status = c.sudo("supervisorctl status", hide=True)
+        running = bool(re.search(fr'\n{site}\s+RUNNING', status.stdout))
+    return running
+
+
 #############
 #   tasks   #
 #############
@@ -89,27 +168,97 @@ def create(
     c, site,
     module=FLASK_MODULE,
     app=APP,
-    port=PORT,
-    deploy_user=DEPLOY_USER
+    port=0,
+    deploy_user=DEPLOY_USER,
+    parallel=4,
+    metrics=False,
+    uvicorn=False,
+    socket=False,
 ):
     """
     Install a deployment from scratch
+
+    Without port the next free one is taken from the port registry of the
+    host, a given port is claimed there.
     """
     logger.info('Create from scratch')
+    start = time.perf_counter()
+    # the steps share c, connect once before they run concurrently
+    c.open()
+    c.sftp()
+    if not socket:
+        port = allocate_port(c, site, port=port)
+    # static files are in <package>/static of the package of the app module
+    package = module.split('.')[0]
+    graph = TaskGraph()
     # install_requirements(c)
-    configure_git(c, site, branch='main')
-    install_flask_work_tree(c, site, package=app)
-    install_venv(c, site, version=3)
-    add_remote(c, site, deploy_user=DEPLOY_USER, deploy_host=DEPLOY_HOST)
-    push_remote(c, site, branch='main', force=False)
-    generate_site_nginx(c, site, port=port)
-    configure_nginx(c, site)
-    generate_site_supervisor(c, site, module=module, app=app, port=port)
-    configure_supervisor(c, site)
+    graph.add('probe', probe, c, site)
+    graph.add(
+        'configure_git', configure_git, c, site, branch='main',
+        package=package,
+        requires=['probe'],
+    )
+    graph.add(
+        'install_flask_work_tree', install_flask_work_tree, c, site,
+        package=package,
+        requires=['probe'],
+    )
+    graph.add(
+        'install_venv', install_venv, c, site, version=3,
+        # the hook builds the same venv on the push, then it is reused
+        requires=['push_remote'],
+    )
+    graph.add(
+        'add_remote', add_remote, c, site,
+        deploy_user=DEPLOY_USER, deploy_host=DEPLOY_HOST,
+        requires=['configure_git'],
+    )
+    graph.add(
+        'push_remote', push_remote, c, site, branch='main', force=False,
+        package=package,
+        requires=['add_remote', 'install_flask_work_tree'],
+    )
+    if socket:
+        graph.add(
+            'install_run_dir', install_run_dir, c, site,
+            deploy_user=deploy_user,
+            requires=['install_flask_work_tree'],
+        )
+    # the generated files are untracked, configure_git wants a clean tree
+    graph.add(
+        'generate_site_nginx', generate_site_nginx, c, site, port=port,
+        metrics=metrics, socket=socket,
+        requires=['configure_git'],
+    )
+    graph.add(
+        'configure_nginx', configure_nginx, c, site,
+        requires=['generate_site_nginx', 'probe'],
+    )
+    graph.add(
+        'generate_site_supervisor', generate_site_supervisor, c, site,
+        module=module, app=app, port=port, metrics=metrics, uvicorn=uvicorn,
+        socket=socket,
+        requires=['configure_git'],
+    )
+    graph.add(
+        'configure_supervisor', configure_supervisor, c, site,
+        requires=[
+            'generate_site_supervisor', 'install_venv', 'push_remote',
+            *(['install_run_dir'] if socket else []),
+        ],
+    )
     # start webserver
-    start_app(c, site)
+    graph.add(
+        'start_app', start_app, c, site,
+        requires=['configure_supervisor'],
+    )
     # install certificate from Let's Encrypt
-    install_cert(c, site)
+    graph.add(
+        'install_cert', install_cert, c, site,
+        requires=['configure_nginx'],
+    )
+    timings = graph.run(max_workers=parallel)
+    print(report(timings, total=time.perf_counter() - start))
 
 
 @task
@@ -122,14 +271,31 @@ def install_requirements(c):
     Supervisor
     Git
     """
-    c.sudo("apt-get update")
-    c.sudo("apt-get install -y python3")
-    c.sudo("apt-get install -y python3-pip")
-    c.sudo("apt-get install -y python3-venv")
-    c.sudo("apt-get install -y nginx")
-    c.sudo("apt-get install -y supervisor")
-    c.sudo("apt-get install -y git")
-    c.sudo("apt-get install python-certbot-nginx")
+    with Batch(c, sudo=True) as batch:
+        batch.run("apt-get update")
+        batch.run("apt-get install -y python3")
+        batch.run("apt-get install -y python3-pip")
+        batch.run("apt-get install -y python3-venv")
+        batch.run("apt-get install -y nginx")
+        batch.run("apt-get install -y supervisor")
+        batch.run("apt-get install -y git")
+        batch.run("apt-get install python-certbot-nginx")
+
+
+@task
+def probe(c, site):
+    """
+    Collect the remote state of site in one round trip
+    """
+    script = remote_state.probe_script(site_paths(site))
+    result = c.sudo(f"sh -c {shlex.quote(script)}", hide=True)
+    state = remote_state.store(c, remote_state.parse(result.stdout))
+    for path, found in state.paths.items():
+        logger.info(f"{path}: {'exists' if found else 'missing'}")
+    logger.info(f"{site}: {state.supervisor.get(site, 'not configured')}")
+    logger.info(f"nginx sites: {' '.join(sorted(state.nginx))}")
+    logger.info(f"ports: {' '.join(map(str, sorted(state.ports)))}")
+    return state
 
 
 @task
@@ -137,6 +303,20 @@ def install_site_dir(c, site):
     c.run(f"mkdir -p {remote_site_dir(site)}")
 
 
+@task
+def install_run_dir(c, site, deploy_user=DEPLOY_USER):
+    """
+    Directory for the app socket, reachable by nginx
+
+    Owned by the deploy user with the nginx group, setgid so that the
+    socket gets the nginx group as well, closed to everybody else.
+    """
+    c.sudo(
+        f"install -d -m 2750 -o {deploy_user} -g {NGINX_USER}"
+        f" {remote_run_dir(site)}"
+    )
+
+
 @task
 def install_venv(c, site, version="3"):
     """
@@ -148,19 +328,85 @@ def install_venv(c, site, version="3"):
     venv_dir = f'{site_dir}/venv{version}'
     git_dir = f'{site_dir}/git'
     work_dir = f'{site_dir}/src'
-    py = f'{venv_dir}/bin/python'
-    pip = f'{py} -m pip'
-    c.run(textwrap.dedent(
+    c.run(
+        venv_script(site, version, f"{site_dir}/requirements.txt")
+        + textwrap.dedent(
+            f"""\
+            echo source {venv_dir}/bin/activate > {site_dir}/.envrc
+            echo export GIT_DIR={git_dir} >> {site_dir}/.envrc
+            echo export GIT_WORK_TREE={work_dir} >> {site_dir}/.envrc
+            echo unset PS1 >> {site_dir}/.envrc
+            """
+        )
+    )
+
+
+def venv_script(site, version, requirements):
+    """
+    Shell script building the venv for requirements and switching to it
+
+    Venvs live in venvs/<hash> of requirements and Python version, an
+    existing one is reused and venv<version> is a symlink to the one in
+    use. Wheels are built once per host into the wheelhouse, touched when
+    used and the least recently used beyond WHEELHOUSE_SIZE are removed.
+    A new venv is byte-compiled in parallel before it is marked complete.
+
+    A venv is built holding venvs/<hash>.lock, so that the post-receive
+    hook and install_venv never build the same one at the same time.
+    The wheelhouse is shared by the sites of the host, building, installing
+    from and pruning it hold its lock. The wheels of a venv are listed in
+    its .wheels and touched whenever the venv is used, built or reused.
+    """
+    site_dir = remote_site_dir(site)
+    venv_link = f'{site_dir}/venv{version}'
+    wheelhouse = remote_wheelhouse()
+    pip = '$venv/bin/python -m pip'
+    offline = f'--no-index --find-links {wheelhouse}'
+    online = f'--find-links {wheelhouse}'
+    return textwrap.dedent(
         f"""\
-        python{version} -m venv {venv_dir}
-        {pip} install --upgrade pip setuptools
-        {pip} install -r {remote_site_dir(site)}/requirements.txt
-        echo source {venv_dir}/bin/activate > {site_dir}/.envrc
-        echo export GIT_DIR={git_dir} >> {site_dir}/.envrc
-        echo export GIT_WORK_TREE={work_dir} >> {site_dir}/.envrc
-        echo unset PS1 >> {site_dir}/.envrc
+        hash=$( (cat {requirements}; python{version} -VV) | sha256sum | cut -c1-16)
+        venv={site_dir}/venvs/$hash
+        mkdir -p {wheelhouse}
+        if [ -f $venv/.complete ]; then
+            echo "$venv is up to date"
+        else (
+            set -e
+            mkdir -p {site_dir}/venvs
+            exec 8>$venv.lock
+            flock 8
+            if [ -f $venv/.complete ]; then
+                echo "$venv was built meanwhile"
+                exit 0
+            fi
+            python{version} -m venv --clear $venv
+            (
+                flock 9
+                {pip} wheel -q {offline} -w {wheelhouse} pip setuptools wheel -r {requirements} 2>/dev/null \\
+                    || {pip} wheel -q {online} -w {wheelhouse} pip setuptools wheel -r {requirements}
+                {pip} install -q {offline} --upgrade pip setuptools wheel
+                {pip} install -q {offline} -r {requirements}
+            ) 9>{wheelhouse}/.lock
+            {pip} list --format=freeze | while IFS='=' read -r name _ version; do
+                find {wheelhouse} -maxdepth 1 -iname "$(echo "$name" | tr -- '-.' '__')-$version-*.whl"
+            done > $venv/.wheels
+            $venv/bin/python -m compileall -qq -j 0 $venv || :
+            touch $venv/.complete
+        ) fi
+        [ -f $venv/.complete ] || exit 1
+        (
+            flock 9
+            if [ -f $venv/.wheels ]; then
+                xargs -r touch -c < $venv/.wheels
+            fi
+            ls -1t {wheelhouse}/*.whl | tail -n +{WHEELHOUSE_SIZE + 1} | xargs -r rm -f
+        ) 9>{wheelhouse}/.lock
+        if [ -d {venv_link} ] && [ ! -L {venv_link} ]; then
+            mv {venv_link} {site_dir}/venvs/legacy
+        fi
+        ln -sfn $venv {venv_link}.new && mv -T {venv_link}.new {venv_link}
         """
-    ))
+    )
 
 
 #######
@@ -169,7 +415,7 @@ def install_venv(c, site, version="3"):
 
 
 @task
-def configure_git(c, site, branch='main'):
+def configure_git(c, site, branch='main', package="app"):
     """
     1. Setup bare Git repo
     2. Create post-receive hook
@@ -201,18 +447,43 @@ def configure_git(c, site, branch='main'):
     assert_clean_workdir()
 
     remote = remote_git_dir(site)
-    if exists(c, remote):
+    if remote_exists(c, remote):
         logger.info(f"{remote} already exists")
     else:
         logger.info("Creating: " + remote)
+        remote_state.forget(c, remote, remote_site_dir(site))
         c.run(f"git init --bare {remote}")
-        c.run(
-            'echo "#!/bin/sh\n'
-            f"GIT_WORK_TREE={remote_flask_work_tree(site)}"
-            f' git checkout {branch} --recurse-submodules -f"'
-            f' > {remote}/hooks/post-receive'
-        )
-        c.run(f"chmod +x {remote_git_dir(site)}/hooks/post-receive")
+        install_hook(c, site, branch=branch, package=package)
+
+
+@task
+def install_hook(
+    c, site, branch='main', version="3", keep=RELEASES_KEEP, package="app"
+):
+    """
+    Install post-receive hook checking out pushes as releases
+    """
+    from template import POST_RECEIVE
+    import static_pipeline
+    logger.info('Install post-receive hook')
+
+    c.put(
+        static_pipeline.__file__, f"{remote_site_dir(site)}/static_pipeline.py"
+    )
+    hook = f"{remote_git_dir(site)}/hooks/post-receive"
+    script = POST_RECEIVE.format(
+        site_dir=remote_site_dir(site),
+        branch=branch,
+        version=version,
+        keep=keep,
+        static=f"{package}/static",
+        venv_script=textwrap.indent(
+            venv_script(site, version, '$RELEASE/requirements.txt'), '    '
+        ),
+    )
+    c.put(io.StringIO(script), hook)
+    c.run(f"chmod +x {hook}")
+
 
 def assert_clean_workdir():
     git_status = local('git status', hide=True)
@@ -239,10 +510,13 @@ def install_flask_work_tree(c, site, package="app"):
     """
     logger.info('Install Flask work tree')
 
-    if exists(c, remote_flask_work_tree(site)):
+    if remote_exists(c, remote_flask_work_tree(site)):
         logger.info(f"{remote_flask_work_tree(site)} exists")
     else:
-        c.run(f"mkdir -p {remote_flask_work_tree(site)}")
+        remote_state.forget(
+            c, remote_flask_work_tree(site), remote_site_dir(site)
+        )
+        c.run(f"mkdir -p {remote_releases_dir(site)}")
         c.run(
             "ln -sf"
             f"  {remote_flask_work_tree(site)}/{package}/static"
@@ -255,9 +529,10 @@ def install_root(c):
     """
     Install root install directory
     """
-    if exists(c, DEPLOY_ROOT):
+    if remote_exists(c, DEPLOY_ROOT):
         logger.info(DEPLOY_ROOT)
     else:
+        remote_state.forget(c, DEPLOY_ROOT)
         c.sudo(f"mkdir -p {DEPLOY_ROOT}")
         c.sudo(f"chown {DEPLOY_USER}:{DEPLOY_USER} {DEPLOY_ROOT}")
 
@@ -276,7 +551,8 @@ def configure_nginx(c, site):
     2. Create new config file
     3. Setup new symbolic link
     4. Copy local config to remote config
-    5. Restart nginx
+    5. Create the cache directory, nginx only creates the last level
+    6. Check the config and reload nginx, keeping open connections
     """
     logger.info('Configure nginx')
     c.sudo("/etc/init.d/nginx start")
@@ -286,17 +562,24 @@ def configure_nginx(c, site):
     enabled = f"/etc/nginx/sites-enabled/{site}"
     available = f"/etc/nginx/sites-available/{site}"
 
-    if exists(c, enabled) is False:
-        c.sudo(f"touch {available}")
-        c.sudo(f"ln -s {available} {enabled}")
+    with Batch(c, sudo=True) as batch:
+        if remote_exists(c, enabled) is False:
+            remote_state.forget(c, enabled, section='nginx')
+            batch.run(f"touch {available}")
+            batch.run(f"ln -s {available} {enabled}")
 
-    scp(c, f"./sites/{site}{available}", available)
-    c.sudo("/etc/init.d/nginx restart")
+        stage(c, batch, f"./sites/{site}{available}", available)
+        batch.run(f"install -d -o {NGINX_USER} {NGINX_CACHE_DIR}")
+        batch.run("nginx -t")
+        batch.run("nginx -s reload")
 
 
 @task
 def disable_nginx_default(c):
-    if exists(c, "/etc/nginx/sites-enabled/default"):
+    if remote_exists(c, "/etc/nginx/sites-enabled/default"):
+        remote_state.forget(
+            c, "/etc/nginx/sites-enabled/default", section='nginx'
+        )
         c.sudo("rm /etc/nginx/sites-enabled/default")
 
 
@@ -309,15 +592,157 @@ def restart_nginx(c):
 def enable_link(c, site):
     enabled = f"/etc/nginx/sites-enabled/{site}"
     available = f"/etc/nginx/sites-available/{site}"
-    c.sudo(f"touch {available}")
-    c.sudo(f"ln -s {available} {enabled}")
+    with Batch(c, sudo=True) as batch:
+        batch.run(f"touch {available}")
+        batch.run(f"ln -s {available} {enabled}")
 
 
 @task
 def scp(c, source, target):
+    with Batch(c, sudo=True) as batch:
+        stage(c, batch, source, target)
+
+
+def stage(c, batch, source, target):
+    """
+    Upload source and queue moving it into place on batch
+    """
     file_ = pathlib.Path(target).name
     c.put(source, f"/tmp/{file_}")
-    c.sudo(f"mv /tmp/{file_} {target}")
+    batch.run(f"mv /tmp/{file_} {target}")
+
+
+def config_files(site):
+    """
+    Generated config files of site, local path -> remote path
+    """
+    remote = [
+        f"/etc/nginx/sites-available/{site}",
+        f"/etc/supervisor/conf.d/{site}.conf",
+    ]
+    return {
+        f"./sites/{site}{path}": path for path in remote
+        if os.path.isfile(f"./sites/{site}{path}")
+    }
+
+
+def file_sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def remote_checksums(c, paths):
+    """
+    sha256 of remote paths, None for missing ones, in one round trip
+    """
+    result = c.run(
+        f"for f in {' '.join(shlex.quote(p) for p in paths)}; do"
+        ' if [ -e "$f" ]; then sha256sum "$f"; else echo "- $f"; fi;'
+        " done",
+        hide=True,
+    )
+    checksums = {}
+    for line in result.stdout.splitlines():
+        checksum, _, path = line.partition(" ")
+        checksums[path.strip()] = None if checksum == "-" else checksum
+    return checksums
+
+
+def config_archive(files):
+    """
+    tar archive of local files stored under their remote paths, root owned
+    """
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        for source, target in files.items():
+            info = tar.gettarinfo(source, arcname=target.lstrip("/"))
+            info.uid = info.gid = 0
+            info.uname = info.gname = "root"
+            info.mode = 0o644
+            with open(source, "rb") as f:
+                tar.addfile(info, f)
+    archive.seek(0)
+    return archive
+
+
+@task
+def sync_configs(c, sites=""):
+    """
+    Upload changed nginx and supervisor files, reload only what changed
+
+    sites is a comma separated list, all sites under ./sites by default.
+    Local and remote checksums are compared in one round trip and the
+    files that differ are uploaded as one archive. nginx is then checked
+    with nginx -t and reloaded, supervisor rereads and restarts only the
+    programs whose config changed. Open connections are kept. If nginx -t
+    fails, the files replaced are restored and the new ones removed.
+    """
+    names = [s for s in sites.split(",") if s] or sorted(os.listdir("sites"))
+    files = {}
+    links = {}
+    for site in names:
+        files.update(config_files(site))
+        if f"/etc/nginx/sites-available/{site}" in files.values():
+            links[f"/etc/nginx/sites-enabled/{site}"] = \
+                f"/etc/nginx/sites-available/{site}"
+
+    remote = remote_checksums(c, [*files.values(), *links])
+    changed = {
+        source: target for source, target in files.items()
+        if remote.get(target) != file_sha256(source)
+    }
+    unlinked = {
+        link: target for link, target in links.items()
+        if remote.get(link) is None
+    }
+    if not changed and not unlinked:
+        logger.info(f"{len(files)} config files up to date")
+        return changed
+
+    for target in changed.values():
+        logger.info(f"Update {target}")
+    nginx = unlinked or any(
+        target.startswith("/etc/nginx/") for target in changed.values()
+    )
+    supervisor = any(
+        target.startswith("/etc/supervisor/") for target in changed.values()
+    )
+    remote_state.forget(c, *changed.values(), *unlinked)
+    if nginx:
+        remote_state.forget(c, section="nginx")
+    if supervisor:
+        remote_state.forget(c, section="supervisor")
+    archive = "/tmp/sync-configs.tar"
+    backup = "/tmp/sync-configs.backup.tar"
+    replaced = [t for t in changed.values() if remote.get(t) is not None]
+    added = [t for t in changed.values() if remote.get(t) is None]
+    if changed:
+        c.put(config_archive(changed), archive)
+    with Batch(c, sudo=True) as batch:
+        if nginx and replaced:
+            members = " ".join(target.lstrip("/") for target in replaced)
+            batch.run(f"tar -cf {backup} -C / {members}")
+        if changed:
+            batch.run(f"tar -xf {archive} -C / --no-same-owner")
+            batch.run(f"rm -f {archive}")
+        for link, target in unlinked.items():
+            batch.run(f"ln -sfn {target} {link}")
+        if nginx:
+            # a config nginx rejects is taken out again, with the rest
+            restore = []
+            if replaced:
+                restore.append(f"tar -xf {backup} -C /")
+            if added or unlinked:
+                restore.append(f"rm -f {' '.join([*added, *unlinked])}")
+            batch.run(f"install -d -o {NGINX_USER} {NGINX_CACHE_DIR}")
+            batch.run(f"nginx -t || {{ {'; '.join(restore)}; false; }}")
+            batch.run("nginx -s reload")
+        if supervisor:
+            batch.run("supervisorctl reread")
+            batch.run("supervisorctl update")
+        if nginx and replaced:
+            batch.run(f"rm -f {backup}")
+    return changed
 
 
 ##############
@@ -336,22 +761,27 @@ def configure_supervisor(c, site):
     """
     logger.info('Configure supervisor')
 
-    if exists(c, f"/etc/supervisor/conf.d/{site}.conf") is False:
-        c.put(
-            f"./sites/{site}/etc/supervisor/conf.d/{site}.conf",
-            f"/tmp/{site}.conf"
+    if remote_exists(c, f"/etc/supervisor/conf.d/{site}.conf") is False:
+        remote_state.forget(
+            c, f"/etc/supervisor/conf.d/{site}.conf", section='supervisor'
         )
-        c.sudo(f"mv /tmp/{site}.conf /etc/supervisor/conf.d/{site}.conf")
-        c.sudo("supervisorctl reread")
-        c.sudo("supervisorctl update")
+        with Batch(c, sudo=True) as batch:
+            stage(
+                c, batch,
+                f"./sites/{site}/etc/supervisor/conf.d/{site}.conf",
+                f"/etc/supervisor/conf.d/{site}.conf",
+            )
+            batch.run("supervisorctl reread")
+            batch.run("supervisorctl update")
     else:
         logger.info(f"/etc/supervisor/conf.d/{site}.conf already exists")
 
 
 @task
 def reload_supervisor(c):
-    c.sudo("supervisorctl reread")
-    c.sudo("supervisorctl update")
+    with Batch(c, sudo=True) as batch:
+        batch.run("supervisorctl reread")
+        batch.run("supervisorctl update")
 
 
 @task
@@ -360,10 +790,10 @@ def start_app(c, site):
     Run the app!
     """
     logger.info('Start app')
-    status = c.sudo("supervisorctl status", hide=True)
-    if re.search(fr'\n{site}\s+RUNNING', status.stdout):
+    if app_running(c, site):
         logger.info(f'{site} is already running')
         return
+    remote_state.forget(c, section='supervisor')
     c.sudo(f"supervisorctl status {site}")
 
 
@@ -372,23 +802,110 @@ def stop_app(c, site):
     """
     Stop the app!
     """
-    status = c.sudo("supervisorctl status", hide=True)
-    if re.search(fr'\n{site}\s+RUNNING', status.stdout):
+    if app_running(c, site):
+        remote_state.forget(c, section='supervisor')
         c.sudo(f"supervisorctl stop {site}")
     logger.info(f"{site} is not running")
 
 
 @task
-def restart_app(c, site):
+def restart_app(c, site, graceful=False, port=0, socket=False):
     """
-    Restart app (with stop/start)
+    Restart app (with stop/start, or a graceful reload)
     """
     logger.info(f'Restarting {site}')
+    if graceful:
+        reload_app(c, site, port=port, socket=socket)
+        return
     stop_app(c, site)
     reload_supervisor(c)
     start_app(c, site)
 
 
+@task
+def reload_app(
+    c, site, signal="HUP", port=0, path="/", timeout=30,
+    warmup=WARMUP_PATHS, rounds=WARMUP_ROUNDS, socket=False,
+):
+    """
+    Reload app workers gracefully, wait until it answers and warm it up
+
+    Without port the app is checked on the port of site in the host's port
+    registry. The old workers may still answer right after the signal, so
+    the app counts as healthy only once they have exited.
+    """
+    logger.info(f'Reloading {site} ({signal})')
+    old_workers = signal_app(c, site, signal)
+    if socket:
+        base_url = "http://localhost"
+    else:
+        base_url = f"http://localhost:{port or site_port(c, site)}"
+    unix_socket = remote_socket(site) if socket else ""
+    wait_healthy(
+        c, f"{base_url}{path}", timeout=timeout, unix_socket=unix_socket,
+        old_workers=old_workers,
+    )
+    if warmup:
+        warm_up(c, base_url, warmup, rounds=rounds, unix_socket=unix_socket)
+
+
+def curl_command(unix_socket=""):
+    command = "curl -fsS -o /dev/null"
+    if unix_socket:
+        command += f" --unix-socket {unix_socket}"
+    return command
+
+
+def signal_app(c, site, signal="HUP"):
+    """
+    Send signal to the supervisor program of site, return the PIDs its
+    worker processes had before
+    """
+    result = c.sudo("sh -c " + shlex.quote(
+        f'pgrep -P "$(supervisorctl pid {site})" || :;'
+        f' supervisorctl signal {signal} {site} >&2'
+    ))
+    return [pid for pid in result.stdout.split() if pid.isdigit()]
+
+
+def wait_healthy(c, url, timeout=30, unix_socket="", old_workers=()):
+    """
+    Poll url on the deploy host until it answers with success, not before
+    the processes old_workers have exited
+    """
+    c.run(textwrap.dedent(
+        f"""\
+        for i in $(seq {timeout}); do
+            sleep 1
+            old=
+            for pid in {' '.join(old_workers)}; do
+                [ -d /proc/$pid ] && old="$old $pid"
+            done
+            [ -n "$old" ] && continue
+            {curl_command(unix_socket)} {url} && exit 0
+        done
+        echo "{url} not healthy after {timeout}s${{old:+, old workers$old running}}" >&2
+        exit 1
+        """
+    ))
+
+
+def warm_up(c, base_url, paths, rounds=WARMUP_ROUNDS, unix_socket=""):
+    """
+    Request each of the comma separated paths rounds times concurrently,
+    so that the new workers import and fill their caches before traffic
+    """
+    urls = [
+        f"{base_url}{path.strip()}" for path in paths.split(",")
+        if path.strip()
+    ]
+    logger.info(f'Warming up {", ".join(urls)}')
+    c.run(
+        f"printf '%s\\n' {' '.join(shlex.quote(url) for url in urls * rounds)}"
+        f" | xargs -n 1 -P {rounds} {curl_command(unix_socket)}"
+    )
+
+
 @task
 def restart_all(c, site):
     """
@@ -408,27 +925,97 @@ def status(c):
 
 
 @task
-def deploy(c, app, repo="production"):
+def deploy(
+    c, app, repo="production", graceful=True, port=0, warmup=WARMUP_PATHS,
+    socket=False,
+):
     """
     1. Copy new Flask files
-    2. Restart gunicorn via supervisor
+    2. Reload (or restart) gunicorn via supervisor
+    3. Warm up the new workers on the given paths
     """
     local("git add -A")
     commit_message = c.prompt("Commit message?")
     local('git commit -am "{0}"'.format(commit_message))
-    local("git push %s main" % repo)
-    c.sudo("supervisorctl restart %s" % app)
+    local("git push %s main" % repo, env=git_env())
+    if graceful:
+        reload_app(c, app, port=port, warmup=warmup, socket=socket)
+    else:
+        c.sudo("supervisorctl restart %s" % app)
 
 
 @task
-def rollback(c, site):
+def rollback(
+    c, site, graceful=True, port=0, warmup=WARMUP_PATHS, socket=False
+):
     """
     1. Quick rollback in case of error
-    2. Restart gunicorn via supervisor
+    2. Reload (or restart) gunicorn via supervisor
     """
     local("git revert main --no-edit")
-    local(f"git push {site} main")
-    c.sudo(f"supervisorctl restart {site}")
+    local(f"git push {site} main", env=git_env())
+    if graceful:
+        reload_app(c, site, port=port, warmup=warmup, socket=socket)
+    else:
+        c.sudo(f"supervisorctl restart {site}")
+
+@task
+def list_releases(c, site):
+    """
+    List releases of site, the current one marked with *
+    """
+    site_dir = remote_site_dir(site)
+    c.run(
+        f'current=$(readlink -f {site_dir}/src);'
+        f' for release in {remote_releases_dir(site)}/*; do'
+        ' [ "$release" = "$current" ] && echo "* $release" || echo "  $release";'
+        ' done'
+    )
+
+
+@task
+def switch_release(c, site, release="", version="3"):
+    """
+    Point src at release, by default the one before the current
+    """
+    site_dir = remote_site_dir(site)
+    releases = remote_releases_dir(site)
+    if release:
+        target = f"{releases}/{release}"
+    else:
+        target = (
+            f'$(ls -1d {releases}/* | grep -B1 -x "$current" | head -n 1)'
+        )
+    c.run(textwrap.dedent(
+        f"""\
+        set -e
+        current=$(readlink -f {site_dir}/src)
+        target={target}
+        if [ ! -d "$target" ] || [ "$target" = "$current" ]; then
+            echo "No release to switch to from $current" >&2
+            exit 1
+        fi
+        if [ -f $target/.venv-hash ]; then
+            ln -sfn {site_dir}/venvs/$(cat $target/.venv-hash) {site_dir}/venv{version}.new
+            mv -T {site_dir}/venv{version}.new {site_dir}/venv{version}
+        fi
+        ln -sfn $target {site_dir}/src.new
+        mv -T {site_dir}/src.new {site_dir}/src
+        echo "src -> $target"
+        """
+    ))
+
+
+@task
+def rollback_release(
+    c, site, release="", port=0, warmup=WARMUP_PATHS, socket=False
+):
+    """
+    Instant rollback to a previous release
+    """
+    switch_release(c, site, release=release)
+    reload_app(c, site, port=port, warmup=warmup, socket=socket)
+
 
 @task
 def clean(c, site):
@@ -442,10 +1029,14 @@ def clean_server(c, site):
     """
     logger.info('clean up all')
     stop_app(c, site)
-    c.sudo(f"rm -rf {remote_site_dir(site)}")
-    c.sudo(f"rm -f /etc/supervisor/conf.d/{site}.conf")
-    c.sudo(f"rm -f /etc/nginx/sites-available/{site}")
-    c.sudo(f"rm -f /etc/nginx/sites-enabled/{site}")
+    release_port(c, site)
+    remote_state.forget(c, *site_paths(site), section='supervisor')
+    remote_state.forget(c, section='nginx')
+    with Batch(c, sudo=True) as batch:
+        batch.run(f"rm -rf {remote_site_dir(site)}")
+        batch.run(f"rm -f /etc/supervisor/conf.d/{site}.conf")
+        batch.run(f"rm -f /etc/nginx/sites-available/{site}")
+        batch.run(f"rm -f /etc/nginx/sites-enabled/{site}")
 
 
 @task
@@ -464,11 +1055,26 @@ def install_cert(c, site):
 
 
 @task
-def generate_site_nginx(c, site, port=8000):
+def generate_site_nginx(
+    c, site, port=8000,
+    keepalive=32,
+    gzip=True,
+    brotli=False,
+    expires="30d",
+    sendfile=True,
+    open_file_cache=False,
+    micro_cache="",
+    cache_ttl="1s",
+    metrics=False,
+    assets=False,
+    socket=False,
+):
     """
     Generate configuration files for nginx
+
+    With socket nginx proxies to the app socket in the run dir of the site
+    instead of port.
     """
-    from template import NGINX
     logger.info('Generate nginx')
 
     # c.local(f'mkdir -p sites/{site}/etc/nginx/sites-available')
@@ -477,7 +1083,37 @@ def generate_site_nginx(c, site, port=8000):
     except FileExistsError:
         pass
     with open(f"sites/{site}/etc/nginx/sites-available/{site}", "w") as f:
-        f.write(NGINX.format(server_name=site, root=DEPLOY_ROOT, port=port))
+        f.write(
+            site_nginx_config(
+                site, port,
+                keepalive=keepalive,
+                gzip=gzip,
+                brotli=brotli,
+                expires=expires,
+                sendfile=sendfile,
+                open_file_cache=open_file_cache,
+                micro_cache=micro_cache,
+                cache_ttl=cache_ttl,
+                metrics=metrics,
+                assets=assets,
+                socket=socket,
+            )
+        )
+
+
+def site_nginx_config(site, port, micro_cache="", socket=False, **options):
+    """
+    nginx config of site, see generate_site_nginx
+    """
+    from template import nginx_config
+    if isinstance(micro_cache, str):
+        micro_cache = micro_cache.split(",")
+    return nginx_config(
+        site, DEPLOY_ROOT, port,
+        micro_cache=[p for p in micro_cache if p],
+        socket=remote_socket(site) if socket else "",
+        **options,
+    )
 
 
 @task
@@ -489,24 +1125,38 @@ def generate_site_supervisor(
     version="3",
     deploy_user=DEPLOY_USER,
     deploy_server=DEPLOY_SERVER,
+    worker_class="sync",
+    workers=0,
+    threads=0,
+    keepalive=0,
+    max_requests=0,
+    max_requests_jitter=0,
+    preload=False,
+    cpus=0,
+    timing=False,
+    profile_rate=0.0,
+    metrics=False,
+    uvicorn=False,
+    socket=False,
 ):
     """
     Generate configuration files for supervisor/gunicorn
-    """
-    try:
-        import flask
-        server = flask.__name__
-    except ImportError:
-        try:
-            import fastapi
-            server = fastapi.__name__
-        except ImportError:
-            logger('No framework installed')
-            raise
 
-    from template import SUPERVISOR
+    Worker settings left at 0 are sized for the deploy host: 2 x cores + 1
+    workers (one per core for gevent/uvicorn), 4 threads for gthread.
+    With uvicorn an ASGI module:app is served by uvicorn's own workers
+    instead, or use worker_class uvicorn.workers.UvicornWorker for gunicorn.
+    With timing the app records per-route latencies and profiles a
+    profile_rate fraction of requests into the profiles dir of the site.
+    With metrics the workers count requests into the metrics dir of the
+    site and serve the totals on /metrics.
+    With socket the app listens on a Unix socket in the run dir of the site
+    (see install-run-dir) instead of port, writable by the nginx group.
+    """
+    server = framework(uvicorn)
     logger.info('Generate supervisor')
-    bindir = f"{remote_site_dir(site)}/venv{version}/bin"
+    if not workers:
+        cpus = cpus or host_cpu_count(c)
 
     try:
         os.makedirs(f"sites/{site}/etc/supervisor/conf.d")
@@ -515,22 +1165,228 @@ def generate_site_supervisor(
 
     with open(f"sites/{site}/etc/supervisor/conf.d/{site}.conf", "w") as f:
         f.write(
-            SUPERVISOR[server].format(
-                program=site,
-                bin=bindir,
+            site_supervisor_config(
+                site, server,
                 module=module,
                 app=app,
                 port=port,
-                src=remote_flask_work_tree(site),
-                user=deploy_user,
-                server=deploy_server,
+                version=version,
+                deploy_user=deploy_user,
+                deploy_server=deploy_server,
+                worker_class=worker_class,
+                workers=workers,
+                threads=threads,
+                keepalive=keepalive,
+                max_requests=max_requests,
+                max_requests_jitter=max_requests_jitter,
+                preload=preload,
+                cpus=cpus,
+                timing=timing,
+                profile_rate=profile_rate,
+                metrics=metrics,
+                socket=socket,
             )
         )
 
 
+def framework(uvicorn=False):
+    """
+    Supervisor template for the installed web framework
+    """
+    if uvicorn:
+        return "fastapi"
+    try:
+        import flask
+        return flask.__name__
+    except ImportError:
+        try:
+            import fastapi
+            return fastapi.__name__
+        except ImportError:
+            logger('No framework installed')
+            raise
+
+
+def site_supervisor_config(
+    site, server,
+    module="flask_project",
+    app="app",
+    port=8000,
+    version="3",
+    deploy_user=DEPLOY_USER,
+    deploy_server=DEPLOY_SERVER,
+    worker_class="sync",
+    workers=0,
+    threads=0,
+    keepalive=0,
+    max_requests=0,
+    max_requests_jitter=0,
+    preload=False,
+    cpus=1,
+    timing=False,
+    profile_rate=0.0,
+    metrics=False,
+    socket=False,
+):
+    """
+    supervisor config of site, see generate_site_supervisor
+    """
+    from template import (
+        SUPERVISOR, auto_workers, gunicorn_options, uvicorn_options,
+        supervisor_environment,
+    )
+    bindir = f"{remote_site_dir(site)}/venv{version}/bin"
+
+    gunicorn = server == "flask" or worker_class.startswith("uvicorn.")
+    if not workers:
+        workers = auto_workers(worker_class if gunicorn else "uvicorn", cpus)
+    if gunicorn:
+        if not threads:
+            threads = 4 if worker_class == "gthread" else 1
+        options = gunicorn_options(
+            worker_class=worker_class,
+            workers=workers,
+            threads=threads,
+            keepalive=keepalive or 2,
+            max_requests=max_requests,
+            max_requests_jitter=max_requests_jitter,
+            preload=preload,
+            umask=0o007 if socket else None,
+        )
+        template = SUPERVISOR["flask"]
+        if socket:
+            bind = f"unix:{remote_socket(site)}"
+        else:
+            bind = f"localhost:{port}"
+    else:
+        # a single uvicorn process dies on the HUP of reload_app, its
+        # process manager (two workers or more) restarts them one by one
+        options = uvicorn_options(
+            workers=max(workers, 2),
+            keepalive=keepalive or 5,
+            max_requests=max_requests,
+        )
+        template = SUPERVISOR[server]
+        if socket:
+            bind = f"--uds {remote_socket(site)}"
+        else:
+            bind = f"--port {port}"
+
+    environment = {}
+    if timing:
+        environment["APP_TIMING"] = 1
+        if profile_rate:
+            environment["APP_PROFILE_RATE"] = profile_rate
+        environment["APP_PROFILE_DIR"] = f"{remote_site_dir(site)}/profiles"
+    if metrics:
+        environment["APP_METRICS_DIR"] = f"{remote_site_dir(site)}/metrics"
+
+    return template.format(
+        program=site,
+        bin=bindir,
+        module=module,
+        app=app,
+        bind=bind,
+        src=remote_flask_work_tree(site),
+        user=deploy_user,
+        server=deploy_server,
+        options=options,
+    ) + supervisor_environment(environment)
+
+
+@task
+def render_inventory(c, inventory="inventory.toml", sites=""):
+    """
+    Generate nginx and supervisor files for the sites of an inventory
+
+    All sites (or the comma separated sites) are rendered in this process
+    and only files whose content changed are written. Hosts of sites
+    without workers or cpus are asked for their core count once.
+    """
+    import inventory as inv
+    start = time.perf_counter()
+    only = set(sites.split(",")) - {""}
+    cpus = {}
+    written = total = 0
+    for entry in inv.sites(inv.load(inventory)):
+        site = entry['site']
+        if only and site not in only:
+            continue
+        common = {key: entry[key] for key in inv.COMMON if key in entry}
+        nginx = {**common, 'port': entry.get('port', 0), **entry['nginx']}
+        supervisor = {key: entry[key] for key in inv.SUPERVISOR if key in entry}
+        supervisor = {**common, **supervisor, **entry['supervisor']}
+        uvicorn = supervisor.pop('uvicorn', False)
+        if not supervisor.get('workers') and not supervisor.get('cpus'):
+            host = entry['host']
+            if host not in cpus:
+                cpus[host] = host_cpu_count(Connection(host) if host else c)
+            supervisor['cpus'] = cpus[host]
+        files = {
+            f"sites/{site}/etc/nginx/sites-available/{site}":
+                site_nginx_config(site, **nginx),
+            f"sites/{site}/etc/supervisor/conf.d/{site}.conf":
+                site_supervisor_config(site, framework(uvicorn), **supervisor),
+        }
+        for path, text in files.items():
+            total += 1
+            if inv.write_if_changed(path, text):
+                written += 1
+                logger.info(f'Wrote {path}')
+    elapsed = (time.perf_counter() - start) * 1000
+    logger.info(f'{written} of {total} files changed ({elapsed:.0f} ms)')
+
+
+def host_cpu_count(c):
+    """
+    Number of cores on the host of c, from the probed state if available
+    """
+    state = remote_state.cached(c)
+    if state is not None and state.cpus:
+        return state.cpus
+    result = c.run("nproc", hide=True, warn=True)
+    try:
+        return int(str(result.stdout).strip())
+    except ValueError:
+        return 1
+
+
 ####
 
 
+def git_env():
+    """
+    Environment for git commands talking to the deploy hosts: ssh shares a
+    master connection per host, unless SSH_CONTROL_PERSIST is empty
+    """
+    if not SSH_CONTROL_PERSIST:
+        return {}
+    return {"GIT_SSH_COMMAND": ssh_mux.ssh_command(SSH_CONTROL_PERSIST)}
+
+
+@task
+def ssh_master(
+    c, host=DEPLOY_HOST, user=DEPLOY_USER, port=0, stop=False,
+    persist=SSH_CONTROL_PERSIST,
+):
+    """
+    Start (or stop) a shared ssh connection to the deploy host
+    """
+    running = ssh_mux.running(host, user, port)
+    if stop:
+        if running:
+            ssh_mux.close_master(host, user, port)
+        else:
+            logger.info(f"No ssh master for {user}@{host}")
+        return
+    if running:
+        logger.info(f"ssh master for {user}@{host} is running")
+    else:
+        ssh_mux.open_master(host, user, port, persist=persist)
+        logger.info(f"Started ssh master for {user}@{host} ({persist})")
+    print(f"export FABRIC_GATEWAY={shlex.quote(ssh_mux.gateway(user))}")
+
+
 @task
 def add_remote(c, site, deploy_user=DEPLOY_USER, deploy_host=DEPLOY_HOST):
     """
@@ -569,16 +1425,41 @@ def rm_remote(c, site):
 
 
 @task
-def push_remote(c, site, branch='main', force=False):
+def push_remote(c, site, branch='main', force=False, package="app"):
     """
     Push to  remote repo
     """
     logger.info('Push to remote')
+    diff = local(
+        f"git diff --name-only {site}/{branch} {branch} --", hide=True,
+        warn=True,
+    )
+    if diff.ok:
+        paths = diff.stdout.splitlines()
+        categories = change_categories(paths, static=f"{package}/static")
+        logger.info(
+            f"{len(paths)} files changed: {' '.join(categories) or 'nothing'}"
+        )
     push_opts = ""
     if force:
         push_opts = "-f"
     # subprocess.run(f"git push {push_opts} {site} {branch}", shell=True)
-    local(f"git push {push_opts} {site} {branch}")
+    local(f"git push {push_opts} {site} {branch}", env=git_env())
+
+
+def change_categories(paths, static="app/static"):
+    """
+    What the post-receive hook will rebuild for these changed paths
+    """
+    found = set()
+    for path in paths:
+        if path == "requirements.txt":
+            found.add("requirements")
+        elif path.startswith(f"{static}/"):
+            found.add("static")
+        else:
+            found.add("code")
+    return [name for name in ("requirements", "static", "code") if name in found]
 
 
 @task
@@ -591,13 +1472,272 @@ def remote_env_sudo(c, env, cmd):
     c.sudo(f"{env} {cmd}")
 
 
+def port_registry(c, command, **kwargs):
+    return c.run(
+        f"python3 {DEPLOY_ROOT}/port_registry.py {remote_port_registry()}"
+        f" {command}",
+        **kwargs,
+    )
+
+
+def install_port_registry(c):
+    import port_registry as registry
+    c.put(registry.__file__, f"{DEPLOY_ROOT}/port_registry.py")
+
+
+def open_port_registry(c):
+    """
+    Install the port registry, built from the configs on a host without one
+    """
+    install_port_registry(c)
+    if not remote_exists(c, remote_port_registry()):
+        port_registry(c, "rebuild")
+
+
+def site_port(c, site):
+    """
+    Port of site in the host's port registry, PORT if it is not there
+    """
+    result = port_registry(c, f"lookup {site}", hide=True, warn=True)
+    found = result.stdout.strip()
+    if result.ok and found.isdigit():
+        return int(found)
+    logger.info(f'{site} not in the port registry, using port {PORT}')
+    return PORT
+
+
 @task
-def list_ports(c):
+def allocate_port(c, site, port=0):
     """
-    List used ports on deploy hosts
+    Port of site from the host's port registry, assigned if it has none
+
+    A host without a registry gets one built from its configs first, so
+    the ports of the sites already there are not handed out again.
     """
-    c.run(
-        'grep localhost  /etc/nginx/sites-enabled/*'
-        ' | cut -d/ -f 5,7'
-        ' | cut -d: -f 4,1'
+    open_port_registry(c)
+    claim = f" --port {port}" if port else ""
+    result = port_registry(c, f"allocate {site}{claim}", hide=True)
+    port = int(result.stdout.strip())
+    logger.info(f'{site} on port {port}')
+    return port
+
+
+@task
+def release_port(c, site):
+    """
+    Free the port of site in the host's port registry
+    """
+    port_registry(c, f"release {site}", hide=True, warn=True)
+
+
+@task
+def list_ports(c, site="", port=0):
+    """
+    List used ports on deploy hosts, or look up a site or port
+
+    A host without a registry gets one built from its configs first.
+    """
+    open_port_registry(c)
+    if site or port:
+        result = port_registry(c, f"lookup {site or port}", warn=True)
+        if result.failed:
+            logger.info(f'{site or port} is not in the port registry')
+    else:
+        port_registry(c, "list")
+
+
+@task
+def rebuild_ports(c):
+    """
+    Recreate the port registry from the nginx and supervisor configs
+    """
+    install_port_registry(c)
+    port_registry(c, "rebuild")
+
+
+#########
+# fleet #
+#########
+
+
+@task
+def fleet(c, name, hosts=DEPLOY_HOSTS, args="", workers=8):
+    """
+    Run a task on several hosts at once
+    """
+    func = globals().get(name.replace('-', '_'))
+    if not isinstance(func, Task):
+        logger.info(f'No such task: {name}')
+        exit(1)
+
+    hosts = [host for host in re.split(r'[,\s]+', hosts) if host]
+    task_args = [arg for arg in args.split(',') if arg]
+    logger.info(f'{name} on {len(hosts)} hosts')
+
+    def run_on(host):
+        return run_on_host(c, host, func, *task_args)
+
+    results = fan_out(run_on, hosts, max_workers=workers)
+    print(fleet_report(results))
+    if any(error is not None for _, _, error, _ in results):
+        exit(1)
+
+
+def run_on_host(c, host, func, *args):
+    """
+    Run task on host with its own connection, return the captured output
+    """
+    output = io.StringIO()
+    config = c.config.clone()
+    config.run.out_stream = output
+    config.run.err_stream = output
+    connection = Connection(host, config=config)
+    try:
+        func(connection, *args)
+    except (Exception, SystemExit) as error:
+        error.output = output.getvalue()
+        raise
+    finally:
+        connection.close()
+    return output.getvalue()
+
+
+def fleet_report(results):
+    """
+    One section per host with status, elapsed time and output
+    """
+    sections = []
+    for host, output, error, seconds in results:
+        status = 'ok' if error is None else 'FAILED'
+        sections.append(f'== {host}: {status} ({seconds:.2f}s)')
+        if isinstance(error, SystemExit):
+            output = getattr(error, 'output', '') + f'exit({error})\n'
+        elif error is not None:
+            output = getattr(error, 'output', '') + f'{error}\n'
+        if output:
+            sections.append(textwrap.indent(output.rstrip('\n'), '    '))
+    return '\n'.join(sections)
+
+
+@task
+def build_static(c, static_dir=f"{FLASK_MODULE}/static"):
+    """
+    Fingerprint and pre-compress static files as the deploy hook does
+    """
+    import static_pipeline
+    manifest, processed = static_pipeline.build(static_dir)
+    logger.info(f"{static_dir}: {len(manifest)} files, {processed} processed")
+    return manifest
+
+
+#############
+# benchmark #
+#############
+
+
+@task
+def benchmark(
+    c,
+    url="",
+    concurrency=10,
+    duration=10,
+    warmup=1,
+    routes="/,/data",
+    module=FLASK_MODULE,
+    app=APP,
+    port=8765,
+    workers=1,
+    output="",
+):
+    """
+    Load test a deployed URL or the app under a local gunicorn
+    """
+    import benchmark as bench
+    routes = [route for route in routes.split(",") if route]
+
+    if url:
+        results = bench.run(
+            url, concurrency=concurrency, duration=duration, routes=routes,
+            warmup=warmup,
+        )
+    else:
+        command = [
+            sys.executable, "-m", "gunicorn", f"{module}:{app}",
+            "-b", f"127.0.0.1:{port}", "-w", str(workers),
+        ]
+        logger.info(" ".join(command))
+        with bench.local_server(command, port):
+            results = bench.run(
+                f"http://127.0.0.1:{port}",
+                concurrency=concurrency, duration=duration, routes=routes,
+                warmup=warmup,
+            )
+        results["server"] = " ".join(command[1:])
+
+    report = json.dumps(results, indent=2)
+    print(report)
+    if output:
+        with open(output, "w") as f:
+            f.write(report + "\n")
+    return results
+
+
+@task
+def benchmark_suite(
+    c,
+    servers="sync,gthread,gevent,uvicorn",
+    workers="1,2,4",
+    keepalive="2,5",
+    threads=4,
+    concurrency=20,
+    duration=5,
+    warmup=1,
+    routes="/,/data",
+    module=FLASK_MODULE,
+    app=APP,
+    port=8765,
+    asgi=False,
+    output="",
+):
+    """
+    Load test the app under each server/workers/keepalive combination
+    """
+    import benchmark as bench
+    routes = [route for route in routes.split(",") if route]
+    runnable = []
+    for server in servers.split(","):
+        if server in bench.SERVERS and not bench.available(server):
+            logger.info(f"Skipping {server}: not installed")
+        elif server:
+            runnable.append(server)
+    configs = bench.matrix(
+        runnable,
+        [int(n) for n in workers.split(",")],
+        [int(n) for n in keepalive.split(",")],
     )
+
+    results = []
+    for config in configs:
+        command = bench.server_command(
+            config["server"], module, app, port,
+            workers=config["workers"], keepalive=config["keepalive"],
+            threads=threads, interface="asgi3" if asgi else "wsgi",
+        )
+        logger.info(" ".join(command[1:]))
+        try:
+            with bench.local_server(command, port):
+                result = bench.run(
+                    f"http://127.0.0.1:{port}", concurrency=concurrency,
+                    duration=duration, routes=routes, warmup=warmup,
+                )
+        except (RuntimeError, TimeoutError) as error:
+            result = {"error": str(error)}
+        result.update(config, command=" ".join(command[1:]))
+        results.append(result)
+
+    print(bench.table(results))
+    if output:
+        with open(output, "w") as f:
+            f.write(json.dumps(bench.ranked(results), indent=2) + "\n")
+    return results
+
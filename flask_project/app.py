@@ -1,6 +1,14 @@
 from flask import Flask, jsonify
 
+from . import assets, metrics, timing
+from .cache import cached
+from .fastjson import FastJSONProvider, preserialized
+
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
+assets.init_app(app)
+app.wsgi_app = timing.instrument(app.wsgi_app, url_map=app.url_map)
+app.wsgi_app = metrics.instrument(app.wsgi_app, url_map=app.url_map)
 
 
 @app.route('/')
@@ -8,12 +16,15 @@ def index():
     return 'Flask is running!'
 
 
+NAMES = preserialized({
+    "first_names": ["Jonny", "Jacob", "Juuli", "Jenny", "Joan", "Jim"]
+})
+
+
 @app.route('/data')
+@cached(ttl=60)
 def names():
-    data = {
-        "first_names": ["Jonny", "Jacob", "Juuli", "Jenny", "Joan", "Jim"]
-    }
-    return jsonify(data)
+    return jsonify(NAMES)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,102 @@
+"""
+ASGI variant of the sample app, for I/O bound sites
+
+    uvicorn flask_project.asgi:app --workers 4
+    gunicorn flask_project.asgi:app -k uvicorn.workers.UvicornWorker -w 4
+
+Routes await instead of block, so one worker serves many slow requests at
+once. Plain ASGI, no framework needed.
+"""
+
+import asyncio
+import urllib.parse
+
+from . import metrics, timing
+from .fastjson import preserialized
+
+NAMES = preserialized({
+    "first_names": ["Jonny", "Jacob", "Juuli", "Jenny", "Joan", "Jim"]
+})
+
+ROUTES = {}
+
+
+def route(path):
+    def register(handler):
+        ROUTES[path] = handler
+        return handler
+    return register
+
+
+async def respond(send, body, status=200, content_type=b'text/plain'):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', content_type),
+            (b'content-length', str(len(body)).encode()),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+@route('/')
+async def index(scope, query):
+    return 200, b'ASGI is running!', b'text/plain'
+
+
+@route('/data')
+async def names(scope, query):
+    return 200, bytes(NAMES), b'application/json'
+
+
+@route('/sleep')
+async def sleep(scope, query):
+    """
+    Stand-in for a slow backend call: wait ms milliseconds without blocking
+    """
+    ms = min(int(query.get('ms', ['100'])[0]), 10000)
+    await asyncio.sleep(ms / 1000)
+    return 200, f'slept {ms} ms'.encode(), b'text/plain'
+
+
+@route('/fan-out')
+async def fan_out(scope, query):
+    """
+    n concurrent stand-in calls, done in the time of the slowest one
+    """
+    n = min(int(query.get('n', ['10'])[0]), 100)
+    await asyncio.gather(*(asyncio.sleep(0.05) for _ in range(n)))
+    return 200, f'{n} calls'.encode(), b'text/plain'
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    handler = ROUTES.get(scope['path'])
+    if handler is None:
+        return await respond(send, b'Not Found', status=404)
+    if scope['method'] not in ('GET', 'HEAD'):
+        return await respond(send, b'Method Not Allowed', status=405)
+    query = urllib.parse.parse_qs(scope.get('query_string', b'').decode())
+    try:
+        status, body, content_type = await handler(scope, query)
+    except ValueError:
+        status, body, content_type = 400, b'Bad Request', b'text/plain'
+    await respond(send, body, status, content_type)
+
+
+app = timing.instrument(application, asgi=True)
+app = metrics.instrument(app, asgi=True, routes=ROUTES)
@@ -0,0 +1,42 @@
+"""
+URLs of fingerprinted static files
+
+static_pipeline.py writes manifest.json into the static folder at deploy
+time, asset_url('app.css') then gives /static/app.<hash>.css, which nginx
+lets clients cache forever. Files missing from the manifest, or all of them
+when there is no manifest, keep their own name.
+"""
+
+import json
+import os
+
+from flask import current_app, url_for
+
+MANIFEST = 'manifest.json'
+
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, MANIFEST)) as f:
+            entries = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return {name: entry['file'] for name, entry in entries.items()}
+
+
+def asset_url(filename, **kwargs):
+    manifest = current_app.extensions.get('assets')
+    if manifest is None:
+        manifest = current_app.extensions['assets'] = load_manifest(
+            current_app.static_folder
+        )
+    return url_for(
+        'static', filename=manifest.get(filename, filename), **kwargs
+    )
+
+
+def init_app(app):
+    """
+    Make asset_url available in templates
+    """
+    app.add_template_global(asset_url)
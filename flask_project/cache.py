@@ -0,0 +1,144 @@
+"""
+In-process response cache with ETag and conditional GET for Flask views
+
+    @app.route('/data')
+    @cached(ttl=60)
+    def data():
+        ...
+
+The view runs once per ttl and query string; the serialized body, its
+strong ETag and headers are kept in an LRU, and clients sending the ETag
+back in If-None-Match get a 304 without a body.
+
+The cached responses are shared by all clients and sent as public, so this
+is for views whose response only depends on the path and query string, as
+for anonymous GETs. Requests with Authorization and responses that set a
+cookie, Vary or are private or no-store are passed through uncached.
+"""
+
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, make_response, request
+
+
+class LRUCache:
+    """
+    Thread safe LRU of at most maxsize entries, each valid for ttl seconds
+    """
+
+    def __init__(self, maxsize=128, ttl=60, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= self.clock():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class Cached:
+    """
+    A response as kept in the cache
+    """
+
+    __slots__ = ('body', 'status', 'headers', 'etag')
+
+    def __init__(self, body, status, headers, etag):
+        self.body = body
+        self.status = status
+        self.headers = headers
+        self.etag = etag
+
+
+def etag_of(body):
+    return hashlib.sha256(body).hexdigest()[:32]
+
+
+def request_key():
+    return request.full_path
+
+
+def cacheable(response):
+    return (
+        response.status_code == 200
+        and not response.is_streamed
+        and 'Set-Cookie' not in response.headers
+        and 'Vary' not in response.headers
+        and not response.cache_control.private
+        and not response.cache_control.no_store
+    )
+
+
+def cached(ttl=60, maxsize=128, max_age=None, key=request_key):
+    """
+    Cache the successful GET responses of a view
+
+    max_age is sent in Cache-Control (default ttl), key gives the cache key
+    of the current request (default path and query string).
+    """
+    max_age = ttl if max_age is None else max_age
+
+    def decorator(view):
+        cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or \
+                    'Authorization' in request.headers:
+                return view(*args, **kwargs)
+            entry = cache.get(key())
+            if entry is None:
+                response = make_response(view(*args, **kwargs))
+                if not cacheable(response):
+                    return response
+                body = response.get_data()
+                entry = Cached(
+                    body,
+                    response.status_code,
+                    [(name, value) for name, value in response.headers
+                     if name not in ('Content-Length', 'ETag')],
+                    etag_of(body),
+                )
+                cache.set(key(), entry)
+            return respond(entry, max_age)
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
+
+
+def respond(entry, max_age):
+    if request.if_none_match.contains(entry.etag):
+        response = Response(status=304)
+    else:
+        response = Response(entry.body, status=entry.status,
+                            headers=entry.headers)
+    response.set_etag(entry.etag)
+    response.headers['Cache-Control'] = f'public, max-age={max_age}'
+    return response
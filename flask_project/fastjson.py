@@ -0,0 +1,84 @@
+"""
+Flask JSON provider using orjson when it is installed
+
+    app.json = FastJSONProvider(app)
+
+Without orjson the stdlib encoder of the default provider is used. Data
+that does not change can be serialized once with preserialized() and
+returned through jsonify as is on every request.
+"""
+
+import json
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JSONBytes(bytes):
+    """
+    A JSON document serialized ahead of time
+    """
+
+
+def preserialized(obj):
+    """
+    Serialize obj once, compact and with sorted keys
+    """
+    default = DefaultJSONProvider.default
+    if orjson is not None:
+        return JSONBytes(orjson.dumps(
+            obj, default=default,
+            option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+            | orjson.OPT_PASSTHROUGH_DATETIME,
+        ))
+    return JSONBytes(json.dumps(
+        obj, default=default, sort_keys=True, separators=(',', ':')
+    ).encode())
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    DefaultJSONProvider with orjson serialization and JSONBytes payloads
+
+    orjson writes UTF-8 rather than ASCII escapes, ensure_ascii is only
+    honoured by the stdlib fallback.
+    """
+
+    def options(self, indent=False):
+        # dates go through default, as HTTP dates like the stdlib provider
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or set(kwargs) - {'indent', 'separators'}:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(
+            obj, default=self.default,
+            option=self.options(indent=bool(kwargs.get('indent'))),
+        ).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if isinstance(obj, JSONBytes):
+            return self._app.response_class(obj, mimetype=self.mimetype)
+        if orjson is None:
+            return super().response(obj)
+        indent = (self.compact is None and self._app.debug) \
+            or self.compact is False
+        body = orjson.dumps(
+            obj, default=self.default, option=self.options(indent=indent)
+        )
+        return self._app.response_class(body + b'\n', mimetype=self.mimetype)
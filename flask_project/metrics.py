@@ -0,0 +1,450 @@
+"""
+Prometheus-style metrics shared by all workers of a site
+
+Every worker process counts into its own mmap-backed file in APP_METRICS_DIR,
+so updating a metric is a few memory writes and no system call. A request
+for /metrics, in whichever worker it lands, adds up the files of all
+workers. The counters of workers that exited are first added to dead.db and
+their files removed, so the directory does not grow with worker restarts:
+
+    app_requests_total{method,route,status}      counter
+    app_request_duration_seconds{route}          histogram
+    app_request_queue_seconds                    histogram, from the
+                                                 X-Request-Start set by nginx
+    app_requests_in_progress                     gauge, live workers only
+    app_workers                                  gauge
+"""
+
+import fcntl
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from .timing import BUCKETS, path_route, url_map_route
+
+DEAD = 'dead.db'
+
+HEADER = struct.Struct('q')
+LENGTH = struct.Struct('i')
+VALUE = struct.Struct('d')
+
+HELP = {
+    'app_requests_total': ('counter', 'Requests handled'),
+    'app_request_duration_seconds': ('histogram', 'Time spent in the app'),
+    'app_request_queue_seconds': (
+        'histogram', 'Time from nginx accepting a request to the app'
+    ),
+    'app_requests_in_progress': ('gauge', 'Requests being handled'),
+    'app_workers': ('gauge', 'Worker processes'),
+}
+
+
+class MmapValues:
+    """
+    Float values of one process in a file
+
+    The file starts with the number of bytes used, followed by records of
+    key length, key (padded to 8 bytes) and value. Records are only
+    appended, so other processes can read while this one writes.
+    """
+
+    def __init__(self, path, size=1 << 16):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.file = os.fdopen(fd, 'r+b')
+        if os.fstat(fd).st_size < size:
+            self.file.truncate(size)
+        self.map = mmap.mmap(fd, 0)
+        self.used = HEADER.unpack_from(self.map, 0)[0] or HEADER.size
+        self.positions = {key: pos for key, _, pos in records(self.map)}
+
+    def position(self, key):
+        pos = self.positions.get(key)
+        if pos is None:
+            pos = self.allocate(key)
+        return pos
+
+    def allocate(self, key):
+        encoded = key.encode()
+        padded = (len(encoded) + LENGTH.size + 7) // 8 * 8 - LENGTH.size
+        size = LENGTH.size + padded + VALUE.size
+        while self.used + size > len(self.map):
+            self.map.resize(2 * len(self.map))
+        LENGTH.pack_into(self.map, self.used, len(encoded))
+        start = self.used + LENGTH.size
+        self.map[start:start + len(encoded)] = encoded
+        pos = self.used + LENGTH.size + padded
+        VALUE.pack_into(self.map, pos, 0.0)
+        self.used += size
+        HEADER.pack_into(self.map, 0, self.used)
+        self.positions[key] = pos
+        return pos
+
+    def get(self, key):
+        return VALUE.unpack_from(self.map, self.position(key))[0]
+
+    def set(self, key, value):
+        VALUE.pack_into(self.map, self.position(key), value)
+
+    def inc(self, key, amount=1.0):
+        pos = self.position(key)
+        VALUE.pack_into(
+            self.map, pos, VALUE.unpack_from(self.map, pos)[0] + amount
+        )
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def records(data):
+    """
+    (key, value, position) for the records in the bytes of a values file
+    """
+    used = HEADER.unpack_from(data, 0)[0]
+    pos = HEADER.size
+    while pos < used:
+        length = LENGTH.unpack_from(data, pos)[0]
+        start = pos + LENGTH.size
+        key = bytes(data[start:start + length]).decode()
+        value_pos = start + (length + LENGTH.size + 7) // 8 * 8 - LENGTH.size
+        yield key, VALUE.unpack_from(data, value_pos)[0], value_pos
+        pos = value_pos + VALUE.size
+
+
+def metric_key(name, suffix='', **labels):
+    return json.dumps([name, suffix, sorted(labels.items())])
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Metrics:
+    """
+    Metrics of this process, written to directory/<pid>.db
+    """
+
+    def __init__(self, directory, buckets=BUCKETS):
+        self.directory = directory
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.pid = None
+        self.values = None
+        self.keys = {}
+
+    def store(self):
+        # the app may be imported before gunicorn forks the workers
+        if self.pid != os.getpid():
+            os.makedirs(self.directory, exist_ok=True)
+            self.pid = os.getpid()
+            self.values = MmapValues(
+                os.path.join(self.directory, f'{self.pid}.db')
+            )
+            self.values.set(metric_key('app_requests_in_progress'), 0.0)
+            self.keys = {}
+        return self.values
+
+    def key(self, name, suffix='', **labels):
+        cache = (name, suffix, tuple(sorted(labels.items())))
+        key = self.keys.get(cache)
+        if key is None:
+            key = self.keys[cache] = metric_key(name, suffix, **labels)
+        return key
+
+    def observe(self, values, name, seconds, **labels):
+        index = next(
+            i for i, bound in enumerate(self.buckets) if seconds <= bound
+        )
+        values.inc(self.key(name, '_bucket', index=index, **labels))
+        values.inc(self.key(name, '_sum', **labels), seconds)
+        values.inc(self.key(name, '_count', **labels))
+
+    def started(self):
+        with self.lock:
+            self.store().inc(self.key('app_requests_in_progress'))
+
+    def finished(self, method, route, status, seconds, queued=None):
+        with self.lock:
+            values = self.store()
+            values.inc(self.key('app_requests_in_progress'), -1.0)
+            values.inc(self.key(
+                'app_requests_total', method=method, route=route,
+                status=status,
+            ))
+            self.observe(
+                values, 'app_request_duration_seconds', seconds, route=route
+            )
+            if queued is not None:
+                self.observe(values, 'app_request_queue_seconds', queued)
+
+    def worker_files(self):
+        """
+        (path, live) of the files of the worker processes
+        """
+        for path in glob.glob(os.path.join(self.directory, '[0-9]*.db')):
+            yield path, alive(int(os.path.basename(path)[:-3]))
+
+    def fold(self):
+        """
+        Add the counters and histograms of exited workers to dead.db and
+        remove their files
+        """
+        dead = [path for path, live in self.worker_files() if not live]
+        if not dead:
+            return
+        totals = MmapValues(os.path.join(self.directory, DEAD))
+        try:
+            for path in dead:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                for key, value, _ in records(data):
+                    if HELP[json.loads(key)[0]][0] != 'gauge':
+                        totals.inc(key, value)
+                os.remove(path)
+        finally:
+            totals.close()
+
+    def collect(self):
+        """
+        Values summed over the files of all workers, gauges only over the
+        live ones
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        totals = {}
+        workers = 0
+        # one scrape at a time, a file is either folded or read as is
+        with open(os.path.join(self.directory, 'collect.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.fold()
+            files = list(self.worker_files())
+            dead = os.path.join(self.directory, DEAD)
+            if os.path.exists(dead):
+                files.append((dead, False))
+            for path, live in files:
+                workers += live
+                with open(path, 'rb') as f:
+                    data = f.read()
+                for key, value, _ in records(data):
+                    name, suffix, labels = json.loads(key)
+                    if HELP[name][0] == 'gauge' and not live:
+                        continue
+                    labels = tuple(map(tuple, labels))
+                    totals[name, suffix, labels] = \
+                        totals.get((name, suffix, labels), 0.0) + value
+        totals['app_workers', '', ()] = float(workers)
+        return totals
+
+    def exposition(self):
+        """
+        The collected metrics in the Prometheus text format
+        """
+        totals = self.collect()
+        lines = []
+        for name, (kind, text) in HELP.items():
+            samples = sorted(
+                (suffix, labels, value)
+                for (metric, suffix, labels), value in totals.items()
+                if metric == name
+            )
+            lines += [f'# HELP {name} {text}', f'# TYPE {name} {kind}']
+            if kind == 'histogram':
+                lines += self.histogram_lines(name, samples)
+            else:
+                lines += [
+                    f'{name}{format_labels(labels)} {value}'
+                    for _, labels, value in samples
+                ]
+        return '\n'.join(lines) + '\n'
+
+    def histogram_lines(self, name, samples):
+        series = {}
+        for suffix, labels, value in samples:
+            labels = dict(labels)
+            index = labels.pop('index', None)
+            entry = series.setdefault(
+                tuple(sorted(labels.items())),
+                {'buckets': [0.0] * len(self.buckets)},
+            )
+            if suffix == '_bucket':
+                entry['buckets'][index] += value
+            else:
+                entry[suffix] = value
+        lines = []
+        for labels, entry in series.items():
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, entry['buckets']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(
+                    f'{name}_bucket{format_labels(labels + (("le", le),))}'
+                    f' {cumulative}'
+                )
+            for suffix in ('_sum', '_count'):
+                lines.append(
+                    f'{name}{suffix}{format_labels(labels)}'
+                    f' {entry.get(suffix, 0.0)}'
+                )
+        return lines
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'),
+        )
+        for name, value in labels
+    )
+    return f'{{{pairs}}}'
+
+
+def queue_seconds(environ, now):
+    """
+    Time since nginx accepted the request, from X-Request-Start: t=<msec>
+    """
+    header = environ.get('HTTP_X_REQUEST_START', '')
+    try:
+        if header.startswith('t='):
+            header = header[2:]
+        return max(now - float(header), 0.0)
+    except ValueError:
+        return None
+
+
+class MetricsMiddleware:
+    """
+    WSGI middleware counting requests and serving the metrics on path
+    """
+
+    def __init__(self, app, metrics, route=path_route, path='/metrics'):
+        self.app = app
+        self.metrics = metrics
+        self.route = route
+        self.path = path
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') == self.path:
+            body = self.metrics.exposition().encode()
+            start_response('200 OK', [
+                ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+                ('Content-Length', str(len(body))),
+            ])
+            return [body]
+
+        queued = queue_seconds(environ, time.time())
+        start = time.perf_counter()
+        status = '500'
+
+        def counting_start_response(status_line, headers, exc_info=None):
+            nonlocal status
+            status = status_line.split(' ', 1)[0]
+            return start_response(status_line, headers, exc_info)
+
+        self.metrics.started()
+        try:
+            return self.app(environ, counting_start_response)
+        finally:
+            self.metrics.finished(
+                environ.get('REQUEST_METHOD', 'GET'), self.route(environ),
+                status, time.perf_counter() - start, queued,
+            )
+
+
+def scope_route(scope):
+    return getattr(scope.get('route'), 'path', None) or scope['path']
+
+
+def routes_route(routes):
+    """
+    Route by the known paths, to bound the number of metrics
+    """
+    def route(scope):
+        return scope['path'] if scope['path'] in routes else '<unmatched>'
+
+    return route
+
+
+class ASGIMetricsMiddleware:
+    """
+    ASGI middleware counting http requests and serving the metrics on path
+    """
+
+    def __init__(self, app, metrics, route=scope_route, path='/metrics'):
+        self.app = app
+        self.metrics = metrics
+        self.route = route
+        self.path = path
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        if scope['path'] == self.path:
+            body = self.metrics.exposition().encode()
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [
+                    (b'content-type',
+                     b'text/plain; version=0.0.4; charset=utf-8'),
+                    (b'content-length', str(len(body)).encode()),
+                ],
+            })
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        headers = dict(scope.get('headers', []))
+        queued = queue_seconds({
+            'HTTP_X_REQUEST_START':
+                headers.get(b'x-request-start', b'').decode('latin-1'),
+        }, time.time())
+        start = time.perf_counter()
+        status = '500'
+
+        async def counting_send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = str(message['status'])
+            await send(message)
+
+        self.metrics.started()
+        try:
+            await self.app(scope, receive, counting_send)
+        finally:
+            self.metrics.finished(
+                scope.get('method', 'GET'), self.route(scope), status,
+                time.perf_counter() - start, queued,
+            )
+
+
+def instrument(
+    app, url_map=None, environ=os.environ, asgi=False, routes=None,
+):
+    """
+    Wrap a WSGI (or ASGI) app when APP_METRICS_DIR is set, else return it
+    as is
+
+    routes are the paths an ASGI app serves, other paths are counted as
+    <unmatched>.
+    """
+    directory = environ.get('APP_METRICS_DIR')
+    if not directory:
+        return app
+    if asgi:
+        route = routes_route(routes) if routes is not None else scope_route
+        return ASGIMetricsMiddleware(app, Metrics(directory), route)
+    route = url_map_route(url_map) if url_map is not None else path_route
+    return MetricsMiddleware(app, Metrics(directory), route)
@@ -0,0 +1,265 @@
+"""
+Opt-in request timing and profiling middleware
+
+Enabled with environment variables, as written by generate_site_supervisor:
+
+    APP_TIMING=1            per-route latency histograms, Server-Timing header
+    APP_PROFILE_RATE=0.01   fraction of requests run under cProfile
+    APP_PROFILE_DIR=...     where the slowest profiles and histograms go
+    APP_PROFILE_KEEP=20     number of slowest profiles kept per worker
+"""
+
+import atexit
+import contextlib
+import cProfile
+import heapq
+import json
+import os
+import random
+import re
+import threading
+import time
+
+BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0, float('inf'),
+)
+
+
+class Histogram:
+    """
+    Cumulative latency histogram with fixed bucket bounds in seconds
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+
+    def as_dict(self):
+        cumulative, buckets = 0, {}
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets['+Inf' if bound == float('inf') else str(bound)] = \
+                cumulative
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+class Timings:
+    """
+    Per-route histograms and the slowest sampled profiles of one process
+    """
+
+    def __init__(self, profile_rate=0.0, profile_dir=None, keep=20):
+        self.histograms = {}
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+        self.keep = keep
+        self.slowest = []
+        self.lock = threading.Lock()
+        self.profiling = threading.Lock()
+
+    def observe(self, route, seconds):
+        with self.lock:
+            if route not in self.histograms:
+                self.histograms[route] = Histogram()
+            self.histograms[route].observe(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                route: histogram.as_dict()
+                for route, histogram in sorted(self.histograms.items())
+            }
+
+    def profiler(self):
+        """
+        A cProfile.Profile for a sampled request, None if not sampled
+
+        Only one request per process is profiled at a time, cProfile does
+        not nest.
+        """
+        if not self.profile_dir or random.random() >= self.profile_rate:
+            return None
+        if not self.profiling.acquire(blocking=False):
+            return None
+        return cProfile.Profile()
+
+    def save(self, profile, route, seconds):
+        """
+        Keep the profile if it is among the slowest seen by this process
+        """
+        try:
+            with self.lock:
+                if len(self.slowest) >= self.keep and \
+                        seconds <= self.slowest[0][0]:
+                    return None
+                name = '{:09.1f}ms-{}-{}-{}.prof'.format(
+                    seconds * 1000, slug(route), os.getpid(), time.time_ns()
+                )
+                path = os.path.join(self.profile_dir, name)
+                evicted = None
+                if len(self.slowest) >= self.keep:
+                    evicted = heapq.heappop(self.slowest)[1]
+                heapq.heappush(self.slowest, (seconds, path))
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profile.dump_stats(path)
+            if evicted:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(evicted)
+            return path
+        finally:
+            self.profiling.release()
+
+    def dump(self):
+        """
+        Write the histograms of this process next to the profiles
+        """
+        if not self.profile_dir or not self.histograms:
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f'timing-{os.getpid()}.json')
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+
+def slug(route):
+    return re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+
+
+def server_timing(seconds):
+    return f'app;dur={seconds * 1000:.1f}'
+
+
+def path_route(environ):
+    return environ.get('PATH_INFO') or '/'
+
+
+def url_map_route(url_map):
+    """
+    Route by the matching url rule rather than the path, to bound the
+    number of histograms
+    """
+    from werkzeug.exceptions import HTTPException
+
+    def route(environ):
+        try:
+            rule, _ = url_map.bind_to_environ(environ).match(return_rule=True)
+        except HTTPException:
+            return '<unmatched>'
+        return rule.rule
+
+    return route
+
+
+class TimingMiddleware:
+    """
+    WSGI middleware timing each request
+
+        app.wsgi_app = TimingMiddleware(
+            app.wsgi_app, Timings(), url_map_route(app.url_map)
+        )
+    """
+
+    def __init__(self, app, timings, route=path_route):
+        self.app = app
+        self.timings = timings
+        self.route = route
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        profile = self.timings.profiler()
+
+        def timed_start_response(status, headers, exc_info=None):
+            headers = list(headers) + [
+                ('Server-Timing', server_timing(time.perf_counter() - start))
+            ]
+            return start_response(status, headers, exc_info)
+
+        if profile is not None:
+            profile.enable()
+        try:
+            return self.app(environ, timed_start_response)
+        finally:
+            if profile is not None:
+                profile.disable()
+            seconds = time.perf_counter() - start
+            route = self.route(environ)
+            self.timings.observe(route, seconds)
+            if profile is not None:
+                self.timings.save(profile, route, seconds)
+
+
+class ASGITimingMiddleware:
+    """
+    ASGI middleware timing each http request
+    """
+
+    def __init__(self, app, timings):
+        self.app = app
+        self.timings = timings
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        profile = self.timings.profiler()
+
+        async def timed_send(message):
+            if message['type'] == 'http.response.start':
+                message = dict(message)
+                message['headers'] = list(message.get('headers', [])) + [(
+                    b'server-timing',
+                    server_timing(time.perf_counter() - start).encode(),
+                )]
+            await send(message)
+
+        if profile is not None:
+            profile.enable()
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            if profile is not None:
+                profile.disable()
+            seconds = time.perf_counter() - start
+            route = getattr(scope.get('route'), 'path', None) or scope['path']
+            self.timings.observe(route, seconds)
+            if profile is not None:
+                self.timings.save(profile, route, seconds)
+
+
+def from_environ(environ=os.environ):
+    """
+    Timings configured by the APP_* variables, None if timing is off
+    """
+    if environ.get('APP_TIMING', '') in ('', '0', 'false', 'no'):
+        return None
+    timings = Timings(
+        profile_rate=float(environ.get('APP_PROFILE_RATE', 0) or 0),
+        profile_dir=environ.get('APP_PROFILE_DIR') or None,
+        keep=int(environ.get('APP_PROFILE_KEEP', 20) or 20),
+    )
+    atexit.register(timings.dump)
+    return timings
+
+
+def instrument(app, asgi=False, url_map=None, environ=os.environ):
+    """
+    Wrap a WSGI (or ASGI) app when APP_TIMING is set, else return it as is
+    """
+    timings = from_environ(environ)
+    if timings is None:
+        return app
+    if asgi:
+        return ASGITimingMiddleware(app, timings)
+    route = url_map_route(url_map) if url_map is not None else path_route
+    return TimingMiddleware(app, timings, route)
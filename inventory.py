@@ -0,0 +1,112 @@
+"""
+Sites of a fleet described in one TOML (or YAML) file
+
+    [defaults]
+    host = "deployhost"
+    module = "flask_project"
+
+    [hosts.deployhost]
+    cpus = 4
+
+    [sites."foo.bar"]
+    port = 9001
+
+    [sites."baz.com"]
+    socket = true
+    metrics = true
+    nginx = {micro_cache = ["/data"], assets = true}
+    supervisor = {worker_class = "gthread", max_requests = 1000}
+
+Settings of a site override those of its host, which override the
+defaults. nginx and supervisor hold the options of generate-site-nginx and
+generate-site-supervisor, merged the same way. YAML files need PyYAML,
+TOML needs Python 3.11 or tomli.
+"""
+
+import os
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# keys of a site used by both configs, or by the supervisor config only
+COMMON = ('port', 'socket', 'metrics')
+SUPERVISOR = ('module', 'app', 'version', 'deploy_user', 'uvicorn', 'cpus')
+SECTIONS = ('nginx', 'supervisor')
+KEYS = {'host', *COMMON, *SUPERVISOR, *SECTIONS}
+
+
+def load(path):
+    """
+    Contents of an inventory file, by extension
+    """
+    if path.endswith(('.yaml', '.yml')):
+        if yaml is None:
+            raise ImportError(f'PyYAML is needed to read {path}')
+        with open(path) as f:
+            return yaml.safe_load(f) or {}
+    if tomllib is None:
+        raise ImportError(f'tomli is needed to read {path}')
+    with open(path, 'rb') as f:
+        return tomllib.load(f)
+
+
+def merge(*layers):
+    """
+    Settings of the layers, later ones winning, nginx and supervisor merged
+    key by key
+    """
+    merged = {section: {} for section in SECTIONS}
+    for layer in layers:
+        for key, value in layer.items():
+            if key in SECTIONS:
+                merged[key].update(value)
+            else:
+                merged[key] = value
+    return merged
+
+
+def sites(data):
+    """
+    Settings of each site in inventory data, in file order
+    """
+    defaults = data.get('defaults', {})
+    hosts = data.get('hosts', {})
+    entries = []
+    for site, settings in data.get('sites', {}).items():
+        unknown = set(settings) - KEYS
+        if unknown:
+            raise ValueError(f'{site}: unknown keys {", ".join(sorted(unknown))}')
+        host = settings.get('host', defaults.get('host'))
+        entry = merge(defaults, hosts.get(host, {}), settings)
+        entry['site'] = site
+        entry['host'] = host
+        if not entry.get('port') and not entry.get('socket'):
+            raise ValueError(f'{site}: needs a port or socket = true')
+        entries.append(entry)
+    return entries
+
+
+def write_if_changed(path, text):
+    """
+    Write text to path unless it already holds it, True if written
+    """
+    try:
+        with open(path) as f:
+            if f.read() == text:
+                return False
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
+    return True
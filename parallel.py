@@ -0,0 +1,155 @@
+"""
+Concurrent execution helpers for fab tasks
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from file_and_stream import logger
+
+
+class Step:
+    """
+    A named call with the steps it has to wait for
+    """
+
+    def __init__(self, name, func, args=(), kwargs=None, requires=()):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.requires = tuple(requires)
+
+    def __call__(self):
+        return self.func(*self.args, **self.kwargs)
+
+
+class TaskGraph:
+    """
+    Dependency graph of steps, independent steps run in a thread pool
+
+        graph = TaskGraph()
+        graph.add('git', configure_git, c, site)
+        graph.add('push', push_remote, c, site, requires=['git'])
+        timings = graph.run(max_workers=4)
+    """
+
+    def __init__(self):
+        self.steps = {}
+
+    def add(self, name, func, *args, requires=(), **kwargs):
+        if name in self.steps:
+            raise ValueError(f'Step {name} already defined')
+        self.steps[name] = Step(name, func, args, kwargs, requires)
+        return self
+
+    def order(self):
+        """
+        Return step names in a valid sequential order
+        """
+        for step in self.steps.values():
+            for dep in step.requires:
+                if dep not in self.steps:
+                    raise ValueError(f'{step.name} requires unknown step {dep}')
+
+        done = []
+        pending = dict(self.steps)
+        while pending:
+            ready = [
+                name for name, step in pending.items()
+                if all(dep in done for dep in step.requires)
+            ]
+            if not ready:
+                raise ValueError(f'Dependency cycle in {sorted(pending)}')
+            for name in ready:
+                done.append(name)
+                del pending[name]
+        return done
+
+    def run(self, max_workers=4):
+        """
+        Run all steps, each as soon as its requirements are done
+
+        Returns a dict of step name to elapsed seconds. The first failing
+        step stops the scheduling of new steps and its exception is
+        re-raised once the running ones have finished.
+        """
+        self.order()
+
+        timings = {}
+        done = set()
+        running = {}
+        failure = None
+
+        def timed(step):
+            start = time.perf_counter()
+            try:
+                step()
+            finally:
+                timings[step.name] = time.perf_counter() - start
+
+        with ThreadPoolExecutor(max_workers=max(int(max_workers), 1)) as pool:
+            while True:
+                if failure is None:
+                    for name, step in self.steps.items():
+                        if name in done or name in running.values():
+                            continue
+                        if all(dep in done for dep in step.requires):
+                            logger.info(f'Start {name}')
+                            running[pool.submit(timed, step)] = name
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        logger.info(f'{name} failed')
+                        failure = failure or future.exception()
+                    else:
+                        logger.info(f'{name} done in {timings[name]:.2f}s')
+                        done.add(name)
+
+        if failure is not None:
+            raise failure
+        return timings
+
+
+def report(timings, total=None):
+    """
+    Format step timings as a table, slowest first
+    """
+    names = list(timings) + (['total'] if total is not None else [])
+    width = max((len(name) for name in names), default=0)
+    lines = [
+        f'{name:<{width}}  {seconds:8.2f}s'
+        for name, seconds in sorted(
+            timings.items(), key=lambda item: item[1], reverse=True
+        )
+    ]
+    if total is not None:
+        lines.append(f'{"total":<{width}}  {total:8.2f}s')
+    return '\n'.join(lines)
+
+
+def fan_out(func, items, max_workers=8):
+    """
+    Call func(item) for every item, at most max_workers at a time
+
+    Returns a list of (item, value, error, seconds) in the order of items,
+    a failing call has value None and the exception as error. A task that
+    calls exit() fails for its item only, with the SystemExit as error.
+    """
+    items = list(items)
+
+    def timed(item):
+        start = time.perf_counter()
+        try:
+            return item, func(item), None, time.perf_counter() - start
+        except (Exception, SystemExit) as error:
+            return item, None, error, time.perf_counter() - start
+
+    if not items:
+        return []
+    workers = min(max(int(max_workers), 1), len(items))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(timed, items))
@@ -0,0 +1,211 @@
+"""
+Host-wide registry of the ports assigned to sites
+
+    python3 port_registry.py <registry> allocate <site> [--port N]
+    python3 port_registry.py <registry> release <site>
+    python3 port_registry.py <registry> lookup <site or port>
+    python3 port_registry.py <registry> list
+    python3 port_registry.py <registry> rebuild
+
+The registry is a JSON file of site -> port. Changes hold an exclusive
+lock on <registry>.lock and replace the file atomically, so concurrent
+deploys to the same host never hand out a port twice. rebuild recreates it
+from the nginx and supervisor configs. Runs with the standard library only.
+"""
+
+import argparse
+import contextlib
+import fcntl
+import glob
+import json
+import os
+import re
+import socket
+import sys
+
+LOW = 9000
+HIGH = 9999
+NGINX_DIR = '/etc/nginx/sites-enabled'
+SUPERVISOR_DIR = '/etc/supervisor/conf.d'
+
+ADDRESS = re.compile(r'localhost:(\d+)|--port[ =](\d+)')
+PROGRAM = re.compile(r'^\[program:([^\]]+)\]', re.MULTILINE)
+
+
+class PortTaken(Exception):
+    pass
+
+
+class Registry:
+    """
+    site -> port with the reverse index, for lookups either way
+    """
+
+    def __init__(self, sites=None):
+        self.sites = {}
+        self.ports = {}
+        for site, port in (sites or {}).items():
+            self.add(site, port)
+
+    def add(self, site, port):
+        port = int(port)
+        owner = self.ports.get(port)
+        if owner is not None and owner != site:
+            raise PortTaken(f'port {port} is taken by {owner}')
+        self.remove(site)
+        self.sites[site] = port
+        self.ports[port] = site
+
+    def remove(self, site):
+        port = self.sites.pop(site, None)
+        if port is not None:
+            del self.ports[port]
+        return port
+
+    def lookup(self, key):
+        """
+        Port of a site, or site on a port
+        """
+        if str(key).isdigit():
+            return self.ports.get(int(key))
+        return self.sites.get(key)
+
+    def allocate(self, site, low=LOW, high=HIGH, in_use=None):
+        """
+        Port of site, the lowest free one in [low, high] if it has none
+
+        in_use(port) tells whether something outside the registry listens
+        on a port, such ports are skipped.
+        """
+        if site in self.sites:
+            return self.sites[site]
+        for port in range(low, high + 1):
+            if port in self.ports or (in_use and in_use(port)):
+                continue
+            self.add(site, port)
+            return port
+        raise PortTaken(f'no free port in {low}-{high}')
+
+
+def listening(port):
+    """
+    Whether a socket already listens on localhost:port
+    """
+    with socket.socket() as s:
+        try:
+            s.bind(('127.0.0.1', port))
+        except OSError:
+            return True
+    return False
+
+
+def load(path):
+    try:
+        with open(path) as f:
+            return Registry(json.load(f))
+    except FileNotFoundError:
+        return Registry()
+
+
+def save(registry, path):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(registry.sites, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+@contextlib.contextmanager
+def locked(path):
+    """
+    Registry at path under an exclusive lock, saved when the block exits
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        registry = load(path)
+        yield registry
+        save(registry, path)
+
+
+def scan(nginx_dir=NGINX_DIR, supervisor_dir=SUPERVISOR_DIR):
+    """
+    site -> port from the nginx sites and supervisor programs, conflicts
+    are reported and the first one found is kept
+    """
+    found = []
+    for path in sorted(glob.glob(os.path.join(nginx_dir, '*'))):
+        with open(path) as f:
+            match = ADDRESS.search(f.read())
+        if match:
+            found.append((os.path.basename(path), match))
+    for path in sorted(glob.glob(os.path.join(supervisor_dir, '*.conf'))):
+        with open(path) as f:
+            text = f.read()
+        programs = list(PROGRAM.finditer(text))
+        for i, program in enumerate(programs):
+            end = programs[i + 1].start() if i + 1 < len(programs) else None
+            match = ADDRESS.search(text, program.end(), end or len(text))
+            if match:
+                found.append((program.group(1), match))
+
+    registry = Registry()
+    for site, match in found:
+        try:
+            registry.add(site, match.group(1) or match.group(2))
+        except PortTaken as error:
+            print(f'{site}: {error}', file=sys.stderr)
+    return registry
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('registry')
+    commands = parser.add_subparsers(dest='command', required=True)
+    allocate = commands.add_parser('allocate')
+    allocate.add_argument('site')
+    allocate.add_argument('--port', type=int, help='claim this port')
+    allocate.add_argument('--low', type=int, default=LOW)
+    allocate.add_argument('--high', type=int, default=HIGH)
+    commands.add_parser('release').add_argument('site')
+    commands.add_parser('lookup').add_argument('key')
+    commands.add_parser('list')
+    rebuild = commands.add_parser('rebuild')
+    rebuild.add_argument('--nginx-dir', default=NGINX_DIR)
+    rebuild.add_argument('--supervisor-dir', default=SUPERVISOR_DIR)
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'allocate':
+            with locked(args.registry) as registry:
+                if args.port:
+                    registry.add(args.site, args.port)
+                    print(args.port)
+                else:
+                    print(registry.allocate(
+                        args.site, args.low, args.high, in_use=listening
+                    ))
+        elif args.command == 'release':
+            with locked(args.registry) as registry:
+                port = registry.remove(args.site)
+            if port is not None:
+                print(port)
+        elif args.command == 'lookup':
+            value = load(args.registry).lookup(args.key)
+            if value is None:
+                return 1
+            print(value)
+        elif args.command == 'list':
+            for port, site in sorted(load(args.registry).ports.items()):
+                print(f'{site} {port}')
+        elif args.command == 'rebuild':
+            with locked(args.registry) as registry:
+                scanned = scan(args.nginx_dir, args.supervisor_dir)
+                registry.sites, registry.ports = scanned.sites, scanned.ports
+            print(f'{len(registry.sites)} sites')
+    except PortTaken as error:
+        print(error, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+Remote state of a deploy host, probed in one round trip and cached
+"""
+
+import shlex
+import threading
+
+SECTIONS = ('paths', 'supervisor', 'nginx', 'ports', 'cpus')
+
+
+class SiteState:
+    """
+    What the tasks need to know about a host, as seen by a single probe
+
+    paths:      probed path -> whether it exists
+    supervisor: program -> state (RUNNING, STOPPED, ...)
+    nginx:      names in /etc/nginx/sites-enabled
+    ports:      TCP ports with a listening socket
+    cpus:       number of cores
+    """
+
+    def __init__(
+        self, paths=None, supervisor=None, nginx=None, ports=None, cpus=None
+    ):
+        self.paths = paths or {}
+        self.supervisor = supervisor
+        self.nginx = nginx
+        self.ports = ports
+        self.cpus = cpus
+
+    def exists(self, path):
+        """
+        True/False for a probed path, None if not known
+        """
+        return self.paths.get(path)
+
+    def running(self, program):
+        """
+        True/False from supervisor status, None if not known
+        """
+        if self.supervisor is None:
+            return None
+        return self.supervisor.get(program) == 'RUNNING'
+
+
+def probe_script(paths):
+    """
+    Shell script reporting on paths, supervisor, nginx and listening ports
+    """
+    lines = ['echo "--paths"']
+    lines += [
+        f'[ -e {shlex.quote(path)} ] && echo "1 {path}" || echo "0 {path}"'
+        for path in paths
+    ]
+    lines += [
+        'echo "--supervisor"',
+        'supervisorctl status 2>/dev/null',
+        'echo "--nginx"',
+        'ls -1 /etc/nginx/sites-enabled 2>/dev/null',
+        'echo "--ports"',
+        "ss -ltnH 2>/dev/null | awk '{print $4}' | sed 's/.*://'",
+        'echo "--cpus"',
+        'nproc 2>/dev/null',
+        ':',
+    ]
+    return '\n'.join(lines)
+
+
+def parse(output):
+    """
+    SiteState from the output of probe_script
+    """
+    state = SiteState(supervisor={}, nginx=set(), ports=set())
+    section = None
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith('--') and line[2:] in SECTIONS:
+            section = line[2:]
+        elif not line or section is None:
+            continue
+        elif section == 'paths':
+            flag, _, path = line.partition(' ')
+            state.paths[path] = flag == '1'
+        elif section == 'supervisor':
+            fields = line.split()
+            if len(fields) > 1:
+                state.supervisor[fields[0]] = fields[1]
+        elif section == 'nginx':
+            state.nginx.add(line)
+        elif section == 'ports' and line.isdigit():
+            state.ports.add(int(line))
+        elif section == 'cpus' and line.isdigit():
+            state.cpus = int(line)
+    return state
+
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def host_key(c):
+    return getattr(c, 'host', None)
+
+
+def store(c, state):
+    with _lock:
+        _cache[host_key(c)] = state
+    return state
+
+
+def cached(c):
+    """
+    The probed state of the host of c, None if not probed
+    """
+    with _lock:
+        return _cache.get(host_key(c))
+
+
+def forget(c, *paths, section=None):
+    """
+    Invalidate paths and/or a whole section after a task changed them
+    """
+    with _lock:
+        state = _cache.get(host_key(c))
+        if state is None:
+            return
+        for path in paths:
+            state.paths.pop(path, None)
+        if section == 'paths':
+            state.paths = {}
+        elif section is not None:
+            setattr(state, section, None)
+
+
+def clear():
+    with _lock:
+        _cache.clear()
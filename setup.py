@@ -2,4 +2,7 @@
 
 from setuptools import setup
 
-setup(py_modules=['fabfile', 'template'])
+setup(py_modules=[
+    'fabfile', 'template', 'parallel', 'batch', 'remote_state', 'benchmark',
+    'static_pipeline', 'port_registry', 'inventory', 'ssh_mux',
+])
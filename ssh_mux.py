@@ -0,0 +1,120 @@
+"""
+Shared OpenSSH master connections to the deploy hosts
+
+    python3 ssh_mux.py gateway <user> <host> [<port>]
+
+One master per user@host:port is kept open for a while after its last use
+(ControlPersist) and carries the following ssh sessions. git pushes run
+ssh with these options (GIT_SSH_COMMAND), and skip the handshake. Fabric
+speaks SSH through paramiko, which cannot join a master, so its
+connections are tunneled through it with ssh -W as a gateway (the
+FABRIC_GATEWAY environment variable, printed by this script while a
+master is running), which saves the TCP connect but not paramiko's own
+key exchange.
+"""
+
+import os
+import shlex
+import subprocess
+import sys
+
+CONTROL_DIR = os.path.join('~', '.ssh', 'flask-deploy')
+PERSIST = '10m'
+
+
+def control_path():
+    """
+    Socket path of the masters, %C being a hash of local host, remote
+    host, port and user; the directory is created if missing
+    """
+    directory = os.path.expanduser(CONTROL_DIR)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    return os.path.join(directory, '%C')
+
+
+def options(master='auto', persist=PERSIST):
+    return [
+        '-o', f'ControlMaster={master}',
+        '-o', f'ControlPath={control_path()}',
+        '-o', f'ControlPersist={persist}',
+    ]
+
+
+def ssh_command(persist=PERSIST):
+    """
+    ssh command line sharing the master, starting one if there is none
+    """
+    return shlex.join(['ssh', *options(persist=persist)])
+
+
+def gateway(user):
+    """
+    Fabric gateway (ProxyCommand) tunneling to sshd through the master of
+    user@host, or connecting directly if there is none
+    """
+    return shlex.join(
+        ['ssh', *options(master='no'), '-p', '%p', '-W', 'localhost:%p',
+         f'{user}@%h']
+    )
+
+
+def target(host, user=None, port=None):
+    args = [f'{user}@{host}' if user else host]
+    if port:
+        args[:0] = ['-p', str(port)]
+    return args
+
+
+def start(host, user=None, port=None, persist=PERSIST):
+    """
+    Command starting a master in the background
+    """
+    return [
+        'ssh', *options(master='yes', persist=persist), '-N', '-f',
+        *target(host, user, port),
+    ]
+
+
+def control(command, host, user=None, port=None):
+    """
+    Command sending check or exit to the master of host
+    """
+    return [
+        'ssh', '-o', f'ControlPath={control_path()}', '-O', command,
+        *target(host, user, port),
+    ]
+
+
+def running(host, user=None, port=None):
+    """
+    Whether a master for user@host:port is up
+    """
+    return subprocess.run(
+        control('check', host, user, port), capture_output=True
+    ).returncode == 0
+
+
+def open_master(host, user=None, port=None, persist=PERSIST):
+    # not through pipes: the master stays in the background holding them
+    subprocess.run(start(host, user, port, persist=persist), check=True)
+
+
+def close_master(host, user=None, port=None):
+    subprocess.run(control('exit', host, user, port), check=True)
+
+
+def main(argv=None):
+    args = sys.argv[1:] if argv is None else argv
+    if not 3 <= len(args) <= 4 or args[0] != 'gateway':
+        print(__doc__.splitlines()[3].strip(), file=sys.stderr)
+        return 2
+    _, user, host, *port = args
+    # without the directory no master runs, and it is not created
+    directory = os.path.expanduser(CONTROL_DIR)
+    if os.path.isdir(directory) and running(host, user, *port):
+        print(gateway(user))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+"""
+Fingerprint and pre-compress the static files of a release
+
+    python3 static_pipeline.py <static dir> [--previous <static dir>]
+
+Next to each file it writes a copy named by its content hash
+(app.css -> app.<hash>.css) and .gz/.br siblings for nginx gzip_static,
+and lists the hashed names in manifest.json. Files whose hash is in the
+manifest of the previous release are hard linked from there instead of
+being compressed again. Runs with the standard library only, .br files
+need the brotli package.
+"""
+
+import argparse
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = 'manifest.json'
+HASH_LENGTH = 12
+HASHED = re.compile(fr'\.[0-9a-f]{{{HASH_LENGTH}}}(\.[^./]+)?$')
+COMPRESSIBLE = {
+    '.css', '.js', '.mjs', '.json', '.html', '.htm', '.txt', '.xml', '.svg',
+    '.map', '.ico', '.wasm', '.ttf', '.otf', '.eot',
+}
+MIN_SIZE = 256
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+def hashed_name(name, digest):
+    stem, ext = os.path.splitext(name)
+    return f'{stem}.{digest}{ext}'
+
+
+def is_output(name):
+    """
+    Files written by the pipeline, not to be processed again
+    """
+    if name == MANIFEST or name.endswith(('.gz', '.br')):
+        return True
+    return bool(HASHED.search(name))
+
+
+def sources(static_dir):
+    """
+    Paths relative to static_dir of the files to process
+    """
+    for root, dirs, files in os.walk(static_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if not is_output(name):
+                path = os.path.join(root, name)
+                yield os.path.relpath(path, static_dir).replace(os.sep, '/')
+
+
+def read_manifest(static_dir):
+    try:
+        with open(os.path.join(static_dir, MANIFEST)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def compress(path):
+    """
+    Write path.gz and path.br where compressing saves space, return the
+    suffixes written
+    """
+    if os.path.splitext(path)[1].lower() not in COMPRESSIBLE:
+        return []
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < MIN_SIZE:
+        return []
+    written = []
+    encoded = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        encoded['.br'] = brotli.compress(data, quality=11)
+    for suffix, body in encoded.items():
+        if len(body) < len(data):
+            with open(path + suffix, 'wb') as f:
+                f.write(body)
+            written.append(suffix)
+    return written
+
+
+def link_or_copy(source, target):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def reuse(previous_dir, name, target_dir, suffixes):
+    """
+    Hard link a hashed file and its compressed siblings from a previous
+    build, False if any of them is missing
+    """
+    if not previous_dir:
+        return False
+    names = [name] + [name + suffix for suffix in suffixes]
+    if not all(os.path.isfile(os.path.join(previous_dir, n)) for n in names):
+        return False
+    for n in names:
+        link_or_copy(
+            os.path.join(previous_dir, n), os.path.join(target_dir, n)
+        )
+    return True
+
+
+def build(static_dir, previous_dir=None):
+    """
+    Process static_dir, return the manifest and the number of files that
+    had to be compressed
+    """
+    old = read_manifest(static_dir)
+    previous = read_manifest(previous_dir) if previous_dir else {}
+    manifest = {}
+    processed = 0
+
+    for name in sources(static_dir):
+        source = os.path.join(static_dir, name)
+        hashed = hashed_name(name, file_hash(source))
+        target = os.path.join(static_dir, hashed)
+        if name in old and old[name]['file'] == hashed and \
+                os.path.isfile(target):
+            compressed = old[name]['compressed']
+        elif name in previous and previous[name]['file'] == hashed and \
+                reuse(previous_dir, hashed, static_dir,
+                      previous[name]['compressed']):
+            compressed = previous[name]['compressed']
+        else:
+            link_or_copy(source, target)
+            compressed = compress(target)
+            processed += 1
+        # the unhashed name gets the same siblings
+        for suffix in ('.gz', '.br'):
+            if suffix in compressed:
+                link_or_copy(target + suffix, source + suffix)
+            else:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(source + suffix)
+        manifest[name] = {'file': hashed, 'compressed': compressed}
+
+    for name, entry in old.items():
+        if manifest.get(name, {}).get('file') != entry['file']:
+            stale = os.path.join(static_dir, entry['file'])
+            for suffix in ['', *entry['compressed']]:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(stale + suffix)
+
+    path = os.path.join(static_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+    return manifest, processed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('static_dir')
+    parser.add_argument('--previous', help='static dir of the last release')
+    args = parser.parse_args(argv)
+    previous = args.previous
+    if previous and os.path.realpath(previous) == \
+            os.path.realpath(args.static_dir):
+        previous = None
+    manifest, processed = build(args.static_dir, previous)
+    print(f'static: {len(manifest)} files, {processed} processed')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,386 @@
+import re
 from string import Template
 NGINX = """\
-server {{
+{upstream}server {{
     server_name {server_name};
-    location / {{
-        proxy_pass http://localhost:{port};
+{server}    location / {{
+        proxy_pass {proxy_pass};
         proxy_set_header Host $host;
         proxy_set_header X-Real-IP $remote_addr;
-    }}
-    location /static {{
+{proxy}    }}
+{locations}    location /static {{
         alias  {root}/sites/{server_name}/static/;
-    }}
+{static}    }}
 }}
 """
 
+NGINX_UPSTREAM = """\
+upstream {upstream} {{
+    server {server};
+    keepalive {keepalive};
+}}
+
+"""
+
+NGINX_CACHE_PATH = """\
+proxy_cache_path /var/cache/nginx/{upstream} levels=1:2 keys_zone={upstream}_cache:10m max_size=100m inactive=10m use_temp_path=off;
+
+"""
+
+NGINX_MICRO_CACHE = """\
+location {path} {{
+    proxy_pass {proxy_pass};
+    proxy_set_header Host $host;
+    proxy_set_header X-Real-IP $remote_addr;
+{proxy}    proxy_cache {upstream}_cache;
+    proxy_cache_valid 200 {ttl};
+    proxy_cache_use_stale updating error timeout http_500 http_502 http_503 http_504;
+    proxy_cache_background_update on;
+    proxy_cache_lock on;
+    add_header X-Cache-Status $upstream_cache_status;
+}}
+"""
+
+NGINX_METRICS = """\
+location = /metrics {{
+    allow 127.0.0.1;
+    allow ::1;
+    deny all;
+    proxy_pass {proxy_pass};
+{proxy}}}
+"""
+
+NGINX_REQUEST_START = """\
+proxy_set_header X-Request-Start "t=${msec}";
+"""
+
+NGINX_KEEPALIVE = """\
+proxy_http_version 1.1;
+proxy_set_header Connection "";
+"""
+
+NGINX_SENDFILE = """\
+sendfile on;
+tcp_nopush on;
+"""
+
+COMPRESSED_TYPES = (
+    "text/plain text/css text/xml application/json application/javascript"
+    " application/xml image/svg+xml"
+)
+
+NGINX_GZIP = f"""\
+gzip on;
+gzip_comp_level 5;
+gzip_min_length 256;
+gzip_proxied any;
+gzip_vary on;
+gzip_types {COMPRESSED_TYPES};
+"""
+
+NGINX_BROTLI = f"""\
+brotli on;
+brotli_comp_level 5;
+brotli_types {COMPRESSED_TYPES};
+"""
+
+NGINX_OPEN_FILE_CACHE = """\
+open_file_cache max=1000 inactive=60s;
+open_file_cache_valid 60s;
+open_file_cache_min_uses 2;
+"""
+
+NGINX_EXPIRES = """\
+expires {expires};
+add_header Cache-Control "public";
+"""
+
+# names written by static_pipeline.py: <stem>.<12 hex digits>.<ext>
+NGINX_ASSET_MAPS = """\
+map $uri ${name}_static_expires {{
+    "~\\.[0-9a-f]{{12}}\\.[^./]+$" max;
+    default {expires};
+}}
+
+map $uri ${name}_static_cache {{
+    "~\\.[0-9a-f]{{12}}\\.[^./]+$" "public, immutable";
+    default "public";
+}}
+
+"""
+
+NGINX_ASSETS = """\
+expires ${name}_static_expires;
+add_header Cache-Control ${name}_static_cache;
+gzip_static on;
+"""
+
+
+def indent(block, level):
+    return "".join(
+        " " * 4 * level + line + "\n" for line in block.splitlines()
+    )
+
+
+def nginx_config(
+    server_name, root, port,
+    keepalive=32,
+    gzip=True,
+    brotli=False,
+    expires="30d",
+    sendfile=True,
+    open_file_cache=False,
+    micro_cache=(),
+    cache_ttl="1s",
+    metrics=False,
+    assets=False,
+    socket="",
+):
+    """
+    nginx site config, each tuning block switched by its option
+
+    micro_cache lists path prefixes whose responses nginx caches for
+    cache_ttl, serving stale entries while one request refreshes them.
+    metrics passes the request start time on to the app and only lets
+    localhost read /metrics. assets serves the .gz/.br files written by
+    static_pipeline.py and lets clients keep fingerprinted names forever.
+    With socket the app is reached on that Unix socket instead of port.
+    """
+    # upstream, cache zone and variable names only take [A-Za-z0-9_]
+    name = re.sub(r"[^A-Za-z0-9_]", "_", server_name)
+    upstream = ""
+    proxy = ""
+    address = f"unix:{socket}" if socket else f"localhost:{port}"
+    proxy_pass = f"http://{address}" + (":" if socket else "")
+    if keepalive:
+        upstream = NGINX_UPSTREAM.format(
+            upstream=name, server=address, keepalive=keepalive
+        )
+        proxy_pass = f"http://{name}"
+        proxy = indent(NGINX_KEEPALIVE, 2)
+
+    server = ""
+    if sendfile:
+        server += indent(NGINX_SENDFILE, 1)
+    if gzip:
+        server += indent(NGINX_GZIP, 1)
+    if brotli:
+        server += indent(NGINX_BROTLI, 1)
+    if open_file_cache:
+        server += indent(NGINX_OPEN_FILE_CACHE, 1)
+
+    locations = ""
+    if metrics:
+        proxy += indent(NGINX_REQUEST_START, 2)
+        locations += indent(
+            NGINX_METRICS.format(
+                proxy_pass=proxy_pass,
+                proxy=indent(NGINX_KEEPALIVE, 1) if keepalive else "",
+            ),
+            1,
+        )
+    if micro_cache:
+        upstream = NGINX_CACHE_PATH.format(upstream=name) + upstream
+        for path in micro_cache:
+            locations += indent(
+                NGINX_MICRO_CACHE.format(
+                    path=path,
+                    proxy_pass=proxy_pass,
+                    proxy=indent(NGINX_KEEPALIVE, 1) if keepalive else "",
+                    upstream=name,
+                    ttl=cache_ttl,
+                ),
+                1,
+            )
+
+    static = ""
+    if assets:
+        upstream = NGINX_ASSET_MAPS.format(
+            name=name, expires=expires or "off"
+        ) + upstream
+        static = indent(NGINX_ASSETS.format(name=name), 2)
+        if brotli:
+            static += indent("brotli_static on;", 2)
+    elif expires:
+        static = indent(NGINX_EXPIRES.format(expires=expires), 2)
+
+    return NGINX.format(
+        upstream=upstream,
+        server_name=server_name,
+        server=server,
+        proxy_pass=proxy_pass,
+        proxy=proxy,
+        locations=locations,
+        root=root,
+        static=static,
+    )
+
 SUPERVISOR = {}
 
 SUPERVISOR["flask"] = """\
 [program:{program}]
-command = {bin}/gunicorn {module}:{app} -b localhost:{port}
+command = {bin}/gunicorn {module}:{app} -b {bind} --chdir {src} {options}
 directory = {src}
 user = {user}
 """
 
 SUPERVISOR["fastapi"] = """\
 [program:{program}]
-command = {bin}/uvicorn {module}:{app} --port {port}
+command = {bin}/uvicorn {module}:{app} {bind} --app-dir {src} {options}
 directory = {src}
 user = {user}
 """
 
+WORKER_CLASSES = ("sync", "gthread", "gevent", "uvicorn.workers.UvicornWorker")
+ASYNC_WORKERS = ("gevent", "uvicorn.workers.UvicornWorker", "uvicorn")
+
+
+def auto_workers(worker_class, cpus):
+    """
+    Default worker count: 2 x cores + 1 for blocking workers, one per core
+    for event loop workers
+    """
+    if worker_class in ASYNC_WORKERS:
+        return max(cpus, 1)
+    return 2 * max(cpus, 1) + 1
+
+
+def gunicorn_options(
+    worker_class="sync", workers=1, threads=1, keepalive=2,
+    max_requests=0, max_requests_jitter=0, preload=False, umask=None,
+):
+    if worker_class not in WORKER_CLASSES:
+        raise ValueError(f"Unknown worker class {worker_class}")
+    options = [f"-w {workers}"]
+    if worker_class != "sync":
+        options.append(f"-k {worker_class}")
+    if threads > 1:
+        options.append(f"--threads {threads}")
+    if keepalive != 2:
+        options.append(f"--keep-alive {keepalive}")
+    if max_requests:
+        options.append(f"--max-requests {max_requests}")
+        if max_requests_jitter:
+            options.append(f"--max-requests-jitter {max_requests_jitter}")
+    if preload:
+        options.append("--preload")
+    if umask is not None:
+        options.append(f"--umask {umask:#o}")
+    return " ".join(options)
+
+
+def uvicorn_options(workers=1, keepalive=5, max_requests=0):
+    options = [f"--workers {workers}"]
+    if keepalive != 5:
+        options.append(f"--timeout-keep-alive {keepalive}")
+    if max_requests:
+        options.append(f"--limit-max-requests {max_requests}")
+    return " ".join(options)
+
+
+def supervisor_environment(variables):
+    """
+    Supervisor environment line for a program, empty if no variables
+    """
+    if not variables:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in variables.items())
+    return f"environment = {pairs}\n"
+
+
+POST_RECEIVE = """\
+#!/bin/sh
+# Check out the pushed branch into a new release and switch src to it
+set -e
+SITE_DIR={site_dir}
+STATIC={static}
+ZERO=0000000000000000000000000000000000000000
+oldrev=$ZERO
+newrev=
+while read -r old new ref; do
+    if [ "$ref" = refs/heads/{branch} ]; then
+        oldrev=$old
+        newrev=$new
+    fi
+done
+if [ -z "$newrev" ] || [ "$newrev" = $ZERO ]; then
+    exit 0
+fi
+
+RELEASE=$SITE_DIR/releases/$(date +%Y%m%d%H%M%S)
+CURRENT=$(readlink -f $SITE_DIR/src || :)
+
+# start from the current release if it is the old revision and no
+# submodule moved, then only the files in the diff are checked out
+if [ "$oldrev" != $ZERO ] && [ -d "$CURRENT" ] \\
+    && [ "$(cat $CURRENT/.revision 2>/dev/null)" = "$oldrev" ] \\
+    && ! git diff --raw --no-renames $oldrev $newrev | grep -Eq '^:(160000|[0-7]+ 160000) '
+then
+    cp -al $CURRENT $RELEASE
+    rm -f $RELEASE/.revision $RELEASE/.changed
+    git diff --name-only --no-renames --diff-filter=D -z $oldrev $newrev \\
+        | (cd $RELEASE && xargs -0r rm -f --)
+    git diff --name-only --no-renames --diff-filter=d -z $oldrev $newrev \\
+        | GIT_WORK_TREE=$RELEASE xargs -0r git checkout -f $newrev --
+    CHANGED=$(git diff --name-only --no-renames $oldrev $newrev)
+    echo "$(echo "$CHANGED" | grep -c .) files checked out"
+    categories=
+    if echo "$CHANGED" | grep -qx requirements.txt; then
+        categories="$categories requirements"
+    fi
+    if echo "$CHANGED" | grep -q "^$STATIC/"; then
+        categories="$categories static"
+    fi
+    if echo "$CHANGED" | grep -v "^$STATIC/" | grep -vx requirements.txt \\
+        | grep -q .; then
+        categories="$categories code"
+    fi
+else
+    mkdir -p $RELEASE
+    GIT_WORK_TREE=$RELEASE git checkout {branch} --recurse-submodules -f
+    categories="requirements static code"
+fi
+echo $newrev > $RELEASE/.revision
+echo "changed:${{categories:- nothing}}"
+echo $categories > $RELEASE/.changed
+changed() {{
+    case " $categories " in *" $1 "*) return 0 ;; esac
+    return 1
+}}
+
+if changed requirements && [ -f $RELEASE/requirements.txt ]; then
+{venv_script}
+    rm -f $RELEASE/.venv-hash
+    echo $hash > $RELEASE/.venv-hash
+fi
+# byte-compile in parallel so new workers do not on their first requests
+if changed code; then
+    $SITE_DIR/venv{version}/bin/python -m compileall -q -j 0 $RELEASE || :
+fi
+
+# fingerprint and pre-compress static files, reusing the last release's
+if changed static && [ -d $RELEASE/$STATIC ] \\
+    && [ -f $SITE_DIR/static_pipeline.py ]; then
+    $SITE_DIR/venv{version}/bin/python $SITE_DIR/static_pipeline.py \\
+        $RELEASE/$STATIC --previous $SITE_DIR/src/$STATIC || :
+fi
+
+# a work tree from before releases is kept as the oldest release
+if [ -d $SITE_DIR/src ] && [ ! -L $SITE_DIR/src ]; then
+    mv $SITE_DIR/src $SITE_DIR/releases/00000000000000
+fi
+ln -sfn $RELEASE $SITE_DIR/src.new
+mv -T $SITE_DIR/src.new $SITE_DIR/src
+echo "src -> $RELEASE"
+
+current=$(readlink -f $SITE_DIR/src)
+ls -1d $SITE_DIR/releases/* | head -n -{keep} | while read -r old; do
+    [ "$old" = "$current" ] || rm -rf "$old"
+done
+for venv in $SITE_DIR/venvs/*; do
+    [ -d "$venv" ] || continue
+    [ "$venv" = "$(readlink -f $SITE_DIR/venv{version})" ] && continue
+    grep -qsx "$(basename $venv)" $SITE_DIR/releases/*/.venv-hash \\
+        || rm -rf "$venv" "$venv.lock"
+done
+"""
@@ -0,0 +1,83 @@
+import asyncio
+import socket
+import sys
+import time
+
+import pytest
+
+from benchmark import Client, local_server
+from flask_project.asgi import application
+
+
+def call(path, query_string=b'', method='GET'):
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': query_string}
+    asyncio.run(application(scope, receive, send))
+    return sent[0]['status'], sent[1]['body']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_routes():
+    assert call('/') == (200, b'ASGI is running!')
+    assert call('/data')[1].startswith(b'{"first_names":["Jonny"')
+    assert call('/sleep', b'ms=1') == (200, b'slept 1 ms')
+    assert call('/fan-out', b'n=3') == (200, b'3 calls')
+    assert call('/sleep', b'ms=x')[0] == 400
+    assert call('/nowhere')[0] == 404
+    assert call('/', method='POST')[0] == 405
+
+
+def test_fan_out_concurrent():
+    start = time.perf_counter()
+    call('/fan-out', b'n=50')
+    assert time.perf_counter() - start < 1
+
+
+async def concurrent_sleeps(url, n):
+    clients = [Client(url) for _ in range(n)]
+    try:
+        return await asyncio.gather(
+            *(client.get('/sleep?ms=300') for client in clients)
+        )
+    finally:
+        for client in clients:
+            await client.close()
+
+
+@pytest.mark.parametrize('server', ['uvicorn', 'gunicorn'])
+def test_boot(server):
+    pytest.importorskip('uvicorn')
+    port = free_port()
+    if server == 'uvicorn':
+        command = [
+            sys.executable, '-m', 'uvicorn', 'flask_project.asgi:app',
+            '--port', str(port), '--workers', '2',
+        ]
+    else:
+        command = [
+            sys.executable, '-m', 'gunicorn', 'flask_project.asgi:app',
+            '-b', f'127.0.0.1:{port}', '-w', '2',
+            '-k', 'uvicorn.workers.UvicornWorker',
+        ]
+    with local_server(command, port, timeout=30):
+        start = time.perf_counter()
+        statuses = asyncio.run(
+            concurrent_sleeps(f'http://127.0.0.1:{port}', 100)
+        )
+        elapsed = time.perf_counter() - start
+    assert statuses == [200] * 100
+    # 100 requests of 300 ms each on 2 workers
+    assert elapsed < 3
@@ -0,0 +1,93 @@
+import subprocess
+from unittest.mock import MagicMock
+
+import pytest
+from invoke import Result
+from invoke.exceptions import UnexpectedExit
+
+from batch import Batch, BatchError, script
+
+
+def sh(command, **kwargs):
+    """
+    Stand-in for c.run executing locally
+    """
+    proc = subprocess.run(command, shell=True, capture_output=True, text=True)
+    result = Result(
+        stdout=proc.stdout, stderr=proc.stderr, exited=proc.returncode,
+        command=command,
+    )
+    if proc.returncode:
+        raise UnexpectedExit(result)
+    return result
+
+
+def test_single_command_unwrapped():
+    assert script(['supervisorctl reread']) == 'supervisorctl reread'
+
+
+def test_one_round_trip():
+    c = MagicMock()
+    with Batch(c, sudo=True) as batch:
+        batch.run('supervisorctl reread')
+        batch.run('supervisorctl update')
+    c.sudo.assert_called_once_with(
+        script(['supervisorctl reread', 'supervisorctl update'])
+    )
+    c.run.assert_not_called()
+
+
+def test_empty_batch():
+    c = MagicMock()
+    with Batch(c):
+        pass
+    c.run.assert_not_called()
+
+
+def test_no_flush_on_exception():
+    c = MagicMock()
+    with pytest.raises(RuntimeError):
+        with Batch(c) as batch:
+            batch.run('rm -rf /tmp/foo')
+            raise RuntimeError
+    c.run.assert_not_called()
+
+
+def test_runs_in_order():
+    results = []
+    c = MagicMock()
+    c.run.side_effect = lambda command: results.append(sh(command))
+    with Batch(c) as batch:
+        batch.run('echo one')
+        batch.run('echo two && echo three')
+        batch.run('echo four')
+    (flushed,), _ = c.run.call_args
+    assert c.run.call_count == 1
+    assert flushed.index('echo one') < flushed.index('echo two && echo three') \
+        < flushed.index('echo four')
+    assert [result.stdout for result in results] == ['one\ntwo\nthree\nfour\n']
+
+
+def test_stops_at_first_failure(tmp_path):
+    c = MagicMock()
+    c.run.side_effect = sh
+    with pytest.raises(BatchError) as info:
+        with Batch(c) as batch:
+            batch.run(f'touch {tmp_path}/a')
+            batch.run('(exit 3)')
+            batch.run(f'touch {tmp_path}/b')
+    assert info.value.index == 2
+    assert info.value.command == '(exit 3)'
+    assert info.value.result.exited == 3
+    assert (tmp_path / 'a').exists()
+    assert not (tmp_path / 'b').exists()
+
+
+def test_single_failure():
+    c = MagicMock()
+    c.run.side_effect = sh
+    with pytest.raises(BatchError) as info:
+        with Batch(c) as batch:
+            batch.run('false')
+    assert info.value.index == 1
+    assert info.value.command == 'false'
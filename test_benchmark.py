@@ -0,0 +1,154 @@
+import http.server
+import socket
+import sys
+import threading
+
+import pytest
+
+from benchmark import (
+    percentile, summary, run, local_server, server_command, matrix, ranked,
+    table,
+)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        status = 404 if self.path == '/missing' else 200
+        body = self.path.encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([7], 99) == 7
+    assert percentile([], 50) is None
+
+
+def test_summary_ms():
+    assert summary([0.002, 0.001, 0.003]) == {
+        'requests': 3, 'p50': 2.0, 'p95': 3.0, 'p99': 3.0, 'max': 3.0
+    }
+
+
+def test_run(server):
+    results = run(
+        server, concurrency=4, duration=0.5, routes=['/', '/missing'],
+        warmup=0.1,
+    )
+    assert results['errors'] == 0
+    assert results['rps'] > 0
+    assert set(results['statuses']) == {'200', '404'}
+    assert results['latency_ms']['requests'] == sum(
+        r['requests'] for r in results['routes_latency_ms'].values()
+    )
+    assert results['latency_ms']['p50'] <= results['latency_ms']['p99']
+
+
+def test_run_nothing_listening():
+    results = run(
+        f'http://127.0.0.1:{free_port()}', concurrency=2, duration=0.2,
+        warmup=0,
+    )
+    assert results['rps'] == 0
+    assert results['errors'] > 0
+    assert results['latency_ms']['p50'] is None
+
+
+def test_local_server():
+    port = free_port()
+    command = [sys.executable, '-m', 'http.server', str(port),
+               '--bind', '127.0.0.1']
+    with local_server(command, port) as proc:
+        assert proc.poll() is None
+        results = run(
+            f'http://127.0.0.1:{port}', concurrency=2, duration=0.2, warmup=0
+        )
+        assert results['statuses'].get('200')
+    assert proc.poll() is not None
+
+
+def test_local_server_exits():
+    command = [sys.executable, '-c', 'raise SystemExit(3)']
+    with pytest.raises(RuntimeError):
+        with local_server(command, free_port()):
+            pass
+
+
+def test_server_command_gthread():
+    command = server_command('gthread', 'flask_project', 'app', 8765,
+                             workers=2, keepalive=5, threads=8)
+    assert command[1:] == [
+        '-m', 'gunicorn', 'flask_project:app', '-b', '127.0.0.1:8765',
+        '-w', '2', '-k', 'gthread', '--threads', '8', '--keep-alive', '5',
+    ]
+
+
+def test_server_command_uvicorn():
+    command = server_command('uvicorn', 'flask_project', 'app', 8765,
+                             workers=4, keepalive=2)
+    assert command[1:] == [
+        '-m', 'uvicorn', 'flask_project:app', '--host', '127.0.0.1',
+        '--port', '8765', '--interface', 'wsgi', '--log-level', 'warning',
+        '--workers', '4', '--timeout-keep-alive', '2',
+    ]
+
+
+def test_matrix():
+    configs = matrix(['sync', 'gevent'], [1, 2], [2, 5])
+    assert {'server': 'gevent', 'workers': 2, 'keepalive': 5} in configs
+    assert [c for c in configs if c['server'] == 'sync'] == [
+        {'server': 'sync', 'workers': 1, 'keepalive': 2},
+        {'server': 'sync', 'workers': 2, 'keepalive': 2},
+    ]
+    with pytest.raises(ValueError):
+        matrix(['tornado'], [1], [2])
+
+
+def test_ranked_table():
+    latency = {'requests': 1, 'p50': 1.0, 'p95': 2.0, 'p99': 3.0, 'max': 3.0}
+    results = [
+        {'server': 'sync', 'workers': 1, 'keepalive': 2, 'rps': 100.0,
+         'errors': 0, 'latency_ms': latency},
+        {'server': 'gevent', 'workers': 1, 'keepalive': 2,
+         'error': 'Server exited with 1'},
+        {'server': 'gthread', 'workers': 2, 'keepalive': 2, 'rps': 300.0,
+         'errors': 0, 'latency_ms': latency},
+    ]
+    assert [r['server'] for r in ranked(results)] == [
+        'gthread', 'sync', 'gevent'
+    ]
+    lines = table(results).splitlines()
+    assert lines[0].split() == [
+        '#', 'server', 'workers', 'keepalive', 'rps', 'p50', 'p95', 'p99',
+        'errors',
+    ]
+    assert lines[1].split()[:5] == ['1', 'gthread', '2', '2', '300.0']
+    assert lines[3].endswith('Server exited with 1')
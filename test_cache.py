@@ -0,0 +1,92 @@
+import pytest
+from flask import Flask, jsonify
+
+from flask_project.cache import LRUCache, cached
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.calls = 0
+
+    @app.route('/data', methods=['GET', 'POST'])
+    @cached(ttl=60, max_age=30)
+    def data():
+        app.calls += 1
+        return jsonify(n=app.calls)
+
+    @app.route('/login')
+    @cached()
+    def login():
+        app.calls += 1
+        response = jsonify(n=app.calls)
+        response.set_cookie('session', str(app.calls))
+        return response
+
+    @app.route('/missing')
+    @cached()
+    def missing():
+        app.calls += 1
+        return 'no', 404
+
+    return app
+
+
+def test_memoized(app):
+    client = app.test_client()
+    first = client.get('/data')
+    second = client.get('/data')
+    assert app.calls == 1
+    assert first.get_data() == second.get_data()
+    assert first.headers['ETag'] == second.headers['ETag']
+    assert first.headers['Content-Type'] == 'application/json'
+    assert first.headers['Cache-Control'] == 'public, max-age=30'
+    client.get('/data?page=2')
+    assert app.calls == 2
+
+
+def test_not_modified(app):
+    client = app.test_client()
+    etag = client.get('/data').headers['ETag']
+    assert not etag.startswith('W/')
+    response = client.get('/data', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    assert response.headers['ETag'] == etag
+    assert client.get(
+        '/data', headers={'If-None-Match': '"other"'}
+    ).status_code == 200
+
+
+def test_only_get_and_success(app):
+    client = app.test_client()
+    client.post('/data')
+    client.post('/data')
+    client.get('/missing')
+    assert client.get('/missing').status_code == 404
+    assert app.calls == 4
+
+
+def test_not_shared(app):
+    client = app.test_client()
+    first = client.get('/login')
+    second = client.get('/login')
+    assert app.calls == 2
+    assert first.headers['Set-Cookie'] != second.headers['Set-Cookie']
+    assert 'Cache-Control' not in second.headers
+    client.get('/data', headers={'Authorization': 'Bearer x'})
+    client.get('/data', headers={'Authorization': 'Bearer y'})
+    assert app.calls == 4
+
+
+def test_lru_ttl():
+    now = [0.0]
+    cache = LRUCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    now[0] = 10
+    assert cache.get('a') is None
@@ -2,6 +2,9 @@ from unittest.mock import patch, call, MagicMock
 import textwrap
 
 import fabfile
+import port_registry
+import remote_state
+from batch import script
 
 
 @patch('fabfile.DEPLOY_ROOT', '/www')
@@ -12,8 +15,14 @@ import fabfile
 @patch('fabfile.exists')
 class TestFab:
 
+    hup = (
+        'sh -c \'pgrep -P "$(supervisorctl pid foo.bar)" || :;'
+        ' supervisorctl signal HUP foo.bar >&2\''
+    )
+
     def setup(self):
         self.c = MagicMock()
+        remote_state.clear()
 
     def test_hello(self, *args):
         fabfile.hello(self.c)
@@ -29,16 +38,44 @@ class TestFab:
 
     def test_install_venv(self, *args):
         fabfile.install_venv(self.c, 'foo.bar', version="3.8")
-        self.c.run.assert_called_once_with(textwrap.dedent(
+        self.c.run.assert_called_once_with(fabfile.venv_script(
+            'foo.bar', '3.8', '/www/sites/foo.bar/requirements.txt'
+        ) + textwrap.dedent(
             """\
-            python3.8 -m venv /www/sites/foo.bar/venv3.8
-            /www/sites/foo.bar/venv3.8/bin/python -m pip install --upgrade pip setuptools
-            /www/sites/foo.bar/venv3.8/bin/python -m pip install -r /www/sites/foo.bar/requirements.txt
             echo source /www/sites/foo.bar/venv3.8/bin/activate > /www/sites/foo.bar/.envrc
             echo export GIT_DIR=/www/sites/foo.bar/git >> /www/sites/foo.bar/.envrc
             echo export GIT_WORK_TREE=/www/sites/foo.bar/src >> /www/sites/foo.bar/.envrc
+            echo unset PS1 >> /www/sites/foo.bar/.envrc
             """
         ))
+
+    def test_venv_script(self, *args):
+        script = fabfile.venv_script(
+            'foo.bar', '3.8', '/www/sites/foo.bar/requirements.txt'
+        )
+        assert (
+            '(cat /www/sites/foo.bar/requirements.txt; python3.8 -VV)'
+            in script
+        )
+        assert 'venv=/www/sites/foo.bar/venvs/$hash' in script
+        assert (
+            'ln -sfn $venv /www/sites/foo.bar/venv3.8.new'
+            ' && mv -T /www/sites/foo.bar/venv3.8.new /www/sites/foo.bar/venv3.8'
+            in script
+        )
+        assert (
+            'pip install -q --no-index --find-links /www/wheelhouse'
+            ' -r /www/sites/foo.bar/requirements.txt' in script
+        )
+        assert 'ls -1t /www/wheelhouse/*.whl | tail -n +201' in script
+        assert '$venv/bin/python -m compileall -qq -j 0 $venv' in script
+        assert script.count(') 9>/www/wheelhouse/.lock') == 2
+        assert 'exec 8>$venv.lock\n    flock 8\n' in script
+        assert 'done > $venv/.wheels' in script
+        # reused venvs touch their wheels too, before the pruning
+        assert script.index('xargs -r touch -c < $venv/.wheels') \
+            > script.index('[ -f $venv/.complete ] || exit 1')
+
 #######
 # git #
 #######
@@ -66,12 +103,42 @@ class TestFab:
         fabfile.configure_git(self.c, 'foo.bar')
 
         post_receive_file = '/www/sites/foo.bar/git/hooks/post-receive'
-        post_receive_cmd = "#!/bin/sh\nGIT_WORK_TREE=/www/sites/foo.bar/src git checkout master --recurse-submodules -f"
         self.c.run.assert_has_calls([
             call('git init --bare /www/sites/foo.bar/git'),
-            call('echo "%s" > %s' % (post_receive_cmd, post_receive_file)),
             call(f'chmod +x {post_receive_file}')
         ])
+        assert self.c.put.call_args.args[1] == post_receive_file
+
+    def test_install_hook(self, *args):
+        fabfile.install_hook(self.c, 'foo.bar', branch='main', keep=3)
+        hook, target = self.c.put.call_args.args
+        script = hook.getvalue()
+        assert target == '/www/sites/foo.bar/git/hooks/post-receive'
+        assert script.startswith('#!/bin/sh\n')
+        assert 'SITE_DIR=/www/sites/foo.bar\n' in script
+        assert 'RELEASE=$SITE_DIR/releases/$(date' in script
+        assert (
+            'GIT_WORK_TREE=$RELEASE git checkout main --recurse-submodules -f'
+            in script
+        )
+        assert 'cat $RELEASE/requirements.txt' in script
+        assert 'mv -T $SITE_DIR/src.new $SITE_DIR/src' in script
+        assert 'head -n -3' in script
+        assert 'STATIC=app/static\n' in script
+        assert '/bin/python -m compileall -q -j 0 $RELEASE' in script
+        assert 'cp -al $CURRENT $RELEASE\n' in script
+        assert (
+            '| GIT_WORK_TREE=$RELEASE xargs -0r git checkout -f $newrev --\n'
+            in script
+        )
+        assert (
+            '$SITE_DIR/static_pipeline.py \\\n'
+            '        $RELEASE/$STATIC --previous $SITE_DIR/src/$STATIC'
+            in script
+        )
+        assert self.c.put.call_args_list[0].args[1] == \
+            '/www/sites/foo.bar/static_pipeline.py'
+        self.c.run.assert_called_once_with(f'chmod +x {target}')
 
     def test_remote_git_dir(self, *args):
         assert fabfile.remote_git_dir('foo.bar') == '/www/sites/foo.bar/git'
@@ -111,6 +178,15 @@ class TestFab:
             shell=True
         )
 
+    def test_change_categories(self, *args):
+        assert fabfile.change_categories([]) == []
+        assert fabfile.change_categories(
+            ['app/views.py', 'app/static/app.css', 'requirements.txt']
+        ) == ['requirements', 'static', 'code']
+        assert fabfile.change_categories(
+            ['site/static/app.css', 'app/static/app.css'], static='site/static'
+        ) == ['static', 'code']
+
 #########
 # flask #
 #########
@@ -133,7 +209,7 @@ class TestFab:
             with patch('fabfile.install_venv'):
                 fabfile.install_flask_work_tree(self.c, 'foo.bar')
         self.c.run.assert_has_calls([
-            call("mkdir -p /www/sites/foo.bar/src"),
+            call("mkdir -p /www/sites/foo.bar/releases"),
             call(
                 "ln -sf  /www/sites/foo.bar/src/app/static"
                 " /www/sites/foo.bar/static"
@@ -152,6 +228,71 @@ class TestFab:
             call('chown whom:whom /www'),
         ])
 
+    def test_create_connects_first(self, *args):
+        connected = []
+        with patch('fabfile.TaskGraph') as graph, \
+                patch('fabfile.allocate_port', return_value=9001), \
+                patch('fabfile.report'):
+            graph.return_value.run.side_effect = \
+                lambda **_: connected.extend(self.c.method_calls)
+            fabfile.create(self.c, 'foo.bar')
+        assert connected == [call.open(), call.sftp()]
+
+    def test_create_venv_after_push(self, *args):
+        with patch('fabfile.TaskGraph') as graph, \
+                patch('fabfile.allocate_port', return_value=9001), \
+                patch('fabfile.report'):
+            fabfile.create(self.c, 'foo.bar')
+        steps = {
+            add.args[0]: add.kwargs
+            for add in graph.return_value.add.call_args_list
+        }
+        assert steps['install_venv']['requires'] == ['push_remote']
+
+    def test_create_generates_after_git(self, *args):
+        graph = fabfile.TaskGraph()
+        with patch('fabfile.TaskGraph', return_value=graph), \
+                patch.object(graph, 'run'), \
+                patch('fabfile.allocate_port', return_value=9001), \
+                patch('fabfile.report'):
+            fabfile.create(self.c, 'foo.bar')
+        # configure_git asserts a clean work tree, before files are generated
+        for name in 'generate_site_nginx', 'generate_site_supervisor':
+            assert 'configure_git' in graph.steps[name].requires
+        order = graph.order()
+        assert order.index('configure_git') < order.index('generate_site_nginx')
+
+    def test_create_static_package(self, *args):
+        with patch('fabfile.TaskGraph') as graph, \
+                patch('fabfile.allocate_port', return_value=9001), \
+                patch('fabfile.report'):
+            fabfile.create(self.c, 'foo.bar', module='proj.asgi', app='app')
+        steps = {
+            add.args[0]: add.kwargs
+            for add in graph.return_value.add.call_args_list
+        }
+        for name in 'configure_git', 'install_flask_work_tree', 'push_remote':
+            assert steps[name]['package'] == 'proj'
+
+    def test_probe(self, *args):
+        self.c.sudo.return_value.stdout = (
+            '--paths\n1 /www/sites/foo.bar/git\n--supervisor\n'
+            'foo.bar RUNNING pid 1\n--nginx\nfoo.bar\n--ports\n9000\n'
+        )
+        state = fabfile.probe(self.c, 'foo.bar')
+        assert self.c.sudo.call_count == 1
+        assert state.exists('/www/sites/foo.bar/git')
+        assert remote_state.cached(self.c) is state
+
+    def test_probed_state_skips_exists(self, *args):
+        exists, _ = args
+        remote_state.store(
+            self.c, remote_state.SiteState(paths={'/www/sites/foo.bar/src': True})
+        )
+        fabfile.install_flask_work_tree(self.c, 'foo.bar')
+        exists.assert_not_called()
+        self.c.run.assert_not_called()
+
     def test_remote_site(self, *args):
         assert fabfile.remote_site_dir('foo.bar') == '/www/sites/foo.bar'
 
@@ -168,8 +309,12 @@ class TestFab:
 
         self.c.sudo.assert_has_calls([
             call('/etc/init.d/nginx start'),
-            call('mv /tmp/foo.bar /etc/nginx/sites-available/foo.bar'),
-            call('/etc/init.d/nginx restart'),
+            call(script([
+                'mv /tmp/foo.bar /etc/nginx/sites-available/foo.bar',
+                'install -d -o www-data /var/cache/nginx',
+                'nginx -t',
+                'nginx -s reload',
+            ])),
         ])
 
         self.c.put.assert_called_with(
@@ -192,13 +337,11 @@ class TestFab:
 
     def test_setup_link(self, *args):
         fabfile.enable_link(self.c, 'foo.bar')
-        self.c.sudo.assert_has_calls([
-            call('touch /etc/nginx/sites-available/foo.bar'),
-            call(
-                'ln -s /etc/nginx/sites-available/foo.bar'
-                ' /etc/nginx/sites-enabled/foo.bar'
-            ),
-        ])
+        self.c.sudo.assert_called_once_with(script([
+            'touch /etc/nginx/sites-available/foo.bar',
+            'ln -s /etc/nginx/sites-available/foo.bar'
+            ' /etc/nginx/sites-enabled/foo.bar',
+        ]))
 
     def test_scp(self, *args):
         fabfile.scp(self.c, 'foo', '/bar/baz')
@@ -227,11 +370,11 @@ class TestFab:
             './sites/foo.bar/etc/supervisor/conf.d/foo.bar.conf',
             '/tmp/foo.bar.conf'
         )
-        self.c.sudo.assert_has_calls([
-            call('mv /tmp/foo.bar.conf /etc/supervisor/conf.d/foo.bar.conf'),
-            call('supervisorctl reread'),
-            call('supervisorctl update'),
-        ])
+        self.c.sudo.assert_called_once_with(script([
+            'mv /tmp/foo.bar.conf /etc/supervisor/conf.d/foo.bar.conf',
+            'supervisorctl reread',
+            'supervisorctl update',
+        ]))
 
     def test_run(self, *args):
         fabfile.start_app(self.c, 'foo.bar')
@@ -241,6 +384,13 @@ class TestFab:
         fabfile.stop_app(self.c, 'foo.bar')
         self.c.sudo.assert_called_once_with('supervisorctl stop foo.bar')
 
+    def test_reload_supervisor(self, *args):
+        fabfile.reload_supervisor(self.c)
+        self.c.sudo.assert_called_once_with(script([
+            'supervisorctl reread',
+            'supervisorctl update',
+        ]))
+
     def test_status(self, *args):
         fabfile.status(self.c)
         self.c.sudo.assert_called_once_with('supervisorctl status')
@@ -256,6 +406,81 @@ class TestFab:
         mrun.assert_called_once_with(self.c, 'foo.bar')
         mstop.assert_called_once_with(self.c, 'foo.bar')
 
+    def test_switch_release(self, *args):
+        fabfile.switch_release(self.c, 'foo.bar', release='20200101000000')
+        script = self.c.run.call_args.args[0]
+        assert 'target=/www/sites/foo.bar/releases/20200101000000' in script
+        assert 'mv -T /www/sites/foo.bar/src.new /www/sites/foo.bar/src' in script
+
+    def test_rollback_release(self, *args):
+        with patch('fabfile.switch_release') as switch:
+            fabfile.rollback_release(self.c, 'foo.bar')
+        switch.assert_called_once_with(self.c, 'foo.bar', release='')
+        self.c.sudo.assert_called_once_with(self.hup)
+
+    def test_graceful_restart(self, *args):
+        with patch('fabfile.stop_app') as mstop:
+            fabfile.restart_app(self.c, 'foo.bar', graceful=True, port=8000)
+        mstop.assert_not_called()
+        self.c.sudo.assert_called_once_with(self.hup)
+        assert (
+            'curl -fsS -o /dev/null http://localhost:8000/'
+            in self.c.run.call_args.args[0]
+        )
+
+    def test_reload_app_waits_for_new_workers(self, *args):
+        self.c.sudo.return_value.stdout = '101\n102\n'
+        fabfile.reload_app(self.c, 'foo.bar', port=8000)
+        health = self.c.run.call_args.args[0]
+        assert '    for pid in 101 102; do\n' in health
+        assert health.index('[ -n "$old" ] && continue') \
+            < health.index('curl -fsS -o /dev/null http://localhost:8000/')
+
+    def test_reload_app_registry_port(self, *args):
+        self.c.run.return_value.stdout = '9004\n'
+        fabfile.reload_app(self.c, 'foo.bar')
+        self.c.run.assert_any_call(
+            'python3 /www/port_registry.py /www/ports.json lookup foo.bar',
+            hide=True, warn=True,
+        )
+        assert 'http://localhost:9004/' in self.c.run.call_args.args[0]
+
+    def test_reload_app_unregistered(self, *args):
+        self.c.run.return_value.ok = False
+        self.c.run.return_value.stdout = ''
+        with patch('fabfile.PORT', 9000):
+            fabfile.reload_app(self.c, 'foo.bar')
+        assert 'http://localhost:9000/' in self.c.run.call_args.args[0]
+
+    def test_reload_app_warmup(self, *args):
+        fabfile.reload_app(
+            self.c, 'foo.bar', port=8000, warmup='/, /data', rounds=2
+        )
+        self.c.sudo.assert_called_once_with(self.hup)
+        self.c.run.assert_called_with(
+            "printf '%s\\n' http://localhost:8000/ http://localhost:8000/data"
+            " http://localhost:8000/ http://localhost:8000/data"
+            " | xargs -n 1 -P 2 curl -fsS -o /dev/null"
+        )
+
+    def test_reload_app_socket(self, *args):
+        fabfile.reload_app(self.c, 'foo.bar', socket=True, warmup='/data')
+        health, warmup = (c.args[0] for c in self.c.run.call_args_list)
+        assert (
+            'curl -fsS -o /dev/null --unix-socket /www/sites/foo.bar/run/app.sock'
+            ' http://localhost/ && exit 0' in health
+        )
+        assert warmup.endswith(
+            '--unix-socket /www/sites/foo.bar/run/app.sock'
+        )
+        assert 'http://localhost/data' in warmup
+
+    def test_install_run_dir(self, *args):
+        fabfile.install_run_dir(self.c, 'foo.bar', deploy_user='whom')
+        self.c.sudo.assert_called_once_with(
+            'install -d -m 2750 -o whom -g www-data /www/sites/foo.bar/run'
+        )
+
     def test_rollback(self, *args):
 
         with patch('fabfile.local') as mock_local:
@@ -265,7 +490,7 @@ class TestFab:
             call('git revert master --no-edit'),
             call('git push foo.bar master')
         ])
-        self.c.sudo.assert_called_once_with('supervisorctl restart foo.bar')
+        self.c.sudo.assert_called_once_with(self.hup)
 
 ###########
 # certbot #
@@ -288,10 +513,12 @@ class TestFab:
 
         self.c.sudo.assert_has_calls([
             call('supervisorctl stop foo.bar'),
-            call('rm -rf /www/sites/foo.bar'),
-            call('rm -f /etc/supervisor/conf.d/foo.bar.conf'),
-            call('rm -f /etc/nginx/sites-available/foo.bar'),
-            call('rm -f /etc/nginx/sites-enabled/foo.bar'),
+            call(script([
+                'rm -rf /www/sites/foo.bar',
+                'rm -f /etc/supervisor/conf.d/foo.bar.conf',
+                'rm -f /etc/nginx/sites-available/foo.bar',
+                'rm -f /etc/nginx/sites-enabled/foo.bar',
+            ])),
         ])
 
         mock_local.assert_has_calls([
@@ -299,6 +526,69 @@ class TestFab:
             call('rm -rf sites/foo.bar')
         ])
 
+    def test_allocate_port(self, *args):
+        exists, _ = args
+        exists.return_value = True
+        self.c.run.return_value.stdout = '9003\n'
+        assert fabfile.allocate_port(self.c, 'foo.bar') == 9003
+        self.c.put.assert_called_once_with(
+            port_registry.__file__, '/www/port_registry.py'
+        )
+        self.c.run.assert_called_once_with(
+            'python3 /www/port_registry.py /www/ports.json allocate foo.bar',
+            hide=True,
+        )
+
+    def test_claim_port(self, *args):
+        self.c.run.return_value.stdout = '8000\n'
+        assert fabfile.allocate_port(self.c, 'foo.bar', port=8000) == 8000
+        assert self.c.run.call_args.args[0].endswith(
+            ' allocate foo.bar --port 8000'
+        )
+
+    def test_allocate_port_new_host(self, *args):
+        exists, _ = args
+        exists.return_value = False
+        self.c.run.return_value.stdout = '9002\n'
+        assert fabfile.allocate_port(self.c, 'foo.bar') == 9002
+        self.c.run.assert_has_calls([
+            call('python3 /www/port_registry.py /www/ports.json rebuild'),
+            call(
+                'python3 /www/port_registry.py /www/ports.json'
+                ' allocate foo.bar',
+                hide=True,
+            ),
+        ])
+
+    def test_list_ports(self, *args):
+        exists, _ = args
+        exists.return_value = True
+        fabfile.list_ports(self.c, site='foo.bar')
+        self.c.put.assert_called_once_with(
+            port_registry.__file__, '/www/port_registry.py'
+        )
+        self.c.run.assert_called_once_with(
+            'python3 /www/port_registry.py /www/ports.json lookup foo.bar',
+            warn=True,
+        )
+
+    def test_list_ports_new_host(self, *args):
+        exists, _ = args
+        exists.return_value = False
+        self.c.run.return_value.failed = True
+        with patch('fabfile.logger') as logger:
+            fabfile.list_ports(self.c, port=9005)
+        self.c.run.assert_has_calls([
+            call('python3 /www/port_registry.py /www/ports.json rebuild'),
+            call(
+                'python3 /www/port_registry.py /www/ports.json lookup 9005',
+                warn=True,
+            ),
+        ])
+        logger.info.assert_called_once_with(
+            '9005 is not in the port registry'
+        )
+
 # env
 
     def test_env_cmd(self, *args):
@@ -308,3 +598,56 @@ class TestFab:
     def test_env_sudo(self, *args):
         fabfile.remote_env_sudo(self.c, "FOO=BAR", "printenv FOO")
         self.c.sudo.assert_called_once_with('FOO=BAR printenv FOO')
+
+# fleet
+
+    def test_run_on_host(self, *args):
+        with patch('fabfile.Connection') as connection:
+            fabfile.run_on_host(self.c, 'host1', fabfile.status)
+        connection.assert_called_once_with(
+            'host1', config=self.c.config.clone()
+        )
+        connection().sudo.assert_called_once_with('supervisorctl status')
+        connection().close.assert_called_once_with()
+
+    def test_fleet(self, *args):
+        with patch('fabfile.run_on_host') as run_on_host:
+            with patch('fabfile.print') as mock_print:
+                run_on_host.return_value = 'RUNNING\n'
+                fabfile.fleet(self.c, 'status', hosts='h1,h2')
+        run_on_host.assert_has_calls([
+            call(self.c, 'h1', fabfile.status),
+            call(self.c, 'h2', fabfile.status),
+        ], any_order=True)
+        report = mock_print.call_args.args[0]
+        assert '== h1: ok' in report
+        assert '== h2: ok' in report
+
+    def test_fleet_host_exits(self, *args):
+        def run_on_host(c, host, func):
+            if host == 'h1':
+                exit(1)
+            return 'RUNNING\n'
+
+        with patch('fabfile.run_on_host', run_on_host), \
+                patch('fabfile.print') as mock_print, \
+                patch('fabfile.exit') as mock_exit:
+            fabfile.fleet(self.c, 'status', hosts='h1,h2')
+        report = mock_print.call_args.args[0]
+        assert '== h1: FAILED' in report
+        assert '    exit(1)' in report
+        assert '== h2: ok' in report
+        mock_exit.assert_called_once_with(1)
+
+    def test_fleet_report(self, *args):
+        report = fabfile.fleet_report([
+            ('h1', 'up\n', None, 1.0),
+            ('h2', None, RuntimeError('down'), 2.0),
+        ])
+        assert report == (
+            '== h1: ok (1.00s)\n'
+            '    up\n'
+            '== h2: FAILED (2.00s)\n'
+            '    down'
+        )
+
@@ -0,0 +1,61 @@
+import datetime
+
+import pytest
+from flask import Flask, jsonify
+
+from flask_project import fastjson
+from flask_project.fastjson import FastJSONProvider, JSONBytes, preserialized
+
+
+@pytest.fixture(params=['orjson', 'stdlib'])
+def app(request, monkeypatch):
+    if request.param == 'orjson':
+        pytest.importorskip('orjson')
+    else:
+        monkeypatch.setattr(fastjson, 'orjson', None)
+    app = Flask(__name__)
+    app.json = FastJSONProvider(app)
+
+    @app.route('/obj')
+    def obj():
+        return jsonify(b=1, a=datetime.date(2020, 1, 2), c={1: 'x'})
+
+    @app.route('/names')
+    def names():
+        return jsonify(STATIC)
+
+    return app
+
+
+STATIC = JSONBytes(b'{"static":true}')
+
+
+def test_jsonify(app):
+    response = app.test_client().get('/obj')
+    assert response.mimetype == 'application/json'
+    assert response.get_json() == {
+        'a': 'Thu, 02 Jan 2020 00:00:00 GMT', 'b': 1, 'c': {'1': 'x'}
+    }
+    assert response.get_data(as_text=True).index('"a"') < \
+        response.get_data(as_text=True).index('"b"')
+
+
+def test_preserialized_passed_through(app):
+    response = app.test_client().get('/names')
+    assert response.get_data() == b'{"static":true}'
+    assert response.mimetype == 'application/json'
+
+
+def test_dumps_loads(app):
+    assert app.json.loads(app.json.dumps({'x': [1, 2]})) == {'x': [1, 2]}
+    assert app.json.dumps({'x': 1}, indent=2).startswith('{\n')
+
+
+def test_preserialized(monkeypatch):
+    expected = b'{"a":[1,2],"b":"\xc3\xa9"}'
+    if fastjson.orjson is not None:
+        assert preserialized({'b': 'é', 'a': [1, 2]}) == expected
+    monkeypatch.setattr(fastjson, 'orjson', None)
+    data = preserialized({'b': 1, 'a': [1, 2]})
+    assert isinstance(data, JSONBytes)
+    assert data == b'{"a":[1,2],"b":1}'
@@ -0,0 +1,116 @@
+import os
+import textwrap
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import fabfile
+import inventory
+
+TOML = """\
+[defaults]
+host = "deployhost"
+module = "proj"
+
+[hosts.deployhost]
+cpus = 2
+
+[hosts.bighost]
+cpus = 16
+nginx = {gzip = false}
+
+[sites."foo.bar"]
+port = 9001
+supervisor = {worker_class = "gthread"}
+
+[sites."baz.com"]
+host = "bighost"
+socket = true
+nginx = {brotli = true}
+"""
+
+YAML = """\
+defaults:
+  host: deployhost
+sites:
+  foo.bar:
+    port: 9001
+    supervisor: {workers: 3}
+"""
+
+
+@pytest.fixture
+def toml_file(tmp_path):
+    path = tmp_path / 'inventory.toml'
+    path.write_text(TOML)
+    return str(path)
+
+
+def test_sites(toml_file):
+    foo, baz = inventory.sites(inventory.load(toml_file))
+    assert foo == {
+        'site': 'foo.bar', 'host': 'deployhost', 'module': 'proj',
+        'cpus': 2, 'port': 9001,
+        'nginx': {}, 'supervisor': {'worker_class': 'gthread'},
+    }
+    assert baz['host'] == 'bighost'
+    assert baz['cpus'] == 16
+    assert baz['nginx'] == {'gzip': False, 'brotli': True}
+
+
+def test_yaml(tmp_path):
+    pytest.importorskip('yaml')
+    path = tmp_path / 'inventory.yml'
+    path.write_text(YAML)
+    (site,) = inventory.sites(inventory.load(str(path)))
+    assert site['supervisor'] == {'workers': 3}
+
+
+def test_invalid():
+    with pytest.raises(ValueError, match='unknown keys prot'):
+        inventory.sites({'sites': {'a.com': {'prot': 1}}})
+    with pytest.raises(ValueError, match='needs a port'):
+        inventory.sites({'sites': {'a.com': {}}})
+
+
+def test_write_if_changed(tmp_path):
+    path = str(tmp_path / 'etc' / 'conf')
+    assert inventory.write_if_changed(path, 'a')
+    mtime = os.stat(path).st_mtime_ns
+    assert not inventory.write_if_changed(path, 'a')
+    assert os.stat(path).st_mtime_ns == mtime
+    assert inventory.write_if_changed(path, 'b')
+    assert open(path).read() == 'b'
+
+
+@patch('fabfile.DEPLOY_ROOT', '/www')
+@patch('invoke.tasks.isinstance')  # necessary for mocking
+def test_render_inventory(_, toml_file, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    c = MagicMock()
+    fabfile.render_inventory(c, inventory=toml_file)
+    conf = tmp_path / 'sites/foo.bar/etc/supervisor/conf.d/foo.bar.conf'
+    assert conf.read_text().splitlines()[1] == (
+        'command = /www/sites/foo.bar/venv3/bin/gunicorn proj:app'
+        ' -b localhost:9001 --chdir /www/sites/foo.bar/src'
+        ' -w 5 -k gthread --threads 4'
+    )
+    nginx = (tmp_path / 'sites/baz.com/etc/nginx/sites-available/baz.com')
+    config = nginx.read_text()
+    assert 'server unix:/www/sites/baz.com/run/app.sock;' in config
+    assert 'brotli on;' in config
+    assert 'gzip on;' not in config
+    c.run.assert_not_called()
+
+    mtime = conf.stat().st_mtime_ns
+    with open(toml_file, 'a') as f:
+        f.write(textwrap.dedent("""\
+            [sites."new.com"]
+            port = 9002
+            """))
+    with patch('fabfile.logger') as logger:
+        fabfile.render_inventory(c, inventory=toml_file)
+    assert logger.info.call_args.args[0].startswith('2 of 6 files changed')
+    assert (tmp_path / 'sites/new.com/etc/nginx/sites-available/new.com') \
+        .exists()
+    assert conf.stat().st_mtime_ns == mtime
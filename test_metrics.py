@@ -0,0 +1,182 @@
+import glob
+import multiprocessing
+import os
+
+from flask import Flask
+
+from flask_project.metrics import (
+    MmapValues, Metrics, MetricsMiddleware, instrument, queue_seconds,
+)
+from flask_project.timing import url_map_route
+
+
+def make_app(metrics):
+    app = Flask(__name__)
+
+    @app.route('/items/<int:n>')
+    def item(n):
+        return str(n)
+
+    app.wsgi_app = MetricsMiddleware(
+        app.wsgi_app, metrics, url_map_route(app.url_map)
+    )
+    return app
+
+
+def test_mmap_values(tmp_path):
+    path = str(tmp_path / '1.db')
+    values = MmapValues(path, size=64)
+    values.inc('a')
+    values.inc('a', 2.5)
+    for n in range(10):
+        values.set(f'key-{n}', n)
+    values.close()
+    values = MmapValues(path)
+    assert values.get('a') == 3.5
+    assert values.get('key-9') == 9.0
+
+
+def count(directory, n):
+    metrics = Metrics(directory)
+    for _ in range(n):
+        metrics.started()
+        metrics.finished('GET', '/', '200', 0.003)
+
+
+def test_summed_over_processes(tmp_path):
+    directory = str(tmp_path)
+    workers = [
+        multiprocessing.Process(target=count, args=(directory, n))
+        for n in (2, 3)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    count(directory, 1)
+    totals = Metrics(directory).collect()
+    key = ('app_requests_total', '',
+           (('method', 'GET'), ('route', '/'), ('status', '200')))
+    assert totals[key] == 6.0
+    assert totals['app_workers', '', ()] == 1.0
+
+
+def test_exited_workers_folded(tmp_path):
+    directory = str(tmp_path)
+    for n in (2, 3):
+        worker = multiprocessing.Process(target=count, args=(directory, n))
+        worker.start()
+        worker.join()
+    metrics = Metrics(directory)
+    key = ('app_requests_total', '',
+           (('method', 'GET'), ('route', '/'), ('status', '200')))
+    assert metrics.collect()[key] == 5.0
+    assert sorted(glob.glob(f'{directory}/*.db')) == [f'{directory}/dead.db']
+    count(directory, 1)
+    assert metrics.collect()[key] == 6.0
+    assert metrics.collect()['app_workers', '', ()] == 1.0
+
+
+def test_in_progress_only_live(tmp_path):
+    directory = str(tmp_path)
+    worker = multiprocessing.Process(
+        target=Metrics(directory).started
+    )
+    worker.start()
+    worker.join()
+    metrics = Metrics(directory)
+    metrics.started()
+    assert metrics.collect()['app_requests_in_progress', '', ()] == 1.0
+
+
+def test_exposition(tmp_path):
+    metrics = Metrics(str(tmp_path), buckets=(0.01, 0.1, float('inf')))
+    for seconds in (0.005, 0.05, 0.05):
+        metrics.started()
+        metrics.finished('GET', '/a', '200', seconds, queued=0.001)
+    text = metrics.exposition()
+    assert '# TYPE app_requests_total counter' in text
+    assert (
+        'app_requests_total{method="GET",route="/a",status="200"} 3.0'
+    ) in text
+    assert 'app_request_duration_seconds_bucket{route="/a",le="0.01"} 1.0' \
+        in text
+    assert 'app_request_duration_seconds_bucket{route="/a",le="+Inf"} 3.0' \
+        in text
+    assert 'app_request_duration_seconds_count{route="/a"} 3.0' in text
+    assert 'app_request_queue_seconds_count 3.0' in text
+    assert 'app_requests_in_progress 0.0' in text
+    assert 'app_workers 1.0' in text
+
+
+def test_middleware(tmp_path):
+    client = make_app(Metrics(str(tmp_path))).test_client()
+    client.get('/items/1')
+    client.get('/items/2', headers={'X-Request-Start': 't=1.0'})
+    client.get('/missing')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    text = response.get_data(as_text=True)
+    assert (
+        'app_requests_total{method="GET",route="/items/<int:n>",status="200"}'
+        ' 2.0'
+    ) in text
+    assert (
+        'app_requests_total{method="GET",route="<unmatched>",status="404"}'
+        ' 1.0'
+    ) in text
+    assert 'app_request_queue_seconds_count 1.0' in text
+    assert glob.glob(f'{tmp_path}/*.db') == [f'{tmp_path}/{os.getpid()}.db']
+
+
+def test_queue_seconds():
+    assert queue_seconds({'HTTP_X_REQUEST_START': 't=100.5'}, 101.0) == 0.5
+    assert queue_seconds({'HTTP_X_REQUEST_START': 't=102'}, 101.0) == 0.0
+    assert queue_seconds({'HTTP_X_REQUEST_START': '100.5'}, 101.0) == 0.5
+    assert queue_seconds({'HTTP_X_REQUEST_START': 't='}, 101.0) is None
+    assert queue_seconds({}, 101.0) is None
+
+
+def test_instrument(tmp_path):
+    app = object()
+    assert instrument(app, environ={}) is app
+    wrapped = instrument(app, environ={'APP_METRICS_DIR': str(tmp_path)})
+    assert wrapped.metrics.directory == str(tmp_path)
+
+
+def test_asgi_middleware(tmp_path):
+    import asyncio
+    from flask_project import asgi
+
+    app = instrument(
+        asgi.application, environ={'APP_METRICS_DIR': str(tmp_path)},
+        asgi=True, routes=asgi.ROUTES,
+    )
+
+    def get(path, headers=()):
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': path,
+                 'query_string': b'', 'headers': list(headers)}
+        asyncio.run(app(scope, receive, send))
+        return sent[0]['status'], sent[1]['body'].decode()
+
+    assert get('/') == (200, 'ASGI is running!')
+    assert get('/', [(b'x-request-start', b't=1.0')])[0] == 200
+    assert get('/missing')[0] == 404
+    status, text = get('/metrics')
+    assert status == 200
+    assert (
+        'app_requests_total{method="GET",route="/",status="200"} 2.0'
+    ) in text
+    assert (
+        'app_requests_total{method="GET",route="<unmatched>",status="404"}'
+        ' 1.0'
+    ) in text
+    assert 'app_request_queue_seconds_count 1.0' in text
@@ -0,0 +1,113 @@
+import threading
+import time
+
+import pytest
+
+from parallel import TaskGraph, report, fan_out
+
+
+def test_order():
+    graph = TaskGraph()
+    graph.add('push', None, requires=['git', 'tree'])
+    graph.add('git', None)
+    graph.add('tree', None)
+    order = graph.order()
+    assert order.index('push') > order.index('git')
+    assert order.index('push') > order.index('tree')
+
+
+def test_unknown_requirement():
+    graph = TaskGraph()
+    graph.add('push', None, requires=['git'])
+    with pytest.raises(ValueError):
+        graph.run()
+
+
+def test_cycle():
+    graph = TaskGraph()
+    graph.add('a', None, requires=['b'])
+    graph.add('b', None, requires=['a'])
+    with pytest.raises(ValueError):
+        graph.run()
+
+
+def test_independent_steps_overlap():
+    barrier = threading.Barrier(2, timeout=5)
+    graph = TaskGraph()
+    graph.add('venv', barrier.wait)
+    graph.add('nginx', barrier.wait)
+    timings = graph.run(max_workers=2)
+    assert set(timings) == {'venv', 'nginx'}
+
+
+def test_dependencies_respected():
+    calls = []
+    graph = TaskGraph()
+    graph.add('start', calls.append, 'start', requires=['configure'])
+    graph.add('configure', calls.append, 'configure', requires=['push'])
+    graph.add('push', calls.append, 'push')
+    graph.run(max_workers=3)
+    assert calls == ['push', 'configure', 'start']
+
+
+def test_failure_stops_dependents():
+    calls = []
+
+    def fail():
+        raise RuntimeError('boom')
+
+    graph = TaskGraph()
+    graph.add('push', fail)
+    graph.add('start', calls.append, 'start', requires=['push'])
+    with pytest.raises(RuntimeError):
+        graph.run()
+    assert calls == []
+
+
+def test_timings():
+    graph = TaskGraph()
+    graph.add('sleep', time.sleep, 0.05)
+    timings = graph.run()
+    assert timings['sleep'] >= 0.05
+
+
+def test_report():
+    table = report({'fast': 0.5, 'slow': 2.0}, total=2.1)
+    assert table.splitlines() == [
+        'slow       2.00s',
+        'fast       0.50s',
+        'total      2.10s',
+    ]
+
+
+def test_fan_out():
+    results = fan_out(lambda host: host.upper(), ['a', 'b', 'c'], max_workers=2)
+    assert [(item, value) for item, value, _, _ in results] == [
+        ('a', 'A'), ('b', 'B'), ('c', 'C')
+    ]
+
+
+def test_fan_out_concurrent():
+    barrier = threading.Barrier(3, timeout=5)
+    results = fan_out(lambda host: barrier.wait(), ['a', 'b', 'c'])
+    assert all(error is None for _, _, error, _ in results)
+
+
+def test_fan_out_error():
+    def fail(host):
+        raise RuntimeError(host)
+
+    [(item, value, error, seconds)] = fan_out(fail, ['a'])
+    assert value is None
+    assert str(error) == 'a'
+
+
+def test_fan_out_exit():
+    def stop(host):
+        if host == 'b':
+            exit(1)
+        return host
+
+    results = fan_out(stop, ['a', 'b', 'c'])
+    assert [value for _, value, _, _ in results] == ['a', None, 'c']
+    assert isinstance(results[1][2], SystemExit)
@@ -0,0 +1,82 @@
+import json
+import threading
+
+import pytest
+
+from port_registry import PortTaken, Registry, load, locked, main, scan
+
+
+def test_allocate():
+    registry = Registry({'a.com': 9000, 'b.com': 9002})
+    assert registry.allocate('c.com') == 9001
+    assert registry.allocate('c.com') == 9001
+    assert registry.allocate('d.com', in_use=lambda port: port == 9003) \
+        == 9004
+    assert registry.lookup('9004') == 'd.com'
+    assert registry.lookup('a.com') == 9000
+    assert registry.lookup('e.com') is None
+
+
+def test_full():
+    registry = Registry({'a.com': 9000})
+    with pytest.raises(PortTaken):
+        registry.allocate('b.com', low=9000, high=9000)
+
+
+def test_claim_and_release():
+    registry = Registry({'a.com': 9000})
+    with pytest.raises(PortTaken):
+        registry.add('b.com', 9000)
+    registry.add('a.com', 9005)
+    assert registry.ports == {9005: 'a.com'}
+    assert registry.remove('a.com') == 9005
+    assert registry.remove('a.com') is None
+    assert registry.sites == registry.ports == {}
+
+
+def test_locked_concurrent(tmp_path):
+    path = str(tmp_path / 'ports.json')
+
+    def allocate(i):
+        with locked(path) as registry:
+            registry.allocate(f'site{i}.com')
+
+    threads = [threading.Thread(target=allocate, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(load(path).ports) == list(range(9000, 9020))
+
+
+def test_not_saved_on_error(tmp_path):
+    path = str(tmp_path / 'ports.json')
+    main([path, 'allocate', 'a.com', '--port', '9100'])
+    assert main([path, 'allocate', 'b.com', '--port', '9100']) == 1
+    assert json.loads((tmp_path / 'ports.json').read_text()) == \
+        {'a.com': 9100}
+
+
+def test_scan(tmp_path, capsys):
+    nginx = tmp_path / 'nginx'
+    supervisor = tmp_path / 'supervisor'
+    nginx.mkdir()
+    supervisor.mkdir()
+    (nginx / 'a.com').write_text('upstream a_com {\n    server localhost:9001;\n')
+    (nginx / 'sock.com').write_text('proxy_pass http://unix:/run/app.sock:;\n')
+    (supervisor / 'b.com.conf').write_text(
+        '[program:b.com]\ncommand = uvicorn m:app --port 9002 --app-dir x\n'
+        '[program:c.com]\ncommand = gunicorn m:app -b localhost:9001\n'
+    )
+    registry = scan(str(nginx), str(supervisor))
+    assert registry.sites == {'a.com': 9001, 'b.com': 9002}
+    assert 'c.com: port 9001 is taken by a.com' in capsys.readouterr().err
+
+
+def test_main_lookup(tmp_path, capsys):
+    path = str(tmp_path / 'ports.json')
+    main([path, 'allocate', 'a.com', '--low', '9500'])
+    main([path, 'list'])
+    assert main([path, 'lookup', '9500']) == 0
+    assert main([path, 'lookup', 'b.com']) == 1
+    assert capsys.readouterr().out == '9500\na.com 9500\na.com\n'
@@ -0,0 +1,74 @@
+import subprocess
+from unittest.mock import MagicMock
+
+import pytest
+
+import remote_state
+
+OUTPUT = """\
+--paths
+1 /www/sites/foo.bar/git
+0 /www/sites/foo.bar/src
+--supervisor
+foo.bar                          RUNNING   pid 1234, uptime 1:02:03
+baz                              STOPPED   Not started
+--nginx
+foo.bar
+default
+--ports
+22
+80
+9000
+--cpus
+4
+"""
+
+
+@pytest.fixture(autouse=True)
+def clear():
+    yield
+    remote_state.clear()
+
+
+def test_parse():
+    state = remote_state.parse(OUTPUT)
+    assert state.exists('/www/sites/foo.bar/git') is True
+    assert state.exists('/www/sites/foo.bar/src') is False
+    assert state.exists('/www') is None
+    assert state.running('foo.bar') is True
+    assert state.running('baz') is False
+    assert state.nginx == {'foo.bar', 'default'}
+    assert state.ports == {22, 80, 9000}
+    assert state.cpus == 4
+
+
+def test_script(tmp_path):
+    (tmp_path / 'here').mkdir()
+    script = remote_state.probe_script(
+        [str(tmp_path / 'here'), str(tmp_path / 'gone')]
+    )
+    output = subprocess.run(
+        ['sh', '-c', script], capture_output=True, text=True, check=True
+    ).stdout
+    state = remote_state.parse(output)
+    assert state.paths == {
+        str(tmp_path / 'here'): True,
+        str(tmp_path / 'gone'): False,
+    }
+
+
+def test_cache_per_host():
+    c1, c2 = MagicMock(host='h1'), MagicMock(host='h2')
+    state = remote_state.store(c1, remote_state.parse(OUTPUT))
+    assert remote_state.cached(c1) is state
+    assert remote_state.cached(c2) is None
+
+
+def test_forget():
+    c = MagicMock(host='h1')
+    state = remote_state.store(c, remote_state.parse(OUTPUT))
+    remote_state.forget(c, '/www/sites/foo.bar/git', section='supervisor')
+    assert state.exists('/www/sites/foo.bar/git') is None
+    assert state.exists('/www/sites/foo.bar/src') is False
+    assert state.running('foo.bar') is None
+    assert state.nginx == {'foo.bar', 'default'}
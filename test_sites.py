@@ -1,6 +1,7 @@
 from unittest.mock import patch, mock_open, MagicMock
 
 import fabfile
+from batch import script
 import pytest
 import textwrap
 
@@ -27,6 +28,50 @@ def test_site_nginx(c, port):
         'sites/foo.bar/etc/nginx/sites-available/foo.bar',
         'w'
     )
+    m().write.assert_called_with(textwrap.dedent(
+        f"""\
+        upstream foo_bar {{
+            server localhost:{port};
+            keepalive 32;
+        }}
+
+        server {{
+            server_name foo.bar;
+            sendfile on;
+            tcp_nopush on;
+            gzip on;
+            gzip_comp_level 5;
+            gzip_min_length 256;
+            gzip_proxied any;
+            gzip_vary on;
+            gzip_types text/plain text/css text/xml application/json application/javascript application/xml image/svg+xml;
+            location / {{
+                proxy_pass http://foo_bar;
+                proxy_set_header Host $host;
+                proxy_set_header X-Real-IP $remote_addr;
+                proxy_http_version 1.1;
+                proxy_set_header Connection "";
+            }}
+            location /static {{
+                alias  /www/sites/foo.bar/static/;
+                expires 30d;
+                add_header Cache-Control "public";
+            }}
+        }}
+        """
+    ))
+
+
+@patch('fabfile.DEPLOY_ROOT', '/www')
+@patch('invoke.tasks.isinstance')  # necessary for mocking
+def test_site_nginx_plain(c, port):
+    m = mock_open()
+    with patch('fabfile.open', m, create=True):
+        with patch('fabfile.os.makedirs'):
+            fabfile.generate_site_nginx(
+                c, 'foo.bar', port,
+                keepalive=0, gzip=False, expires='', sendfile=False,
+            )
     m().write.assert_called_with(textwrap.dedent(
         f"""\
         server {{
@@ -44,6 +89,15 @@ def test_site_nginx(c, port):
     ))
 
 
+def test_nginx_optional_blocks():
+    from template import nginx_config
+    config = nginx_config(
+        'foo.bar', '/www', 8000, brotli=True, open_file_cache=True
+    )
+    assert '    brotli on;\n' in config
+    assert '    open_file_cache max=1000 inactive=60s;\n' in config
+
+
 @patch('fabfile.DEPLOY_ROOT', '/www')
 @patch('fabfile.DEPLOY_USER', 'www')
 @patch('invoke.tasks.isinstance')  # necessary for mocking
@@ -63,8 +117,300 @@ def test_site_supervisor(c, port):
     m().write.assert_called_with(textwrap.dedent(
         f"""\
         [program:foo.bar]
-        command = /www/sites/foo.bar/venv3.8/bin/gunicorn baz:bla -b localhost:{port}
+        command = /www/sites/foo.bar/venv3.8/bin/gunicorn baz:bla -b localhost:{port} --chdir /www/sites/foo.bar/src -w 3
         directory = /www/sites/foo.bar/src
         user = www
         """
     ))
+
+
+@patch('fabfile.DEPLOY_ROOT', '/www')
+@patch('invoke.tasks.isinstance')  # necessary for mocking
+def test_site_supervisor_workers(c, port):
+    m = mock_open()
+    with patch('fabfile.open', m, create=True):
+        with patch('fabfile.os.makedirs'):
+            fabfile.generate_site_supervisor(
+                c, 'foo.bar',
+                module='baz', app='bla', port=port, version=3.8,
+                deploy_user='www', worker_class='gthread', cpus=2,
+                keepalive=5, max_requests=1000, max_requests_jitter=50,
+                preload=True,
+            )
+    command = m().write.call_args.args[0].splitlines()[1]
+    assert command == (
+        f'command = /www/sites/foo.bar/venv3.8/bin/gunicorn baz:bla'
+        f' -b localhost:{port} --chdir /www/sites/foo.bar/src'
+        ' -w 5 -k gthread --threads 4 --keep-alive 5'
+        ' --max-requests 1000 --max-requests-jitter 50 --preload'
+    )
+    c.run.assert_not_called()
+
+
+def test_auto_workers():
+    from template import auto_workers
+    assert auto_workers('sync', 4) == 9
+    assert auto_workers('gthread', 1) == 3
+    assert auto_workers('gevent', 4) == 4
+    assert auto_workers('uvicorn', 0) == 1
+
+
+def test_uvicorn_options():
+    from template import uvicorn_options
+    assert uvicorn_options(workers=4) == '--workers 4'
+    assert uvicorn_options(workers=2, keepalive=10, max_requests=500) == (
+        '--workers 2 --timeout-keep-alive 10 --limit-max-requests 500'
+    )
+
+
+def test_unknown_worker_class():
+    from template import gunicorn_options
+    with pytest.raises(ValueError):
+        gunicorn_options(worker_class='eventlet')
+
+
+@patch('fabfile.DEPLOY_ROOT', '/www')
+@patch('invoke.tasks.isinstance')  # necessary for mocking
+def test_site_nginx_micro_cache(c, port):
+    m = mock_open()
+    with patch('fabfile.open', m, create=True):
+        with patch('fabfile.os.makedirs'):
+            fabfile.generate_site_nginx(
+                c, 'foo.bar', port, micro_cache='/data,/api', cache_ttl='5s'
+            )
+    config = m().write.call_args.args[0]
+    assert config.startswith(
+        'proxy_cache_path /var/cache/nginx/foo_bar levels=1:2'
+        ' keys_zone=foo_bar_cache:10m'
+    )
+    assert '    location /data {\n' in config
+    assert '    location /api {\n' in config
+    assert config.count('        proxy_cache foo_bar_cache;\n') == 2
+    assert config.count('        proxy_cache_valid 200 5s;\n') == 2
+    assert '        proxy_cache_use_stale updating' in config
+    assert '        proxy_cache_lock on;\n' in config
+
+
+@patch('fabfile.DEPLOY_ROOT', '/www')
+@patch('invoke.tasks.isinstance')  # necessary for mocking
+def test_site_supervisor_timing(c, port):
+    m = mock_open()
+    with patch('fabfile.open', m, create=True):
+        with patch('fabfile.os.makedirs'):
+            fabfile.generate_site_supervisor(
+                c, 'foo.bar',
+                module='baz', app='bla', port=port, version=3.8,
+                deploy_user='www', cpus=1, timing=True, profile_rate=0.01,
+            )
+    environment = m().write.call_args.args[0].splitlines()[-1]
+    assert environment == (
+        'environment = APP_TIMING="1",APP_PROFILE_RATE="0.01",'
+        'APP_PROFILE_DIR="/www/sites/foo.bar/profiles"'
+    )
+
+
+@patch('fabfile.DEPLOY_ROOT', '/www')
+@patch('invoke.tasks.isinstance')  # necessary for mocking
+def test_site_nginx_metrics(c, port):
+    m = mock_open()
+    with patch('fabfile.open', m, create=True):
+        with patch('fabfile.os.makedirs'):
+            fabfile.generate_site_nginx(c, 'foo.bar', port, metrics=True)
+    config = m().write.call_args.args[0]
+    assert textwrap.indent(textwrap.dedent("""\
+        location = /metrics {
+            allow 127.0.0.1;
+            allow ::1;
+            deny all;
+            proxy_pass http://foo_bar;
+        """), '    ') in config
+    assert '        proxy_set_header X-Request-Start "t=${msec}";\n' in config
+
+
+@patch('fabfile.DEPLOY_ROOT', '/www')
+@patch('invoke.tasks.isinstance')  # necessary for mocking
+def test_site_supervisor_metrics(c, port):
+    m = mock_open()
+    with patch('fabfile.open', m, create=True):
+        with patch('fabfile.os.makedirs'):
+            fabfile.generate_site_supervisor(
+                c, 'foo.bar', port=port, deploy_user='www', cpus=1,
+                metrics=True,
+            )
+    environment = m().write.call_args.args[0].splitlines()[-1]
+    assert environment == (
+        'environment = APP_METRICS_DIR="/www/sites/foo.bar/metrics"'
+    )
+
+
+@patch('fabfile.DEPLOY_ROOT', '/www')
+@patch('invoke.tasks.isinstance')  # necessary for mocking
+def test_site_supervisor_uvicorn(c, port):
+    m = mock_open()
+    with patch('fabfile.open', m, create=True):
+        with patch('fabfile.os.makedirs'):
+            fabfile.generate_site_supervisor(
+                c, 'foo.bar', module='flask_project.asgi', app='app',
+                port=port, version=3.8, deploy_user='www', cpus=4,
+                uvicorn=True,
+            )
+    command = m().write.call_args.args[0].splitlines()[1]
+    assert command == (
+        'command = /www/sites/foo.bar/venv3.8/bin/uvicorn'
+        f' flask_project.asgi:app --port {port}'
+        ' --app-dir /www/sites/foo.bar/src --workers 4'
+    )
+
+
+@patch('fabfile.DEPLOY_ROOT', '/www')
+def test_site_supervisor_uvicorn_one_core():
+    config = fabfile.site_supervisor_config(
+        'foo.bar', 'fastapi', module='flask_project.asgi', port=9001, cpus=1,
+    )
+    assert config.splitlines()[1].endswith(' --workers 2')
+
+
+@patch('fabfile.DEPLOY_ROOT', '/www')
+@patch('invoke.tasks.isinstance')  # necessary for mocking
+def test_site_nginx_assets(c, port):
+    m = mock_open()
+    with patch('fabfile.open', m, create=True):
+        with patch('fabfile.os.makedirs'):
+            fabfile.generate_site_nginx(c, 'foo.bar', port, assets=True)
+    config = m().write.call_args.args[0]
+    assert config.startswith(textwrap.dedent("""\
+        map $uri $foo_bar_static_expires {
+            "~\\.[0-9a-f]{12}\\.[^./]+$" max;
+            default 30d;
+        }
+        """))
+    assert textwrap.indent(textwrap.dedent("""\
+        location /static {
+            alias  /www/sites/foo.bar/static/;
+            expires $foo_bar_static_expires;
+            add_header Cache-Control $foo_bar_static_cache;
+            gzip_static on;
+        }
+        """), '    ') in config
+
+
+def test_nginx_hyphenated_site():
+    from template import nginx_config
+    config = nginx_config(
+        'my-site.example.com', '/www', 8000, micro_cache=['/data'],
+        assets=True,
+    )
+    assert 'upstream my_site_example_com {\n' in config
+    assert ' keys_zone=my_site_example_com_cache:10m ' in config
+    assert 'map $uri $my_site_example_com_static_expires {\n' in config
+    assert 'expires $my_site_example_com_static_expires;\n' in config
+    assert 'server_name my-site.example.com;\n' in config
+
+
+@patch('fabfile.DEPLOY_ROOT', '/www')
+@patch('invoke.tasks.isinstance')  # necessary for mocking
+def test_site_nginx_socket(c, port):
+    m = mock_open()
+    with patch('fabfile.open', m, create=True):
+        with patch('fabfile.os.makedirs'):
+            fabfile.generate_site_nginx(c, 'foo.bar', port, socket=True)
+    config = m().write.call_args.args[0]
+    assert config.startswith(textwrap.dedent("""\
+        upstream foo_bar {
+            server unix:/www/sites/foo.bar/run/app.sock;
+        """))
+    assert 'localhost' not in config
+
+
+def test_nginx_socket_plain():
+    from template import nginx_config
+    config = nginx_config(
+        'foo.bar', '/www', 8000, keepalive=0, socket='/www/app.sock'
+    )
+    assert '        proxy_pass http://unix:/www/app.sock:;\n' in config
+
+
+@patch('fabfile.DEPLOY_ROOT', '/www')
+@patch('invoke.tasks.isinstance')  # necessary for mocking
+@pytest.mark.parametrize('uvicorn, bind', [
+    (False, '-b unix:/www/sites/foo.bar/run/app.sock'),
+    (True, '--uds /www/sites/foo.bar/run/app.sock'),
+])
+def test_site_supervisor_socket(c, port, uvicorn, bind):
+    m = mock_open()
+    with patch('fabfile.open', m, create=True):
+        with patch('fabfile.os.makedirs'):
+            fabfile.generate_site_supervisor(
+                c, 'foo.bar', port=port, deploy_user='www', cpus=1,
+                uvicorn=uvicorn, socket=True,
+            )
+    command = m().write.call_args.args[0].splitlines()[1]
+    assert f' {bind} ' in command
+    assert str(port) not in command
+    assert command.endswith(' --umask 0o7') != uvicorn
+
+
+def sha256(text):
+    import hashlib
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+@patch('invoke.tasks.isinstance')  # necessary for mocking
+def test_sync_configs(_, c, tmp_path, monkeypatch):
+    import tarfile
+    monkeypatch.chdir(tmp_path)
+    for site in ('a.com', 'b.com'):
+        fabfile.generate_site_nginx(c, site, 9000)
+        fabfile.generate_site_supervisor(c, site, port=9000, cpus=1)
+    nginx_a = open('sites/a.com/etc/nginx/sites-available/a.com').read()
+    conf_b = open('sites/b.com/etc/supervisor/conf.d/b.com.conf').read()
+    c.run.return_value.stdout = '\n'.join([
+        f'{sha256(nginx_a)}  /etc/nginx/sites-available/a.com',
+        f'{sha256("old")}  /etc/supervisor/conf.d/a.com.conf',
+        '- /etc/nginx/sites-available/b.com',
+        f'{sha256(conf_b)}  /etc/supervisor/conf.d/b.com.conf',
+        f'{sha256(nginx_a)}  /etc/nginx/sites-enabled/a.com',
+        '- /etc/nginx/sites-enabled/b.com',
+    ])
+
+    changed = fabfile.sync_configs(c)
+
+    assert c.run.call_count == 1
+    assert sorted(changed.values()) == [
+        '/etc/nginx/sites-available/b.com', '/etc/supervisor/conf.d/a.com.conf'
+    ]
+    archive, target = c.put.call_args.args
+    with tarfile.open(fileobj=archive) as tar:
+        assert sorted(tar.getnames()) == [
+            'etc/nginx/sites-available/b.com', 'etc/supervisor/conf.d/a.com.conf'
+        ]
+        assert tar.getmember('etc/supervisor/conf.d/a.com.conf').uid == 0
+    assert c.sudo.call_args.args[0] == script([
+        'tar -cf /tmp/sync-configs.backup.tar -C /'
+        ' etc/supervisor/conf.d/a.com.conf',
+        f'tar -xf {target} -C / --no-same-owner',
+        f'rm -f {target}',
+        'ln -sfn /etc/nginx/sites-available/b.com /etc/nginx/sites-enabled/b.com',
+        'install -d -o www-data /var/cache/nginx',
+        'nginx -t || { tar -xf /tmp/sync-configs.backup.tar -C /;'
+        ' rm -f /etc/nginx/sites-available/b.com'
+        ' /etc/nginx/sites-enabled/b.com; false; }',
+        'nginx -s reload',
+        'supervisorctl reread',
+        'supervisorctl update',
+        'rm -f /tmp/sync-configs.backup.tar',
+    ])
+
+
+@patch('invoke.tasks.isinstance')  # necessary for mocking
+def test_sync_configs_unchanged(_, c, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    fabfile.generate_site_nginx(c, 'a.com', 9000)
+    nginx = open('sites/a.com/etc/nginx/sites-available/a.com').read()
+    c.run.return_value.stdout = (
+        f'{sha256(nginx)}  /etc/nginx/sites-available/a.com\n'
+        f'{sha256(nginx)}  /etc/nginx/sites-enabled/a.com\n'
+    )
+    assert fabfile.sync_configs(c, sites='a.com') == {}
+    c.put.assert_not_called()
+    c.sudo.assert_not_called()
@@ -0,0 +1,78 @@
+import shlex
+from unittest.mock import MagicMock, call, patch
+
+import pytest
+
+import fabfile
+import ssh_mux
+
+
+@pytest.fixture(autouse=True)
+def control_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(ssh_mux, 'CONTROL_DIR', str(tmp_path / 'mux'))
+    return tmp_path / 'mux'
+
+
+def test_ssh_command(control_dir):
+    assert shlex.split(ssh_mux.ssh_command('5m')) == [
+        'ssh', '-o', 'ControlMaster=auto',
+        '-o', f'ControlPath={control_dir}/%C', '-o', 'ControlPersist=5m',
+    ]
+    assert control_dir.is_dir()
+    assert control_dir.stat().st_mode & 0o777 == 0o700
+
+
+def test_gateway(control_dir):
+    assert ssh_mux.gateway('www') == (
+        f'ssh -o ControlMaster=no -o ControlPath={control_dir}/%C'
+        ' -o ControlPersist=10m -p %p -W localhost:%p www@%h'
+    )
+
+
+def test_start_and_control(control_dir):
+    assert ssh_mux.start('h', 'u', 2222)[-5:] == \
+        ['-N', '-f', '-p', '2222', 'u@h']
+    assert ssh_mux.control('exit', 'h') == [
+        'ssh', '-o', f'ControlPath={control_dir}/%C', '-O', 'exit', 'h'
+    ]
+
+
+@patch('invoke.tasks.isinstance')  # necessary for mocking
+@pytest.mark.parametrize('running', [False, True])
+def test_ssh_master(_, running):
+    with patch('ssh_mux.subprocess.run') as run, \
+            patch('ssh_mux.running', return_value=running):
+        fabfile.ssh_master(MagicMock(), host='h', user='u')
+        fabfile.ssh_master(MagicMock(), host='h', user='u', stop=True)
+    if running:
+        expected = ssh_mux.control('exit', 'h', 'u', 0)
+    else:
+        expected = ssh_mux.start('h', 'u', 0)
+    run.assert_called_once_with(expected, check=True)
+
+
+def test_main_without_master(capsys, control_dir):
+    with patch('ssh_mux.running', return_value=True) as running:
+        assert ssh_mux.main(['gateway', 'u', 'h']) == 0
+    running.assert_not_called()
+    assert not control_dir.exists()
+    control_dir.mkdir()
+    with patch('ssh_mux.running', return_value=False):
+        assert ssh_mux.main(['gateway', 'u', 'h']) == 0
+    assert capsys.readouterr().out == ''
+    with patch('ssh_mux.running', return_value=True):
+        ssh_mux.main(['gateway', 'u', 'h'])
+    assert capsys.readouterr().out == ssh_mux.gateway('u') + '\n'
+
+
+@patch('invoke.tasks.isinstance')  # necessary for mocking
+def test_push_shares_connection(_, control_dir):
+    with patch('fabfile.local') as local:
+        fabfile.push_remote(MagicMock(), 'foo.bar')
+    command, = local.call_args.args
+    assert command.startswith('git push')
+    assert local.call_args.kwargs['env'] == {
+        'GIT_SSH_COMMAND': ssh_mux.ssh_command(fabfile.SSH_CONTROL_PERSIST)
+    }
+    with patch('fabfile.SSH_CONTROL_PERSIST', ''):
+        assert fabfile.git_env() == {}
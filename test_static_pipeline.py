@@ -0,0 +1,87 @@
+import gzip
+import json
+import os
+
+import pytest
+from flask import Flask
+
+from flask_project.assets import asset_url
+from static_pipeline import build, file_hash, is_output, main
+
+CSS = b'body { color: black; }\n' * 40
+
+
+@pytest.fixture
+def static(tmp_path):
+    static = tmp_path / 'static'
+    (static / 'css').mkdir(parents=True)
+    (static / 'css' / 'app.css').write_bytes(CSS)
+    (static / 'logo.png').write_bytes(b'\x89PNG' + b'\0' * 500)
+    (static / 'tiny.js').write_bytes(b'1;')
+    return static
+
+
+def test_build(static):
+    manifest, processed = build(str(static))
+    assert processed == 3
+    css = manifest['css/app.css']
+    assert css == {
+        'file': f'css/app.{file_hash(static / "css" / "app.css")}.css',
+        'compressed': ['.gz'],
+    }
+    assert (static / css['file']).read_bytes() == CSS
+    assert gzip.decompress((static / (css['file'] + '.gz')).read_bytes()) \
+        == CSS
+    assert (static / 'css' / 'app.css.gz').exists()
+    assert manifest['logo.png']['compressed'] == []
+    assert manifest['tiny.js']['compressed'] == []
+    assert json.loads((static / 'manifest.json').read_text()) == manifest
+
+
+def test_incremental(static):
+    first, _ = build(str(static))
+    _, processed = build(str(static))
+    assert processed == 0
+
+    (static / 'css' / 'app.css').write_bytes(CSS + b'a { }\n')
+    manifest, processed = build(str(static))
+    assert processed == 1
+    old = first['css/app.css']['file']
+    assert not (static / old).exists()
+    assert not (static / (old + '.gz')).exists()
+    assert (static / manifest['css/app.css']['file']).exists()
+
+
+def test_previous_release(static, tmp_path):
+    build(str(static))
+    release = tmp_path / 'release'
+    (release / 'css').mkdir(parents=True)
+    (release / 'css' / 'app.css').write_bytes(CSS)
+    (release / 'logo.png').write_bytes(b'\x89PNG' + b'\1' * 500)
+    manifest, processed = build(str(release), str(static))
+    assert processed == 1
+    hashed = manifest['css/app.css']['file'] + '.gz'
+    assert os.path.samefile(release / hashed, static / hashed)
+    assert (release / 'css' / 'app.css.gz').exists()
+
+
+def test_main_ignores_same_previous(static, capsys):
+    main([str(static), '--previous', str(static)])
+    assert capsys.readouterr().out == 'static: 3 files, 3 processed\n'
+
+
+def test_is_output():
+    assert is_output('manifest.json')
+    assert is_output('app.css.gz')
+    assert is_output('app.0123456789ab.css')
+    assert not is_output('app.css')
+    assert not is_output('jquery.3.6.0.min.js')
+
+
+def test_asset_url(static):
+    manifest, _ = build(str(static))
+    app = Flask(__name__, static_folder=str(static))
+    with app.test_request_context():
+        assert asset_url('css/app.css') == \
+            f"/static/{manifest['css/app.css']['file']}"
+        assert asset_url('other.js') == '/static/other.js'
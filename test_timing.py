@@ -0,0 +1,115 @@
+import asyncio
+import os
+
+from flask import Flask
+
+from flask_project.timing import (
+    Histogram, Timings, TimingMiddleware, ASGITimingMiddleware, instrument,
+    from_environ, url_map_route,
+)
+
+
+def make_app(timings):
+    app = Flask(__name__)
+
+    @app.route('/items/<int:n>')
+    def item(n):
+        return str(n)
+
+    app.wsgi_app = TimingMiddleware(
+        app.wsgi_app, timings, url_map_route(app.url_map)
+    )
+    return app
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(0.01, 0.1, float('inf')))
+    for seconds in (0.005, 0.05, 0.05, 3):
+        histogram.observe(seconds)
+    assert histogram.as_dict() == {
+        'count': 4, 'sum': 3.105,
+        'buckets': {'0.01': 1, '0.1': 3, '+Inf': 4},
+    }
+
+
+def test_server_timing_and_routes():
+    timings = Timings()
+    client = make_app(timings).test_client()
+    response = client.get('/items/1')
+    client.get('/items/2')
+    client.get('/nowhere')
+    assert response.headers['Server-Timing'].startswith('app;dur=')
+    snapshot = timings.snapshot()
+    assert set(snapshot) == {'/items/<int:n>', '<unmatched>'}
+    assert snapshot['/items/<int:n>']['count'] == 2
+
+
+def test_keeps_slowest_profiles(tmp_path):
+    timings = Timings(profile_rate=1.0, profile_dir=str(tmp_path), keep=2)
+    for seconds in (0.3, 0.1, 0.5, 0.2):
+        profile = timings.profiler()
+        assert profile is not None
+        timings.save(profile, '/items/<int:n>', seconds)
+    names = sorted(os.listdir(tmp_path))
+    assert len(names) == 2
+    assert names[0].startswith('0000300.0ms-items_int_n')
+    assert names[1].startswith('0000500.0ms-items_int_n')
+
+
+def test_one_profile_at_a_time(tmp_path):
+    timings = Timings(profile_rate=1.0, profile_dir=str(tmp_path))
+    profile = timings.profiler()
+    assert timings.profiler() is None
+    timings.save(profile, '/', 0.1)
+    assert timings.profiler() is not None
+
+
+def test_profiles_requests(tmp_path):
+    timings = Timings(profile_rate=1.0, profile_dir=str(tmp_path))
+    make_app(timings).test_client().get('/items/3')
+    assert [name for name in os.listdir(tmp_path) if name.endswith('.prof')]
+
+
+def test_dump(tmp_path):
+    timings = Timings(profile_dir=str(tmp_path))
+    timings.observe('/', 0.01)
+    timings.dump()
+    assert os.listdir(tmp_path) == [f'timing-{os.getpid()}.json']
+
+
+def test_instrument_off():
+    app = object()
+    assert instrument(app, environ={}) is app
+    assert instrument(app, environ={'APP_TIMING': '0'}) is app
+    assert from_environ({}) is None
+
+
+def test_instrument_on():
+    app = object()
+    wrapped = instrument(app, environ={
+        'APP_TIMING': '1', 'APP_PROFILE_RATE': '0.5', 'APP_PROFILE_KEEP': '5'
+    })
+    assert wrapped.app is app
+    assert wrapped.timings.profile_rate == 0.5
+    assert wrapped.timings.keep == 5
+    assert isinstance(instrument(app, asgi=True, environ={'APP_TIMING': '1'}),
+                      ASGITimingMiddleware)
+
+
+def test_asgi():
+    async def app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': b'ok'})
+
+    timings = Timings()
+    middleware = ASGITimingMiddleware(app, timings)
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(middleware({'type': 'http', 'path': '/a'}, None, send))
+    headers = dict(sent[0]['headers'])
+    assert headers[b'server-timing'].startswith(b'app;dur=')
+    assert timings.snapshot()['/a']['count'] == 1